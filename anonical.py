@@ -4,7 +4,8 @@ import re
 import sys
 
 
-pattern = '^BEGIN:VEVENT|^END:VEVENT|^DTSTART|^DTEND|^DURATION|^RRULE'.encode()
+pattern = ('^BEGIN:VEVENT|^END:VEVENT|^DTSTART|^DTEND|^DURATION|^RRULE|'
+           '^EXRULE|^RDATE|^EXDATE').encode()
 match = re.compile(pattern)
 
 if __name__ == '__main__':
@@ -24,7 +25,7 @@ if __name__ == '__main__':
     else:
         outfile = open(sys.argv[2], 'wb')
 
-    for line in infile.readlines():
+    for line in infile:
         line = line.upper()
         if match.match(line):
             outfile.write(line)
@@ -1,73 +1,229 @@
+from AccessControl.Permissions import manage_zcatalog_indexes
+from AccessControl.SecurityInfo import ClassSecurityInfo
+from AccessControl.class_init import InitializeClass
+from App.config import getConfiguration
 from App.special_dtml import DTMLFile
+from BTrees.IIBTree import IIBTree
 from BTrees.IIBTree import IITreeSet
 from BTrees.IIBTree import intersection
-from BTrees.IIBTree import union
 from BTrees.IIBTree import multiunion
 from BTrees.IOBTree import IOBTree
+from BTrees.LLBTree import LLBTree
+from BTrees.LOBTree import LOBTree
 from BTrees.Length import Length
 from BTrees.OOBTree import OOBTree
 from DateTime import DateTime
 from OFS.SimpleItem import SimpleItem
+from Products.PluginIndexes.interfaces import ILimitedResultIndex
 from Products.PluginIndexes.interfaces import IPluggableIndex
+from bisect import bisect_right
+from calendar import timegm
 from datetime import datetime
+from datetime import timedelta
 from dateutil import rrule
+from heapq import heappop
+from heapq import heappush
+from heapq import heapreplace
+from itertools import chain
+from plone.app.eventindex.budget import ExpansionBudget
+from plone.app.eventindex.budget import ExpansionBudgetExceeded
+from plone.app.eventindex.cache import LRUCache
+from plone.app.eventindex.parallel import filter_parallel
+from plone.app.eventindex.parallel import start as start_pool
+from plone.app.eventindex.recurrence import canonical_rule
+from plone.app.eventindex.recurrence import compile_rule
+from plone.app.eventindex.recurrence import expand_seconds
+from plone.app.eventindex.recurrence import from_seconds
+from plone.app.eventindex.recurrence import is_open_ended
+from plone.app.eventindex.recurrence import last_occurrence
+from plone.app.eventindex.recurrence import localize_datetime
+from plone.app.eventindex.recurrence import period_signature
+from plone.app.eventindex.recurrence import rule_cost
+from plone.app.eventindex.recurrence import rule_signature
+from plone.app.eventindex.recurrence import rule_step
+from plone.app.eventindex.recurrence import sync_timezone
+from plone.app.eventindex.recurrence import to_seconds
+from plone.app.eventindex.recurrence import utc_datetime
+from plone.app.eventindex.rows import Row
+from plone.app.eventindex.stats import QueryStats
+from plone.app.eventindex.stats import Statistics
+from plone.app.eventindex.stats import get_statistics
+from plone.app.eventindex.stats import report
+from plone.app.eventindex.vectorized import overlapping
 from zope.interface import implements
 
+import logging
+import pytz
+import transaction
 
-def is_open_ended(rule):
-    if isinstance(rule, rrule.rruleset):
-        rules = rule._rrule
-    else:
-        rules = [rule]
 
-    for r in rules:
-        if r._count is None and r._until is None:
-            return True
+logger = logging.getLogger('plone.app.eventindex')
 
-    return False
 
+# Open ended events end at OPEN_END, which sorts after all real times.
+OPEN_END = 2 ** 63 - 1
 
-def localize_datetime(dt, tz):
-    if not isinstance(dt, datetime):
-        return dt
+# The version of the data structures, see EventIndex.upgrade().
+INDEX_VERSION = 6
 
-    if tz is None and dt.tzinfo is not None:
-        return dt.replace(tzinfo=None)
-    elif tz is not None and dt.tzinfo is None:
-        return tz.localize(dt)
-    else:
-        return dt
 
+class UpgradeRequired(Exception):
+    """The data structures of an index are older than the code."""
 
-def sync_timezone(rule, tz):
-    if isinstance(rule, rrule.rruleset):
-        if getattr(rule, '_exdate', None):
-            rule._exdate = [localize_datetime(x, tz) for x in rule._exdate]
-        if getattr(rule, '_rdate', None):
-            rule._rdate = [localize_datetime(x, tz) for x in rule._rdate]
-        for x in rule._rrule:
-            sync_timezone(x, tz)
-    else:
-        if getattr(rule, '_until', None):
-            rule._until = localize_datetime(rule._until, tz)
-        if getattr(rule, '_dtstart', None):
-            rule._dtstart = localize_datetime(rule._dtstart, tz)
+
+# The bucket sizes of calendar(), in seconds.
+BUCKET_SIZES = {
+    'hour': 3600,
+    'day': 86400,
+    'week': 7 * 86400,
+}
+
+# Query results, shared by all ZODB connections of the process and keyed on
+# the index, its modification counter and the query period.
+result_cache = LRUCache(1000)
+
+
+def count_keys(ranges, limit=None):
+    """Count the keys of several BTree ranges in lockstep.
+
+    Counting stops as soon as one of the ranges is exhausted, or when
+    ``limit`` keys have been counted in each range, so the cost is bounded
+    by the smallest range. Returns the counts and the position of the
+    exhausted range, or None if the limit was reached first. Only the count
+    of the exhausted range is exact, the others are lower bounds.
+    """
+    iterators = [iter(keys) for keys in ranges]
+    counts = [0] * len(iterators)
+    while limit is None or counts[-1] < limit:
+        for position, iterator in enumerate(iterators):
+            try:
+                iterator.next()
+            except StopIteration:
+                return counts, position
+            counts[position] += 1
+    return counts, None
+
+
+class SortKeys(object):
+    """The sort keys of the documents of an index, see documentToKeyMap.
+
+    The keys are computed when they are first needed, and then kept for the
+    rest of the query.
+    """
+
+    def __init__(self, index, start, keys):
+        self.index = index
+        self.start = start
+        self.keys = keys
+
+    def __getitem__(self, documentId):
+        key = self.keys.get(documentId)
+        if key is None:
+            # Raises a KeyError for documents that aren't indexed.
+            key = self.keys[documentId] = self.index._sort_key(documentId,
+                                                               self.start)
+        return key
+
+    def get(self, documentId, default=None):
+        try:
+            return self[documentId]
+        except KeyError:
+            return default
 
 
 class EventIndex(SimpleItem):
 
-    implements(IPluggableIndex)
+    implements(IPluggableIndex, ILimitedResultIndex)
 
     meta_type = "EventIndex"
 
+    security = ClassSecurityInfo()
+
     manage_options = (
         {'label': 'Settings',
          'action': 'manage_main'},
+        {'label': 'Statistics',
+         'action': 'manage_statistics'},
     )
 
     manage = manage_main = DTMLFile('www/manageEventIndex', globals())
     manage_main._setName('manage_main')
 
+    security.declareProtected(manage_zcatalog_indexes, 'manage_statistics')
+    manage_statistics = DTMLFile('www/statisticsEventIndex', globals())
+    security.declareProtected(manage_zcatalog_indexes, 'getStatistics')
+    security.declareProtected(manage_zcatalog_indexes,
+                              'manage_resetStatistics')
+    security.declareProtected(manage_zcatalog_indexes, 'manage_upgrade')
+
+    # Materialization of recurring events is optional and disabled by
+    # default, see enable_materialization(). These defaults also apply to
+    # indexes created before materialization existed.
+    materialize_before = 30
+    materialize_after = 365
+    _horizon = None
+    _occurrence2uid = None
+    _unmaterialized = None  # Recurrences with too many occurrences to store
+    _max_duration = 0
+
+    # When a range scan is estimated to be more than verify_factor times
+    # larger than the set of candidates it is to be intersected with, the
+    # candidates are checked one by one instead.
+    verify_factor = 4
+
+    # The start of queries is rounded down and the end up to multiples of
+    # cache_quantum seconds, so that queries for nearly the same period,
+    # like from now on, share their entries in the result cache.
+    cache_quantum = 0
+    _counter = None
+
+    # The interval grid has grid_levels levels of buckets, the buckets of
+    # the lowest level are grid_base seconds wide, and each level doubles
+    # the width. Indexes created before the grid existed have no grid until
+    # build_grid() is called.
+    grid_base = 3600
+    grid_levels = 17
+    _grid = None
+    _grid_overflow = None
+
+    # Expanding a recurrence may skip at most max_occurrences occurrences
+    # before the query period, and all the expansions of a query together at
+    # most query_budget occurrences and query_timeout seconds (None for no
+    # limit). Recurrences over the budget are handled by budget_policy,
+    # which is 'match' to include them in the result, 'nomatch' to leave
+    # them out, or 'raise' to raise ExpansionBudgetExceeded.
+    max_occurrences = 10000
+    query_budget = 100000
+    query_timeout = None
+    budget_policy = 'match'
+
+    # When parallel_processes is set, queries with at least
+    # parallel_threshold recurring candidates expand them in a pool of that
+    # many processes, parallel_chunk candidates at a time. The per event
+    # max_occurrences applies, but not the query_budget and query_timeout.
+    parallel_processes = 0
+    parallel_threshold = 1000
+    parallel_chunk = 250
+
+    # Queries taking at least slow_query_threshold seconds are logged, and
+    # kept in the slow query log of the Statistics tab. None disables it.
+    slow_query_threshold = 1.0
+
+    # The last occurrence of a bounded recurrence that can't be computed is
+    # found by expanding it, up to max_indexed_occurrences occurrences.
+    # Longer recurrences are indexed as if they were open ended.
+    max_indexed_occurrences = 100000
+
+    # Rows of the trees keyed on times are kept when they become empty, so
+    # concurrent transactions moving events to and from popular times, like
+    # midnight, only change the rows, whose conflicts are resolved, and not
+    # the trees themselves. See prune_rows() and Row.
+    keep_empty_rows = True
+    _row_type = Row
+
+    # Indexes created before versioning have version 0.
+    _version = 0
+
     def __init__(self, id, extra=None, caller=None):
         self._id = id
         self.start_attr = extra and extra['start_attr'] or 'start'
@@ -77,13 +233,155 @@ class EventIndex(SimpleItem):
 
     def clear(self):
         """Empty the index"""
+        if self._counter is None:
+            self._counter = Length()
+        else:
+            self._increment_counter()
+        self._version = INDEX_VERSION
         self._length = Length()
-        self._end2uid = OOBTree()
-        self._start2uid = OOBTree()
-        self._uid2end = IOBTree()  # Contains the index used in _end2uid
-        self._uid2duration = IOBTree()  # Contains the duration
-        self._uid2start = IOBTree()
+        self._end2uid = LOBTree()
+        self._start2uid = LOBTree()
+        self._uid2end = LLBTree()  # Contains the index used in _end2uid
+        self._uid2duration = LLBTree()  # Contains the duration in seconds
+        self._uid2start = LLBTree()
         self._uid2recurrence = IOBTree()
+        self._grid = IOBTree()  # level -> bucket -> documentIds
+        self._grid_overflow = self._row_type()  # Too long for the grid
+        self._signature2uid = OOBTree()  # Open ended events by signature
+        self._uid2signature = IOBTree()
+        self._uid2cost = IIBTree()  # Cost classes of the recurrences
+        self._uid2step = LLBTree()  # Seconds between regular occurrences
+        if self._horizon is not None:
+            self._occurrence2uid = LOBTree()
+            self._unmaterialized = IITreeSet()
+            self._max_duration = 0
+
+    def upgrade(self):
+        """Upgrade the data structures of an index from an older version.
+
+        This is done when deploying a new version, in a transaction of its
+        own, by the ``plone.app.eventindex.upgrade`` script or the Upgrade
+        button of the Settings tab. Until then, queries and indexing raise
+        UpgradeRequired, as they can't use the old data structures, and
+        shouldn't rewrite the whole index in the request of a visitor or an
+        editor.
+        """
+        if self._version < 1:
+            self._upgrade_epoch_keys()
+        if self._version < 2:
+            self._upgrade_rule_storage()
+        if self._version < 3:
+            self._upgrade_signatures()
+        if self._version < 4:
+            self._upgrade_costs()
+        if self._version < 5:
+            self._upgrade_steps()
+        if self._version < 6:
+            self._upgrade_length()
+        self._version = INDEX_VERSION
+
+    def needsUpgrade(self):
+        """Return whether the data structures of the index are outdated."""
+        return self._version < INDEX_VERSION
+
+    def manage_upgrade(self, REQUEST=None):
+        """Upgrade the data structures of the index."""
+        self.upgrade()
+        if REQUEST is not None:
+            REQUEST.RESPONSE.redirect(self.absolute_url() + '/manage_main')
+
+    def _check_version(self):
+        if self._version < INDEX_VERSION:
+            raise UpgradeRequired(
+                "Index %s has version %s data structures, upgrade it to "
+                "version %s with the plone.app.eventindex.upgrade script or "
+                "the Upgrade button of its Settings tab" % (
+                    self._id, self._version, INDEX_VERSION))
+
+    def _upgrade_epoch_keys(self):
+        # Version 0 stored UTC time tuples, and None as the end of open ended
+        # events, in OOBTrees and the durations as timedeltas.
+        uid2start = self._uid2start
+        uid2end = self._uid2end
+        uid2duration = self._uid2duration
+        self._end2uid = LOBTree()
+        self._start2uid = LOBTree()
+        self._uid2end = LLBTree()
+        self._uid2duration = LLBTree()
+        self._uid2start = LLBTree()
+
+        for documentId, start_value in uid2start.items():
+            start_value = timegm(start_value)
+            end_value = uid2end[documentId]
+            if end_value is None:
+                end_value = OPEN_END
+            else:
+                end_value = timegm(end_value)
+            duration = uid2duration[documentId]
+
+            self._insert_row(self._start2uid, start_value, documentId)
+            self._insert_row(self._end2uid, end_value, documentId)
+            self._uid2start[documentId] = start_value
+            self._uid2end[documentId] = end_value
+            self._uid2duration[documentId] = (duration.days * 86400 +
+                                              duration.seconds)
+
+        # Indexes of version 0 predate the grid, and keep using the range
+        # scans until build_grid() is called. Only an existing grid is
+        # rebuilt on the new keys.
+        if self._grid is not None:
+            self.build_grid()
+        if self._horizon is not None:
+            self._rematerialize()
+
+    def _upgrade_rule_storage(self):
+        # Version 1 stored the rrule and rruleset objects themselves.
+        for documentId, rule in list(self._uid2recurrence.items()):
+            if rule is None or isinstance(rule, tuple):
+                continue
+            if isinstance(rule, rrule.rruleset):
+                if not rule._rrule:
+                    continue
+                start = rule._rrule[0]._dtstart
+            else:
+                start = rule._dtstart
+            self._uid2recurrence[documentId] = canonical_rule(rule, start)
+
+    def _upgrade_signatures(self):
+        self._signature2uid = OOBTree()
+        self._uid2signature = IOBTree()
+        for documentId, end_value in self._uid2end.items():
+            if end_value == OPEN_END:
+                self._signature_insert(documentId,
+                                       self._uid2recurrence[documentId])
+
+    def _upgrade_costs(self):
+        self._uid2cost = IIBTree()
+        for documentId, recurrence in self._uid2recurrence.items():
+            if recurrence is not None:
+                self._uid2cost[documentId] = rule_cost(
+                    compile_rule(recurrence))
+
+    def _increment_counter(self):
+        if self._counter is None:
+            self._counter = Length()
+        self._counter.change(1)
+
+    def getCounter(self):
+        """Return a counter which is increased on index changes"""
+        return self._counter is not None and self._counter() or 0
+
+    def _upgrade_steps(self):
+        self._uid2step = LLBTree()
+        for documentId, recurrence in self._uid2recurrence.items():
+            if recurrence is not None:
+                step = rule_step(compile_rule(recurrence))
+                if step is not None:
+                    self._uid2step[documentId] = step
+
+    def _upgrade_length(self):
+        # Before version 6 the length wasn't maintained.
+        self._length = Length(len(self._uid2start))
 
     def getId(self):
         """Return Id of index."""
@@ -92,11 +390,11 @@ class EventIndex(SimpleItem):
     def getEntryForObject(self, documentId, default=''):
         """Get all information contained for 'documentId'."""
         uid2start = self._uid2start.get(documentId)
-        if uid2start:
+        if uid2start is not None:
             return {
                 'start': uid2start,
                 'end': self._uid2end[documentId],
-                'recurrence': self._uid2recurrence[documentId],
+                'recurrence': compile_rule(self._uid2recurrence[documentId]),
                 'duration': self._uid2duration[documentId]
             }
         else:
@@ -136,27 +434,75 @@ class EventIndex(SimpleItem):
           calling it raises an AttributeError, do not add it to the index.
           for that name.
         """
+        self._check_version()
+
+        values = self._compute_values(obj)
+        if values is not None and self._unchanged(documentId, values):
+            # Reindexing for a change of other attributes. Nothing is
+            # written, so this can't cause any conflicts.
+            self._statistics().unchanged()
+            return False
+
         # Clear the data structures before indexing the object. This will ensure
         # we don't leave any stale data behind when an object gets reindexed.
         self.unindex_object(documentId)
 
+        if values is None:
+            # Ignore calls if the obj does not have the start field.
+            return False
+
+        start_value, end_value, duration_value, recurrence = values
+        self._increment_counter()
+        self._length.change(1)
+        self._insert_row(self._start2uid, start_value, documentId)
+        self._insert_row(self._end2uid, end_value, documentId)
+
+        self._uid2start[documentId] = start_value
+        self._uid2recurrence[documentId] = recurrence
+        self._uid2end[documentId] = end_value
+        self._uid2duration[documentId] = duration_value
+        if recurrence is not None:
+            rule = compile_rule(recurrence)
+            self._uid2cost[documentId] = rule_cost(rule)
+            step = rule_step(rule)
+            if step is not None:
+                self._uid2step[documentId] = step
+
+        if self._grid is not None:
+            self._grid_insert(documentId, start_value, end_value)
+
+        if end_value == OPEN_END:
+            self._signature_insert(documentId, recurrence)
+
+        if self._horizon is not None and recurrence is not None:
+            self._materialize(documentId, *self._horizon)
+
+        return True
+
+    def _compute_values(self, obj):
+        """Compute what should be indexed for an object.
+
+        Returns a (start, end, duration, recurrence) tuple of the values to
+        store, or None if the object has no start.
+        """
         ### 1. Get the values.
         start = self._getattr(self.start_attr, obj)
         end = self._getattr(self.end_attr, obj)
         if start is None:
-            # Ignore calls if the obj does not have the start field.
-            return False
+            return None
 
         if end is None:
             # Singular event
             end = start
 
         recurrence = self._getattr(self.recurrence_attr, obj)
+        text = None
         if not recurrence:
             rule = None
         elif isinstance(recurrence, basestring):
             # XXX trap and log errors
             rule = rrule.rrulestr(recurrence, dtstart=start)
+            text = recurrence
         elif isinstance(recurrence, rrule.rrulebase):
             rule = recurrence
         else:
@@ -169,49 +515,214 @@ class EventIndex(SimpleItem):
 
         ### 2. Make them into what should be indexed.
         # XXX Naive events are not comparable to timezoned events, so we convert
-        # everything to utctimetuple(). This means naive events are assumed to
-        # be GMT, but we can live with that at the moment.
-        start_value = start.utctimetuple()
-        end_value = end.utctimetuple()
+        # everything to seconds since the epoch in UTC. This means naive events
+        # are assumed to be GMT, but we can live with that at the moment.
+        start_value = to_seconds(start)
+        end_value = to_seconds(end)
+        duration_value = end_value - start_value
 
         # The end value should be the end of the recurrence, if any:
-        if rule is not None:
-            if is_open_ended(rule):
-                # This recurrence is open ended
-                end_value = None
+        if rule is None:
+            return start_value, end_value, duration_value, None
+
+        if is_open_ended(rule):
+            # This recurrence is open ended
+            end_value = OPEN_END
+        else:
+            try:
+                last = last_occurrence(rule, self.max_indexed_occurrences)
+            except ExpansionBudgetExceeded, e:
+                # Expanding it on every edit would be too slow, so we index
+                # it as if it were open ended.
+                logger.warning('%s: %s, indexing it as open ended' % (
+                    self.getId(), e))
+                end_value = OPEN_END
             else:
-                duration = end - start
-                allrecs = [x for x in rule._iter()]
-                if allrecs:
-                    last = allrecs[-1] + duration
+                if last is not None:
+                    last += end - start
                 else:
                     # Real data may have invalud recurrence rules,
                     # which end before the start for example.
                     # Then we end up here.
                     last = end
-                end_value = last.utctimetuple()
+                end_value = to_seconds(last)
+
+        # Store the rule in its compact form rather than pickling it.
+        return (start_value, end_value, duration_value,
+                canonical_rule(rule, start, text))
+
+    def _unchanged(self, documentId, values):
+        """Check if a document is indexed with these values already."""
+        start_value, end_value, duration_value, recurrence = values
+        return (self._uid2start.get(documentId) == start_value and
+                self._uid2end[documentId] == end_value and
+                self._uid2duration[documentId] == duration_value and
+                self._uid2recurrence.get(documentId) == recurrence)
+
+    def index_objects(self, objects):
+        """Index many objects at once, for example when rebuilding a catalog.
+
+        ``objects`` is an iterable of (documentId, obj) pairs. This gives
+        the same result as calling ``index_object`` for each pair, but all
+        values are computed first, and then written key by key in sorted
+        order, so every BTree bucket is loaded and changed once instead of
+        once per object. If the index is empty, the trees are built from
+        scratch. Objects that are indexed with the same values already are
+        left alone.
+
+        Returns the number of objects indexed.
+        """
+        self._check_version()
+
+        rows = {}
+        unchanged = 0
+        for documentId, obj in objects:
+            values = self._compute_values(obj)
+            if values is not None and self._unchanged(documentId, values):
+                self._statistics().unchanged()
+                rows.pop(documentId, None)
+                unchanged += 1
+                continue
+            rows[documentId] = values
 
-        ### 3. Store everything in the indexes:
-        row = self._start2uid.get(start_value, None)
-        if row is None:
-            row = IITreeSet((documentId,))
-            self._start2uid[start_value] = row
+        if self._uid2start:
+            for documentId in rows:
+                self.unindex_object(documentId)
+            fresh = False
         else:
-            row.insert(documentId)
+            fresh = True
+
+        starts = {}
+        ends = {}
+        positions = {}
+        overflow = []
+        uid2start = []
+        uid2end = []
+        uid2duration = []
+        uid2recurrence = []
+        uid2cost = []
+        uid2step = []
+        for documentId, values in sorted(rows.items()):
+            if values is None:
+                continue
+            start_value, end_value, duration_value, recurrence = values
+            starts.setdefault(start_value, []).append(documentId)
+            ends.setdefault(end_value, []).append(documentId)
+            uid2start.append((documentId, start_value))
+            uid2end.append((documentId, end_value))
+            uid2duration.append((documentId, duration_value))
+            uid2recurrence.append((documentId, recurrence))
+            if recurrence is not None:
+                rule = compile_rule(recurrence)
+                uid2cost.append((documentId, rule_cost(rule)))
+                step = rule_step(rule)
+                if step is not None:
+                    uid2step.append((documentId, step))
+            if self._grid is not None:
+                position = self._grid_position(start_value, end_value)
+                if position is None:
+                    overflow.append(documentId)
+                else:
+                    positions.setdefault(position, []).append(documentId)
+
+        if fresh:
+            self._start2uid = LOBTree(
+                [(key, self._row_type(row))
+                 for key, row in sorted(starts.items())])
+            self._end2uid = LOBTree(
+                [(key, self._row_type(row))
+                 for key, row in sorted(ends.items())])
+            self._uid2start = LLBTree(uid2start)
+            self._uid2end = LLBTree(uid2end)
+            self._uid2duration = LLBTree(uid2duration)
+            self._uid2recurrence = IOBTree(uid2recurrence)
+            self._uid2cost = IIBTree(uid2cost)
+            self._uid2step = LLBTree(uid2step)
+        else:
+            self._insert_rows(self._start2uid, starts)
+            self._insert_rows(self._end2uid, ends)
+            self._uid2start.update(uid2start)
+            self._uid2end.update(uid2end)
+            self._uid2duration.update(uid2duration)
+            self._uid2recurrence.update(uid2recurrence)
+            self._uid2cost.update(uid2cost)
+            self._uid2step.update(uid2step)
+
+        if self._grid is not None:
+            levels = {}
+            for (level, bucket), row in positions.items():
+                levels.setdefault(level, {})[bucket] = row
+            for level, rows_by_bucket in sorted(levels.items()):
+                buckets = self._grid.get(level)
+                if buckets is None:
+                    buckets = IOBTree()
+                    self._grid[level] = buckets
+                self._insert_rows(buckets, rows_by_bucket)
+            self._grid_overflow.update(overflow)
+
+        for documentId, end_value in uid2end:
+            if end_value == OPEN_END:
+                self._signature_insert(documentId, rows[documentId][3])
+
+        if self._horizon is not None:
+            for documentId, recurrence in uid2recurrence:
+                if recurrence is not None:
+                    self._materialize(documentId, *self._horizon)
+
+        if rows:
+            self._increment_counter()
+        if uid2start:
+            self._length.change(len(uid2start))
+        return len(uid2start) + unchanged
 
-        row = self._end2uid.get(end_value, None)
+    def _insert_row(self, to_uid, key, documentId):
+        """Add documentId to the row of key, creating the row if needed."""
+        row = to_uid.get(key, None)
         if row is None:
-            row = IITreeSet((documentId,))
-            self._end2uid[end_value] = row
+            row = self._row_type((documentId,))
+            to_uid[key] = row
         else:
             row.insert(documentId)
 
-        self._uid2start[documentId] = start_value
-        self._uid2recurrence[documentId] = rule
-        self._uid2end[documentId] = end_value
-        self._uid2duration[documentId] = end - start
+    def _insert_rows(self, to_uid, rows):
+        """Add the documentIds of a mapping of keys to lists to the rows."""
+        for key, documentIds in sorted(rows.items()):
+            row = to_uid.get(key, None)
+            if row is None:
+                to_uid[key] = self._row_type(documentIds)
+            else:
+                row.update(documentIds)
 
-        return True
+    def _remove_row(self, to_uid, key, documentId):
+        """Remove documentId from the row of key.
+
+        Empty rows are removed too, unless ``keep_empty_rows`` is set.
+        """
+        row = to_uid.get(key)
+        if row is not None:
+            if documentId in row:
+                row.remove(documentId)
+            if not self.keep_empty_rows and not row:
+                del to_uid[key]
+
+    def prune_rows(self):
+        """Remove the empty rows kept by ``keep_empty_rows``.
+
+        Returns the number of rows removed. This rewrites the trees keyed on
+        times, so it is best done at a quiet moment, like a database pack.
+        """
+        trees = [self._start2uid, self._end2uid, self._signature2uid]
+        if self._occurrence2uid is not None:
+            trees.append(self._occurrence2uid)
+        if self._grid is not None:
+            trees.extend(self._grid.values())
+        removed = 0
+        for to_uid in trees:
+            empty = [key for key, row in to_uid.items() if not row]
+            for key in empty:
+                del to_uid[key]
+            removed += len(empty)
+        return removed
 
     def _remove_id(self, documentId, from_uid, to_uid):
         """Remove documentId based on point.
@@ -226,20 +737,77 @@ class EventIndex(SimpleItem):
         :param to_uid:
         :type to_uid:
         """
-        fuid = from_uid.pop(documentId, 'No ID found')
-        row = to_uid.get(fuid)
-        if row is not None:
-            if documentId in row:
-                row.remove(documentId)
-            if len(row) == 0:
-                to_uid.pop(fuid, 'Not Found')
+        fuid = from_uid.pop(documentId, None)
+        if fuid is not None:
+            self._remove_row(to_uid, fuid, documentId)
 
     def unindex_object(self, documentId):
         """Remove the documentId from the index."""
+        self._check_version()
+
+        if documentId not in self._uid2start:
+            return
+
+        self._increment_counter()
+        self._length.change(-1)
+        self._dematerialize(documentId)
+        self._grid_remove(documentId)
+        self._signature_remove(documentId)
         self._remove_id(documentId, self._uid2start, self._start2uid)
         self._remove_id(documentId, self._uid2end, self._end2uid)
         self._uid2duration.pop(documentId, 'No ID found')
         self._uid2recurrence.pop(documentId, 'No ID found')
+        self._uid2cost.pop(documentId, None)
+        self._uid2step.pop(documentId, None)
+
+    def _signature_insert(self, documentId, recurrence):
+        """Add an open ended recurring event to its signature group.
+
+        The events are grouped on the signature of their rule and their
+        duration, see ``rule_signature``, so queries can skip whole groups
+        of events which can't have occurrences within the query period.
+        """
+        if not isinstance(recurrence, tuple):
+            # Rules not in the compact form may have timezones with varying
+            # offsets, so the hours of their occurrences aren't known.
+            return
+        signature = rule_signature(compile_rule(recurrence))
+        if signature is None:
+            return
+        key = signature + (self._uid2duration[documentId],)
+        self._uid2signature[documentId] = key
+        self._insert_row(self._signature2uid, key, documentId)
+
+    def _signature_remove(self, documentId):
+        key = self._uid2signature.pop(documentId, None)
+        if key is not None:
+            self._remove_row(self._signature2uid, key, documentId)
+
+    def _rejected_by_signature(self, start, end):
+        """Find the open ended events which can't occur within a period.
+
+        ``start`` and ``end`` are naive UTC datetimes. Returns the union of
+        the signature groups whose occurrences can't overlap the period, or
+        None if there are none.
+        """
+        if start is None or end is None:
+            return None
+
+        start = to_seconds(start)
+        end = to_seconds(end)
+        rejected = []
+        for key, row in self._signature2uid.items():
+            weekmask, monthmask, duration = key
+            # An occurrence overlaps the period if it starts within it, or
+            # less than its duration before it:
+            period_weekmask, period_monthmask = period_signature(
+                start - duration + 1, end)
+            if not (weekmask & period_weekmask and
+                    monthmask & period_monthmask):
+                rejected.append(row)
+        if not rejected:
+            return None
+        return multiunion(rejected)
 
     def _get_position(self, request, position):
         """Get position from certain ID.
@@ -255,9 +823,206 @@ class EventIndex(SimpleItem):
             pos = pos.utcdatetime()
         return pos
 
-    def _finalize_index(self, result, start, end, used_fields):
+    def _iter_occurrences(self, documentId, start, end, budget=None):
+        """Iterate over the occurrences of a document within a period.
+
+        Yields ``(occurrence_start, occurrence_end)`` tuples of naive UTC
+        datetimes for every occurrence that ends after ``start`` and starts
+        before or at ``end``. Either of ``start`` and ``end`` may be None,
+        meaning that the period is open in that direction.
+
+        If an ``ExpansionBudget`` is given, the occurrences skipped before
+        the period are counted against it.
+        """
+        if start is not None:
+            start = to_seconds(start)
+        if end is not None:
+            end = to_seconds(end)
+        for occurrence_start, occurrence_end in self._iter_occurrence_seconds(
+                documentId, start, end, budget):
+            yield from_seconds(occurrence_start), from_seconds(occurrence_end)
+
+    def _iter_occurrence_seconds(self, documentId, start, end, budget=None):
+        """Iterate over the occurrences of a document within a period.
+
+        This is ``_iter_occurrences`` with ``start`` and ``end``, and the
+        occurrence times yielded, in seconds since the epoch.
+        """
+        event_start = self._uid2start[documentId]
+        duration = self._uid2duration[documentId]
+        recurrence = compile_rule(self._uid2recurrence.get(documentId))
+        if recurrence is None:
+            # The range scans have already matched single events.
+            yield event_start, event_start + duration
+            return
+
+        for occurrence in expand_seconds(recurrence, duration, start, end,
+                                         budget and budget.spend):
+            yield occurrence
+
+    def _materialize(self, documentId, lo, hi):
+        """Store the occurrences of a document starting within [lo, hi).
+
+        Recurrences with more than ``max_occurrences`` occurrences within
+        [lo, hi), or before it, aren't stored at all. They are added to
+        ``_unmaterialized`` and expanded by the queries instead. Returns
+        False for them, True otherwise.
+        """
+        lo = to_seconds(lo)
+        hi = to_seconds(hi)
+        budget = ExpansionBudget(self.max_occurrences)
+        budget.start(documentId)
+        starts = []
+        try:
+            for occurrence_start, occurrence_end in \
+                    self._iter_occurrence_seconds(documentId, lo, hi, budget):
+                if occurrence_start < lo:
+                    continue
+                if occurrence_start >= hi:
+                    break
+                budget.spend()
+                starts.append(occurrence_start)
+        except ExpansionBudgetExceeded:
+            logger.warning(
+                '%s: document %s has more than %s occurrences to '
+                'materialize, it is expanded by the queries instead' % (
+                    self.getId(), documentId, self.max_occurrences))
+            if self._unmaterialized is None:
+                self._unmaterialized = IITreeSet()
+            self._unmaterialized.insert(documentId)
+            return False
+
+        duration = self._uid2duration[documentId]
+        if duration > self._max_duration:
+            self._max_duration = duration
+        for occurrence_start in starts:
+            self._insert_row(self._occurrence2uid, occurrence_start,
+                             documentId)
+        return True
+
+    def _dematerialize(self, documentId):
+        """Remove the stored occurrences of a document."""
+        if self._horizon is None or not self._uid2recurrence.get(documentId):
+            return
+        if (self._unmaterialized is not None and
+                documentId in self._unmaterialized):
+            # Nothing was stored.
+            self._unmaterialized.remove(documentId)
+            return
+        self._remove_occurrences(documentId, *self._horizon)
+
+    def _remove_occurrences(self, documentId, lo, hi):
+        """Remove the stored occurrences of a document within [lo, hi)."""
+        for occurrence_start, occurrence_end in self._iter_occurrence_seconds(
+                documentId, to_seconds(lo), to_seconds(hi)):
+            self._remove_row(self._occurrence2uid, occurrence_start,
+                             documentId)
+
+    def _horizon_around(self, now):
+        if now is None:
+            now = datetime.utcnow()
+        now = utc_datetime(now).replace(minute=0, second=0)
+        return (now - timedelta(days=self.materialize_before),
+                now + timedelta(days=self.materialize_after))
+
+    def enable_materialization(self, before=30, after=365, now=None):
+        """Precompute the occurrences of recurring events.
+
+        The occurrences starting from ``before`` days before ``now`` until
+        ``after`` days after it are stored in a BTree keyed on their start,
+        so queries within this horizon become a range scan instead of an
+        expansion of every recurrence. Queries outside of the horizon still
+        expand the recurrences. Call ``update_horizon()`` regularly to move
+        the horizon forward as time passes.
+        """
+        self.materialize_before = before
+        self.materialize_after = after
+        self._horizon = self._horizon_around(now)
+        self._rematerialize()
+
+    def _rematerialize(self):
+        self._occurrence2uid = LOBTree()
+        self._unmaterialized = IITreeSet()
+        self._max_duration = 0
+        lo, hi = self._horizon
+        for documentId, recurrence in self._uid2recurrence.items():
+            if recurrence is not None:
+                self._materialize(documentId, lo, hi)
+
+    def disable_materialization(self):
+        """Drop the precomputed occurrences."""
+        self._horizon = None
+        self._occurrence2uid = None
+        self._unmaterialized = None
+        self._max_duration = 0
+
+    def update_horizon(self, now=None):
+        """Move the materialization horizon forward to ``now``.
+
+        Occurrences that fell out of the horizon are dropped, and only the
+        newly covered part of the horizon is expanded.
+        """
+        if self._horizon is None:
+            return
+
+        old_lo, old_hi = self._horizon
+        lo, hi = self._horizon_around(now)
+        lo = max(lo, old_lo)
+        hi = max(hi, old_hi)
+
+        for key in list(self._occurrence2uid.keys(
+                max=to_seconds(lo), excludemax=True)):
+            del self._occurrence2uid[key]
+
+        if hi > old_hi:
+            unmaterialized = self._unmaterialized
+            for documentId, recurrence in self._uid2recurrence.items():
+                if recurrence is None or (unmaterialized is not None and
+                                          documentId in unmaterialized):
+                    continue
+                if not self._materialize(documentId, max(lo, old_hi), hi):
+                    # It's expanded by the queries now, so its occurrences
+                    # in the rest of the horizon are dropped too.
+                    self._remove_occurrences(documentId, lo, old_hi)
+
+        self._horizon = lo, hi
+
+    def _materialized(self, start, end):
+        """Find the recurring events with an occurrence within the period.
+
+        Returns None if the period isn't covered by the materialization
+        horizon, in which case the recurrences must be expanded.
+        """
+        if self._horizon is None or start is None or end is None:
+            return None
+
+        lo, hi = self._horizon
+        if start - timedelta(seconds=self._max_duration) < lo or end >= hi:
+            return None
+
+        start = to_seconds(start)
+        end = to_seconds(end)
+        # Occurrences starting after the period start all overlap it:
+        result = multiunion(self._occurrence2uid.values(
+            start, end, excludemin=True))
+        # For those starting before it we need to look at the duration:
+        for key, row in self._occurrence2uid.items(
+                start - self._max_duration, start):
+            for documentId in row:
+                if key + self._uid2duration[documentId] > start:
+                    result.insert(documentId)
+        return result
+
+    def _finalize_index(self, result, start, end, used_fields,
+                        sort_keys=None, stats=None):
+        if stats is None:
+            stats = QueryStats()
         filtered_result = IITreeSet()
-        # used_recurrence = False
+        used_recurrence = False
+        materialized = self._materialized(start, end)
+        rejected = self._rejected_by_signature(start, end)
+        regular = []
+        by_cost = ([], [], [])
 
         for documentId in result:
             recurrence = self._uid2recurrence.get(documentId)
@@ -266,44 +1031,390 @@ class EventIndex(SimpleItem):
                 filtered_result.add(documentId)
                 continue
 
-            # used_recurrence = True
-            match = False
-            # This is a possible place where optimizations can be done if
-            # necessary. For example, for periods where the start and end
-            # date is the same, we can first check if the start time and
-            # and time of the date falls inbetween the start and end times
-            # of the period, so to avoid expansion. But most likely this
-            # will have a very small impact on speed, so I skip this until
-            # it actually becomes a problem.
+            used_recurrence = True
+            stats.recurring += 1
+            if rejected is not None and documentId in rejected:
+                stats.rejected += 1
+                continue
 
-            if start is not None:
-                event_start = datetime(*self._uid2start[documentId][:6])
+            if materialized is not None and (
+                    self._unmaterialized is None or
+                    documentId not in self._unmaterialized):
+                stats.materialized += 1
+                if documentId in materialized:
+                    filtered_result.add(documentId)
+                continue
+
+            if documentId in self._uid2step:
+                regular.append(documentId)
             else:
-                event_start = None
-            if end is not None:
-                event_duration = self._uid2duration[documentId]
-                event_end = event_start + event_duration
+                by_cost[self._uid2cost.get(documentId, 0)].append(documentId)
+
+        if regular:
+            stats.regular += len(regular)
+            self._filter_regular(regular, start, end, filtered_result)
+        stats.phase('filter')
+
+        candidates = by_cost[0] + by_cost[1] + by_cost[2]
+        stats.expanded += len(candidates)
+        if (self.parallel_processes and
+                len(candidates) >= self.parallel_threshold):
+            by_cost = (self._filter_parallel(candidates, start, end,
+                                             filtered_result),)
+
+        # The cheapest recurrences are expanded first, so that they get
+        # expanded even if the budget is used up by the expensive ones.
+        budget = ExpansionBudget(self.max_occurrences, self.query_budget,
+                                 self.query_timeout)
+        if start is not None:
+            start = to_seconds(start)
+        if end is not None:
+            end = to_seconds(end)
+        for documentIds in by_cost:
+            for documentId in documentIds:
+                examined = budget.examined
+                try:
+                    budget.start(documentId)
+                    for occurrence in self._iter_occurrence_seconds(
+                            documentId, start, end, budget):
+                        # One occurrence within the period is enough.
+                        filtered_result.add(documentId)
+                        examined -= 1
+                        if sort_keys is not None and start is not None:
+                            # And it's the next occurrence, for sorting.
+                            sort_keys[documentId] = occurrence[0]
+                        break
+                except ExpansionBudgetExceeded, e:
+                    stats.over_budget += 1
+                    if self._over_budget(documentId, e):
+                        filtered_result.add(documentId)
+                stats.cost(documentId, budget.examined - examined)
+        stats.phase('expand')
+
+        if used_recurrence:
+            used_fields += (self.recurrence_attr,)
+        return filtered_result, used_fields
+
+    def _filter_regular(self, candidates, start, end, result):
+        """Add the regular recurrences matching the period to the result.
+
+        Their occurrences are computed with arithmetic instead of being
+        expanded, see ``plone.app.eventindex.vectorized``.
+        """
+        if start is not None:
+            start = to_seconds(start)
+        if end is not None:
+            end = to_seconds(end)
+        firsts = []
+        steps = []
+        lasts = []
+        durations = []
+        for documentId in candidates:
+            duration = self._uid2duration[documentId]
+            end_value = self._uid2end[documentId]
+            if end_value != OPEN_END:
+                # The end is the end of the last occurrence.
+                end_value -= duration
+            firsts.append(self._uid2start[documentId])
+            steps.append(self._uid2step[documentId])
+            lasts.append(end_value)
+            durations.append(duration)
+        result.update(overlapping(candidates, firsts, steps, lasts, durations,
+                                  start, end))
+
+    def _filter_parallel(self, candidates, start, end, result):
+        """Add the candidates matching the period to the result.
+
+        The recurrences are expanded in the process pool, see
+        ``plone.app.eventindex.parallel``. Only the recurrences stored in
+        the compact form are sent to the pool. The others, with a start in
+        a timezone that isn't a pytz one, are returned to be expanded in
+        this process.
+        """
+        if start is not None:
+            start = to_seconds(start)
+        if end is not None:
+            end = to_seconds(end)
+        events = []
+        rest = []
+        for documentId in candidates:
+            recurrence = self._uid2recurrence[documentId]
+            if isinstance(recurrence, tuple):
+                events.append((documentId, self._uid2duration[documentId],
+                               recurrence))
             else:
-                event_end = None
+                rest.append(documentId)
+        matches, over_budget = filter_parallel(
+            self.parallel_processes, self.parallel_chunk, start, end,
+            self.max_occurrences, events)
+        result.update(matches)
+        for documentId in over_budget:
+            error = ExpansionBudgetExceeded(
+                'Document %s has more than %s occurrences before the query '
+                'period' % (documentId, self.max_occurrences), documentId)
+            if self._over_budget(documentId, error):
+                result.insert(documentId)
+        return rest
+
+    def _over_budget(self, documentId, error):
+        """Handle a recurrence whose expansion went over the budget.
+
+        Returns True if the document should be treated as a match, according
+        to the ``budget_policy``. The document is counted in the statistics
+        of the index, and logged the first time.
+        """
+        if self._statistics().over_budget(documentId) == 1:
+            logger.warning('%s: %s' % (self.getId(), error))
 
-            for occurrence in recurrence._iter():
-                utc_occurrence = datetime(*occurrence.utctimetuple()[:6])
-                if event_start is not None and utc_occurrence < event_start:
-                    # XXX we should add a counter and break after 10000 occurrences.
-                    continue
-                if event_end is not None and utc_occurrence > event_end:
-                    break
+        if self.budget_policy == 'raise':
+            error.documentId = documentId
+            raise error
+        return self.budget_policy == 'match'
 
-                # The start of this occurrence starts between the start and end date of
-                # the query:
-                match = True
-                break
+    def getOverBudget(self):
+        """Get the documents whose expansion went over the budget.
 
-            if match:
-                filtered_result.add(documentId)
-            # if used_recurrence:
-            used_fields += (self.recurrence_attr,)
-        return filtered_result, used_fields
+        Returns a dictionary of documentIds and the number of times each
+        went over the budget in this process, since the statistics were
+        last reset. The documents going over it most often are shown on the
+        Statistics tab.
+        """
+        return dict(self._statistics().exceeded)
+
+    def _matches(self, documentId, start, end):
+        """Check the start and end of a single document against a period.
+
+        ``start`` and ``end`` are seconds since the epoch or None.
+        """
+        if start is not None and self._uid2end[documentId] <= start:
+            return False
+        if end is not None and self._uid2start[documentId] > end:
+            return False
+        return True
+
+    def _grid_position(self, start_value, end_value):
+        """Get the level and bucket of the grid an event is stored in.
+
+        Returns None for events that are too long for the grid, or open
+        ended, and therefore stored in the overflow set.
+        """
+        if end_value == OPEN_END:
+            return None
+        length = end_value - start_value
+        width = self.grid_base
+        for level in range(self.grid_levels):
+            if length <= width:
+                return level, start_value // width
+            width *= 2
+        return None
+
+    def _grid_insert(self, documentId, start_value, end_value):
+        position = self._grid_position(start_value, end_value)
+        if position is None:
+            self._grid_overflow.insert(documentId)
+            return
+
+        level, bucket = position
+        buckets = self._grid.get(level)
+        if buckets is None:
+            buckets = IOBTree()
+            self._grid[level] = buckets
+        self._insert_row(buckets, bucket, documentId)
+
+    def _grid_remove(self, documentId):
+        if self._grid is None or documentId not in self._uid2start:
+            return
+
+        position = self._grid_position(self._uid2start[documentId],
+                                       self._uid2end[documentId])
+        if position is None:
+            if documentId in self._grid_overflow:
+                self._grid_overflow.remove(documentId)
+            return
+
+        level, bucket = position
+        buckets = self._grid.get(level)
+        if buckets is not None:
+            self._remove_row(buckets, bucket, documentId)
+
+    def build_grid(self):
+        """Build the interval grid for an index created before it existed.
+
+        Until this has been done the index uses the range scans of the
+        _start2uid and _end2uid trees to answer queries.
+        """
+        self._grid = IOBTree()
+        self._grid_overflow = self._row_type()
+        for documentId, start_value in self._uid2start.items():
+            self._grid_insert(documentId, start_value,
+                              self._uid2end[documentId])
+
+    def _grid_scan(self, start, end):
+        """Find the events overlapping a period in the interval grid.
+
+        ``start`` and ``end`` are seconds since the epoch or None, but not
+        both.
+
+        Every event is stored in the bucket containing its start, on the
+        lowest level whose buckets are at least as wide as the event. On
+        each level, an overlapping event must start at most one bucket
+        width before the period start. The events of the buckets strictly
+        inside the period all overlap it, so only the few buckets at the
+        edges of the period, and the overflow set of events too long for
+        the grid, need to be checked event by event.
+
+        Returns the keys of the buckets to visit, for estimating the cost,
+        and a function computing the result.
+        """
+        ranges = []
+        width = self.grid_base
+        for level in range(self.grid_levels):
+            buckets = self._grid.get(level)
+            if buckets is not None:
+                lo = hi = sure_lo = sure_hi = None
+                if start is not None:
+                    lo = start // width - 1
+                    sure_lo = start // width + 1
+                if end is not None:
+                    hi = end // width
+                    sure_hi = (end + 1) // width - 1
+                ranges.append((buckets, lo, hi, sure_lo, sure_hi))
+            width *= 2
+
+        def scan():
+            sure = []
+            edges = []
+            for buckets, lo, hi, sure_lo, sure_hi in ranges:
+                if sure_lo is None or sure_hi is None or sure_lo <= sure_hi:
+                    sure.extend(buckets.values(sure_lo, sure_hi))
+                    if sure_lo is not None:
+                        edges.extend(buckets.values(lo, sure_lo - 1))
+                    if sure_hi is not None:
+                        edges.extend(buckets.values(sure_hi + 1, hi))
+                else:
+                    edges.extend(buckets.values(lo, hi))
+            edges.append(self._grid_overflow)
+
+            result = multiunion(sure)
+            for row in edges:
+                for documentId in row:
+                    if self._matches(documentId, start, end):
+                        result.insert(documentId)
+            return result
+
+        keys = [buckets.keys(lo, hi) for buckets, lo, hi, sl, sh in ranges]
+        keys.append(self._grid_overflow)
+        return chain(*keys), scan
+
+    def _search(self, start, end, resultset=None, stats=None):
+        """Find the documents whose start and end span the period.
+
+        ``start`` and ``end`` are naive UTC datetimes or None. Returns the
+        set of candidate documentIds, of which the recurring events still
+        need to be checked by expanding their recurrence, and the names of
+        the fields used. If ``resultset`` is given, the candidates are
+        restricted to it.
+
+        The candidates come from the interval grid or, for indexes without
+        a grid, from intersecting the events ending after the start with
+        the events starting before the end. The smallest of these sets and
+        the resultset is materialized first, and the other constraints are
+        then either intersected with it or, if their range scan would be
+        much larger, checked document by document.
+
+        The sizes of the range scans are counted in ``stats``, a
+        ``QueryStats``, if given.
+
+        Raises UpgradeRequired if the index needs to be upgraded.
+        """
+        self._check_version()
+
+        if stats is None:
+            stats = QueryStats()
+        used_fields = ()
+
+        if not self._length():  # No events at all
+            stats.exit = 'empty'
+            return IITreeSet(), used_fields
+
+        if start is not None:
+            used_fields += (self.start_attr,)
+            start = to_seconds(start)
+        if end is not None:
+            used_fields += (self.end_attr,)
+            end = to_seconds(end)
+
+        if start is None and end is None:
+            # No period at all, so we must return *all* uids.
+            result = self._all_documents()
+            if resultset is not None:
+                result = intersection(result, resultset)
+            stats.exit = 'unbounded'
+            stats.candidates = len(result)
+            return result, used_fields
+
+        scans = []
+        if self._grid is not None:
+            scans.append(('grid',) + self._grid_scan(start, end))
+        else:
+            if start is not None:
+                def scan_end():
+                    # We don't want the events who end before the start. In
+                    # other words we want to find those evens whose end >
+                    # the start query, including the open ended events.
+                    return multiunion(
+                        self._end2uid.values(start, excludemin=True))
+
+                # Events that end on exactly the same time as the search
+                # period start should not be included:
+                scans.append(('end', self._end2uid.keys(start, excludemin=True),
+                              scan_end))
+
+            if end is not None:
+                def scan_start():
+                    # We also do not want the events whose start come after
+                    # the end query. In other words, we find all events
+                    # where start <= end.
+                    return multiunion(self._start2uid.values(max=end))
+
+                scans.append(('start', self._start2uid.keys(max=end),
+                              scan_start))
+
+        limit = None
+        if resultset is not None:
+            limit = len(resultset) * self.verify_factor
+        counts, smallest = count_keys([keys for name, keys, scan in scans],
+                                      limit)
+        for (name, keys, scan), count in zip(scans, counts):
+            stats.scans[name] = count
+        if smallest is None:
+            # All range scans are larger than the resultset, so we check the
+            # documents of the resultset one by one instead.
+            result = IITreeSet([documentId for documentId in resultset
+                                if self._matches(documentId, start, end)])
+            stats.exit = 'verified'
+            stats.candidates = len(result)
+            return result, used_fields
+
+        name, keys, scan = scans.pop(smallest)
+        result = scan()
+        if resultset is not None:
+            # Intersect with the resultset before the recurrences are
+            # expanded, so no rules are expanded for irrelevant events.
+            result = intersection(result, resultset)
+
+        for name, keys, scan in scans:
+            counts, smallest = count_keys(
+                [keys], len(result) * self.verify_factor)
+            stats.scans[name] = max(stats.scans[name], counts[0])
+            if smallest is None:
+                result = IITreeSet([documentId for documentId in result
+                                    if self._matches(documentId, start, end)])
+            else:
+                result = intersection(result, scan())
+
+        stats.candidates = len(result)
+        return result, used_fields
 
     def _apply_index(self, request, resultset=None):
         """Apply the index to query parameters given in 'request'.
@@ -325,80 +1436,576 @@ class EventIndex(SimpleItem):
         all data fields used.
 
         The resultset argument contains the resultset, as already calculated by
-        ZCatalog's search method.
+        ZCatalog's search method. The catalog passes it because the index
+        provides ILimitedResultIndex, and applies the index after the
+        others. Cached results are for the whole index, and intersected
+        with the resultset.
         """
         if not request.has_key(self._id):  # 'in' doesn't work with this object
-            return IITreeSet(self._uid2end.keys()), ()
+            self._v_sort_query = None
+            return None
+
+        start = self._quantize(utc_datetime(
+            self._get_position(request, 'start')))
+        end = self._quantize(utc_datetime(self._get_position(request, 'end')),
+                             up=True)
+
+        # Remember the start of the query for sorting its results on the
+        # next occurrence, see documentToKeyMap().
+        sort_keys = {}
+        sort_start = None
+        if start is not None:
+            sort_start = to_seconds(start)
+        self._v_sort_query = None
+        if self._sorts_on(request):
+            self._v_sort_query = (transaction.get(), sort_start, sort_keys)
+
+        limit = None
+        if start is not None:
+            limit = self._get_position(request, 'limit')
+
+        stats = QueryStats(start, end, limit)
+        key = None
+        if resultset is None or limit is None:
+            # The next occurrences within a resultset aren't those of the
+            # whole index within the resultset.
+            key = self._cache_key(start, end, limit)
+        if key is not None:
+            cached = result_cache.get(key)
+            if cached is not None:
+                result, used_fields = cached
+                if resultset is None:
+                    result = IITreeSet(result)
+                else:
+                    result = intersection(result, resultset)
+                stats.exit = 'cached'
+                self._report(stats, len(result))
+                return result, used_fields
+
+        if limit is not None:
+            # Only the events of the next limit occurrences:
+            result = IITreeSet()
+            for documentId, occurrence_start, occurrence_end in self.upcoming(
+                    start, limit, end, resultset):
+                result.insert(documentId)
+                sort_keys.setdefault(documentId, to_seconds(occurrence_start))
+            stats.phase('upcoming')
+            used_fields = (self.start_attr, self.recurrence_attr)
+            if end is not None:
+                used_fields += (self.end_attr,)
+        else:
+            result, used_fields = self._search(start, end, resultset, stats)
+            stats.phase('search')
+            result, used_fields = self._finalize_index(
+                result, start, end, used_fields, sort_keys, stats)
+        if key is not None and resultset is None:
+            # Results restricted to a resultset aren't cached.
+            result_cache.set(key, (IITreeSet(result), used_fields))
+        self._report(stats, len(result))
+        return result, used_fields
+
+    def _all_documents(self):
+        """Get the set of all indexed documentIds.
+
+        The set is kept in a volatile attribute and shared by the queries
+        until the index changes, so it must not be modified. It isn't kept
+        while the index has changes which aren't committed.
+        """
+        counter = self.getCounter()
+        cached = getattr(self, '_v_all_documents', None)
+        if cached is not None and cached[0] == counter:
+            return cached[1]
+        documents = IITreeSet(self._uid2end.keys())
+        if self._counter is not None and not self._counter._p_changed:
+            self._v_all_documents = (counter, documents)
+        return documents
+
+    def _report(self, stats, results):
+        stats.finish(results)
+        report(self, self._statistics(), stats, self.slow_query_threshold)
+
+    def _statistics(self):
+        if self._p_oid is None:
+            # Not stored in a database, so the index keeps them itself.
+            statistics = getattr(self, '_v_statistics', None)
+            if statistics is None:
+                statistics = self._v_statistics = Statistics()
+            return statistics
+        return get_statistics((self._p_jar.db().database_name, self._p_oid))
+
+    def getUnchanged(self):
+        """Get the number of reindexes skipped because nothing changed.
+
+        This counts the objects that were indexed with the values they were
+        indexed with already, since the index was loaded in this process.
+        """
+        return self._statistics().summary()['unchanged']
 
-        start = self._get_position(request, 'start')
-        end = self._get_position(request, 'end')
+    def getStatistics(self):
+        """Get the statistics of the queries of the index in this process.
 
-        used_fields = ()
+        See ``plone.app.eventindex.stats.Statistics.summary``.
+        """
+        return self._statistics().summary()
 
-        # We don't want the events who end before the start. In other
-        # words we want to find those evens whose end >= the start query,
-        # or None as None means they have infinite recurrence.
-        try:
-            maxkey = self._end2uid.maxKey()
-        except ValueError:  # No events at all
-            return IITreeSet(), used_fields
+    def manage_resetStatistics(self, REQUEST=None):
+        """Reset the statistics of the queries of the index."""
+        self._statistics().reset()
+        if REQUEST is not None:
+            REQUEST.RESPONSE.redirect(self.absolute_url() +
+                                      '/manage_statistics')
 
-        if start is None or maxkey is None:
-            # start is None, so we need to search right from the start; or
-            # (amazingly) all events have infinite recurrence.
-            # This means we must return *all* uids.
-            start_uids = IITreeSet(self._uid2end.keys())
-        else:
-            used_fields += (self.start_attr,)
-            #start_uids = IITreeSet()
-            start = start.utctimetuple()
-            try:
-                minkey = self._end2uid.minKey(start)
-                # Events that end on exactly the same same time as the
-                # search period start should not be included:
-                if minkey == start:
-                    excludemin = True
-                else:
-                    excludemin = False
+    def _quantize(self, dt, up=False):
+        """Round a query time to a multiple of the cache_quantum.
 
-                start_uids = multiunion(self._end2uid.values(minkey, maxkey, excludemin=excludemin))
+        Starts are rounded down and ends, with ``up``, up, so the period
+        queried is only ever widened.
+        """
+        if dt is None or not self.cache_quantum:
+            return dt
+        seconds = to_seconds(dt)
+        if up:
+            return from_seconds(seconds + -seconds % self.cache_quantum)
+        return from_seconds(seconds - seconds % self.cache_quantum)
+
+    def _cache_key(self, start, end, limit=None):
+        """Get the key of a query period in the result cache.
+
+        Returns None if the results can't be cached, because the index
+        isn't stored in a database, or has changes which aren't committed
+        and therefore aren't reflected by the counter. The settings that
+        change the results are part of the key, as changing them doesn't
+        change the counter.
+        """
+        if self._p_oid is None or self._counter is None:
+            return None
+        counter = self.getCounter()
+        if self._counter._p_changed:
+            return None
+        settings = (self.max_occurrences, self.query_budget,
+                    self.query_timeout, self.budget_policy, self._horizon)
+        return (self._p_jar.db().database_name, self._p_oid, counter,
+                settings, start, end, limit)
+
+    def occurrences(self, start, end, resultset=None):
+        """Iterate over the occurrences of events within a period.
+
+        ``start`` and ``end`` are datetimes or DateTimes, ``start`` may be
+        None to search from the beginning of time. ``end`` is required, as
+        open ended recurrences would otherwise never stop.
+
+        Yields ``(documentId, occurrence_start, occurrence_end)`` tuples,
+        with the occurrence times as naive UTC datetimes. The occurrences
+        are generated lazily, document by document, and each recurrence is
+        expanded only once. If ``resultset`` is given, only the documents
+        in it are considered. Recurrences skipping more than
+        ``max_occurrences`` occurrences to get to the period are cut short,
+        unless the ``budget_policy`` is 'raise'.
+        """
+        if end is None:
+            raise ValueError("occurrences() requires an end of the period")
+        if isinstance(start, DateTime):
+            start = start.utcdatetime()
+        if isinstance(end, DateTime):
+            end = end.utcdatetime()
+        start = utc_datetime(start)
+        end = utc_datetime(end)
 
-            except ValueError:
-                # No ending events
-                start_uids = IITreeSet()
+        result, used_fields = self._search(start, end, resultset)
 
-            # Include open ended events, if any
-            if self._end2uid.has_key(None):
-                start_uids = union(start_uids, self._end2uid[None])
+        budget = ExpansionBudget(self.max_occurrences)
+        for documentId in result:
+            budget.start(documentId)
+            try:
+                for occurrence_start, occurrence_end in self._iter_occurrences(
+                        documentId, start, end, budget):
+                    yield documentId, occurrence_start, occurrence_end
+            except ExpansionBudgetExceeded, e:
+                self._over_budget(documentId, e)
+
+    def upcoming(self, start, limit, end=None, resultset=None):
+        """Get the next occurrences of the events from a moment on.
+
+        ``start`` and ``end`` are datetimes or DateTimes, and ``end`` may be
+        None. Returns a list of at most ``limit`` ``(documentId,
+        occurrence_start, occurrence_end)`` tuples, of the occurrences that
+        end after ``start`` and start before or at ``end``, in the order of
+        their start. The occurrence times are naive UTC datetimes.
+
+        The occurrences of the events are merged lazily, through a heap
+        keyed on the next occurrence of each event. Events starting after
+        ``start`` are taken from the start ordered _start2uid tree, and only
+        expanded once they start before the next occurrence found so far,
+        so events that can't be among the first ``limit`` occurrences are
+        never looked at. If ``resultset`` is given, only the documents in it
+        are considered.
+
+        The occurrences skipped before ``start`` count against the budget
+        of the query, see ``max_occurrences``, ``query_budget`` and
+        ``query_timeout``. Recurrences over the budget are left out, unless
+        ``budget_policy`` is 'raise', which raises ExpansionBudgetExceeded.
+        """
+        if isinstance(start, DateTime):
+            start = start.utcdatetime()
+        if isinstance(end, DateTime):
+            end = end.utcdatetime()
+        start = utc_datetime(start)
+        end = utc_datetime(end)
+        start_value = to_seconds(start)
+        end_value = None
+        if end is not None:
+            end_value = to_seconds(end)
 
-        # XXX At this point an intersection with the resultset might be
-        # beneficial. It would stop us from calculating the recurrence
-        # of ids that won't be returned. It could be done after the
-        # intersection with end_uids below as well, performance tests will tell.
+        heap = []
+        query_budget = ExpansionBudget(self.max_occurrences, self.query_budget,
+                                       self.query_timeout)
 
-        # We also do not want the events whose start come after the end query.
-        # In other words, we find all events where start <= end.
-        if end is not None:
-            end = end.utctimetuple()
+        def advance(documentId, occurrences):
             try:
-                minkey = self._start2uid.minKey()
-                end_uids = multiunion(self._start2uid.values(minkey, end))
-                used_fields += (self.end_attr,)
-
-            except ValueError:
-                # No events
-                return IITreeSet(), used_fields
+                for occurrence_start, occurrence_end in occurrences:
+                    heappush(heap, (occurrence_start, documentId,
+                                    occurrence_end, occurrences))
+                    return
+            except ExpansionBudgetExceeded, e:
+                self._over_budget(documentId, e)
+
+        def open_event(documentId):
+            if resultset is not None and documentId not in resultset:
+                return
+            budget = None
+            if self._uid2recurrence.get(documentId) is not None:
+                try:
+                    budget = query_budget.event(documentId)
+                except ExpansionBudgetExceeded, e:
+                    self._over_budget(documentId, e)
+                    return
+            advance(documentId, self._iter_occurrences(documentId, start, end,
+                                                       budget))
+
+        # The events that started before the moment and are still going on,
+        # or have occurrences left:
+        current = self._search(start, start, resultset)[0]
+        for documentId in current:
+            open_event(documentId)
+
+        later = iter(self._start2uid.items(start_value, end_value,
+                                           excludemin=True))
+        pending = next(later, None)
+        result = []
+        while len(result) < limit:
+            # Events starting before the earliest occurrence found so far may
+            # have an even earlier occurrence.
+            while pending is not None and (
+                    not heap or pending[0] <= to_seconds(heap[0][0])):
+                for documentId in pending[1]:
+                    open_event(documentId)
+                pending = next(later, None)
+            if not heap:
+                break
+            occurrence_start, documentId, occurrence_end, occurrences = \
+                heappop(heap)
+            result.append((documentId, occurrence_start, occurrence_end))
+            advance(documentId, occurrences)
+        return result
+
+    def calendar(self, start, end, size='day', resultset=None, tzinfo=None):
+        """Get the events of a period in buckets, like the days of a month.
+
+        ``start`` and ``end`` are datetimes or DateTimes, and ``size`` is
+        the size of the buckets: 'hour', 'day', 'week' or a timedelta. The
+        buckets follow each other from ``start`` on, and the last one is
+        cut short at ``end``. Days and weeks are 24 hours and 7 days of UTC,
+        unless ``tzinfo`` is given, then they start at the same wall time
+        in that timezone, so they stay aligned with the local days when the
+        offset changes for daylight saving time.
+
+        Returns a list of ``(bucket_start, documentIds, count)`` tuples, one
+        for every bucket, with the start of the bucket as a naive UTC
+        datetime, an IITreeSet of the documents with occurrences in the
+        bucket and the number of these occurrences. Occurrences are in
+        every bucket they overlap, occurrences without a duration in the
+        bucket they start in. The range trees are searched once for the
+        whole period, and each recurrence expanded once. If ``resultset``
+        is given, only the documents in it are considered.
+
+        The occurrences within the period count against the budget of the
+        query, like those before it, see ``max_occurrences``,
+        ``query_budget`` and ``query_timeout``. Recurrences going over the
+        budget are cut short, with the occurrences found until then in the
+        buckets, unless the ``budget_policy`` is 'raise'.
+        """
+        if start is None or end is None:
+            raise ValueError("calendar() requires a start and an end")
+        wall_time = tzinfo is not None and size in ('day', 'week')
+        if isinstance(size, timedelta):
+            size = size.days * 86400 + size.seconds
+        elif size in BUCKET_SIZES:
+            size = BUCKET_SIZES[size]
+        else:
+            raise ValueError("Unknown bucket size %r" % (size,))
+        if size <= 0:
+            raise ValueError("The bucket size must be positive")
+        if isinstance(start, DateTime):
+            start = start.utcdatetime()
+        if isinstance(end, DateTime):
+            end = end.utcdatetime()
+        start = utc_datetime(start)
+        end = utc_datetime(end)
+        start_value = to_seconds(start)
+        end_value = to_seconds(end)
+        edges = self._bucket_edges(start_value, end_value, size,
+                                   wall_time and tzinfo or None)
+        count = len(edges) - 1
+
+        documentIds = [[] for bucket in range(count)]
+        counts = [0] * count
+        if count:
+            # The searched period starts a second early, to include the
+            # occurrences without a duration at the start.
+            result = self._search(start - timedelta(seconds=1), end,
+                                  resultset)[0]
+            budget = ExpansionBudget(self.max_occurrences, self.query_budget,
+                                     self.query_timeout)
+            for documentId in result:
+                recurring = self._uid2recurrence.get(documentId) is not None
+                try:
+                    if recurring:
+                        budget.start(documentId)
+                    for occurrence_start, occurrence_end in \
+                            self._iter_occurrence_seconds(
+                                documentId, start_value - 1, end_value,
+                                budget):
+                        if occurrence_start >= end_value:
+                            break
+                        if recurring:
+                            budget.spend()
+                        first = bisect_right(edges, occurrence_start) - 1
+                        last = bisect_right(edges, max(
+                            occurrence_end, occurrence_start + 1) - 1) - 1
+                        for bucket in range(max(first, 0),
+                                            min(last + 1, count)):
+                            if documentIds[bucket][-1:] != [documentId]:
+                                documentIds[bucket].append(documentId)
+                            counts[bucket] += 1
+                except ExpansionBudgetExceeded, e:
+                    self._over_budget(documentId, e)
+
+        return [(from_seconds(edges[bucket]),
+                 IITreeSet(documentIds[bucket]), counts[bucket])
+                for bucket in range(count)]
+
+    def _bucket_edges(self, start_value, end_value, size, tzinfo=None):
+        """Get the starts of the buckets of calendar(), and the end.
+
+        The buckets are ``size`` seconds apart, or, if ``tzinfo`` is given,
+        ``size`` seconds apart in the wall time of that timezone.
+        """
+        if end_value <= start_value:
+            return [start_value]
+        if tzinfo is None:
+            return range(start_value, end_value, size) + [end_value]
+        edges = [start_value]
+        wall = pytz.utc.localize(from_seconds(start_value)).astimezone(
+            tzinfo).replace(tzinfo=None)
+        step = timedelta(seconds=size)
+        while True:
+            wall += step
+            if hasattr(tzinfo, 'localize'):  # pytz
+                edge = to_seconds(tzinfo.localize(wall))
+            else:
+                edge = to_seconds(wall.replace(tzinfo=tzinfo))
+            if edge >= end_value:
+                break
+            edges.append(edge)
+        edges.append(end_value)
+        return edges
+
+    def freebusy(self, start, end, resultset=None):
+        """Get the busy periods of the events within a period.
+
+        ``start`` and ``end`` are datetimes or DateTimes. Returns a list of
+        ``(busy_start, busy_end)`` tuples of naive UTC datetimes, in order,
+        of the times within the period covered by at least one occurrence.
+        Overlapping and adjoining occurrences are merged into one busy
+        period. If ``resultset`` is given, like the events of a room, only
+        the documents in it are considered.
+
+        The occurrences of the documents, with their stored durations, are
+        merged lazily in the order of their start, through a heap holding
+        the next occurrence of each document, and swept into busy periods.
+        Only the busy periods are kept, not the occurrences.
+
+        The occurrences of recurrences count against the budget of the
+        query, see ``max_occurrences``, ``query_budget`` and
+        ``query_timeout``, also those within the period. Recurrences going
+        over the budget are cut short: the busy periods only include their
+        occurrences until then, which may leave busy times out, unless the
+        ``budget_policy`` is 'raise', which raises ExpansionBudgetExceeded.
+        """
+        if start is None or end is None:
+            raise ValueError("freebusy() requires a start and an end")
+        if isinstance(start, DateTime):
+            start = start.utcdatetime()
+        if isinstance(end, DateTime):
+            end = end.utcdatetime()
+        start = utc_datetime(start)
+        end = utc_datetime(end)
+        start_value = to_seconds(start)
+        end_value = to_seconds(end)
+
+        def advance(documentId, occurrences, budget):
+            # Get the next occurrence of a document, or None.
+            try:
+                occurrence = next(occurrences, None)
+                if occurrence is None or occurrence[0] >= end_value:
+                    return None
+                if budget is not None:
+                    budget.spend()
+            except ExpansionBudgetExceeded, e:
+                self._over_budget(documentId, e)
+                return None
+            return occurrence + (documentId, occurrences, budget)
+
+        # The documents are expanded at the same time, each with a budget
+        # of its own within the budget of the query.
+        query_budget = ExpansionBudget(self.max_occurrences, self.query_budget,
+                                       self.query_timeout)
+        heap = []
+        for documentId in self._search(start, end, resultset)[0]:
+            budget = None
+            if self._uid2recurrence.get(documentId) is not None:
+                try:
+                    budget = query_budget.event(documentId)
+                except ExpansionBudgetExceeded, e:
+                    self._over_budget(documentId, e)
+                    continue
+            entry = advance(documentId, self._iter_occurrence_seconds(
+                documentId, start_value, end_value, budget), budget)
+            if entry is not None:
+                heappush(heap, entry)
+
+        # Sweep over the occurrences in the order of their start, extending
+        # the current busy period while they overlap it.
+        busy = []
+        busy_start = busy_end = None
+        while heap:
+            (occurrence_start, occurrence_end, documentId, occurrences,
+             budget) = heap[0]
+            entry = advance(documentId, occurrences, budget)
+            if entry is None:
+                heappop(heap)
+            else:
+                heapreplace(heap, entry)
+            if occurrence_end <= occurrence_start:
+                continue
+            if busy_end is not None and occurrence_start <= busy_end:
+                if occurrence_end > busy_end:
+                    busy_end = occurrence_end
+                continue
+            if busy_end is not None:
+                busy.append((busy_start, busy_end))
+            busy_start, busy_end = occurrence_start, occurrence_end
+        if busy_end is not None:
+            busy.append((busy_start, busy_end))
+
+        return [(from_seconds(max(busy_start, start_value)),
+                 from_seconds(min(busy_end, end_value)))
+                for busy_start, busy_end in busy]
+
+    def _sort_key(self, documentId, start):
+        """Get the start of the next occurrence of a document.
+
+        The next occurrence is the first one ending after ``start``, in
+        seconds since the epoch. For events without any occurrences after
+        ``start``, the start of their last occurrence is used.
+        """
+        event_start = self._uid2start[documentId]
+        if start is None or self._uid2recurrence.get(documentId) is None:
+            return event_start
+
+        duration = self._uid2duration[documentId]
+        last = self._uid2end[documentId]
+        if last != OPEN_END:
+            last -= duration
+        step = self._uid2step.get(documentId)
+        if step is not None:
+            if event_start + duration > start:
+                return event_start
+            return min(last, event_start +
+                       ((start - duration - event_start) // step + 1) * step)
 
-            result = intersection(start_uids, end_uids)
+        try:
+            for occurrence_start, occurrence_end in \
+                    self._iter_occurrence_seconds(
+                        documentId, start, None,
+                        ExpansionBudget(self.max_occurrences)):
+                return occurrence_start
+        except ExpansionBudgetExceeded:
+            # Sort it as if it occurs at the start.
+            return start
+        if last == OPEN_END:
+            return event_start
+        return last
+
+    def _sorts_on(self, request):
+        """Check if a catalog query sorts its results on this index."""
+        for name in ('sort_on', 'sort-on'):
+            sort_on = request.get(name)
+            if isinstance(sort_on, basestring):
+                sort_on = [sort_on]
+            if sort_on and self._id in sort_on:
+                return True
+        return False
+
+    def documentToKeyMap(self):
+        """Map the documents to their next occurrences, for sorting.
+
+        This makes the index usable as the ``sort_on`` index of a catalog
+        query. The key of a document is the start of its first occurrence
+        ending after the start of the period queried for, in seconds since
+        the epoch, or just the start of the event if the index wasn't
+        queried. The keys of the recurrences expanded by the query are
+        reused.
+
+        The period is the one of the last query of the index sorting on it,
+        and only applies to the first sort after that query, which is the
+        sort of the results of that query. Later catalog searches sorting
+        on the index without querying it sort on the start of the events.
+        """
+        query = getattr(self, '_v_sort_query', None)
+        self._v_sort_query = None
+        if query is None or query[0] is not transaction.get():
+            keys = SortKeys(self, None, {})
+        else:
+            keys = SortKeys(self, query[1], query[2])
+        # For items(), which the catalog may use for the same sort.
+        self._v_sort_keys = (transaction.get(), keys)
+        return keys
+
+    def items(self):
+        """Get the documentIds by their sort keys, in sorted order."""
+        last = getattr(self, '_v_sort_keys', None)
+        if last is not None and last[0] is transaction.get():
+            keys = last[1]
         else:
-            # No end specified, take all:
-            result = start_uids
+            keys = self.documentToKeyMap()
+        rows = {}
+        for documentId in self._uid2start.keys():
+            rows.setdefault(keys[documentId], []).append(documentId)
+        return [(key, IITreeSet(rows[key])) for key in sorted(rows)]
 
-        return self._finalize_index(result, start, end, used_fields)
+    def __len__(self):
+        return self.numObjects()
 
     def numObjects(self):
         """Return the number of indexed objects."""
-        return len(self._uid2start.keys())
+        if self._version < 6:
+            # The length isn't maintained yet.
+            return len(self._uid2start)
+        return self._length()
+
+
+InitializeClass(EventIndex)
 
 
 manage_addEventIndexForm = DTMLFile('www/addEventIndex', globals())
@@ -419,3 +2026,6 @@ def initialize(context):
                           icon='www/index.gif',
                           visibility=None,
                          )
+    # Fork the process pool before any requests are served in threads.
+    product_config = getattr(getConfiguration(), 'product_config', None)
+    start_pool((product_config or {}).get('plone.app.eventindex'))
@@ -0,0 +1 @@
+# Benchmarks of the event index, see runner.py.
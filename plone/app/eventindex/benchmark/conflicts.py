@@ -0,0 +1,134 @@
+"""Measure the write conflicts of concurrent indexing.
+
+Several threads, each with its own ZODB connection, move events of their
+own between the same few popular times, like editors moving events to
+midnight, and count the ConflictErrors of their commits. The database is a
+FileStorage, which resolves the conflicts it can.
+
+The run is done with the conflict resolving rows of the index, which are
+kept when they become empty, and with the plain IITreeSet rows removed
+when empty that the index used before, to compare the conflict rates.
+"""
+from BTrees.IIBTree import IITreeSet
+from ZODB.DB import DB
+from ZODB.FileStorage import FileStorage
+from ZODB.POSException import ConflictError
+from datetime import timedelta
+from optparse import OptionParser
+from plone.app.eventindex import EventIndex
+from plone.app.eventindex.benchmark.generate import Event
+from plone.app.eventindex.benchmark.generate import NOW
+from random import Random
+
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import transaction
+
+
+# The popular times the events are moved between.
+HOT_TIMES = tuple(NOW.replace(hour=0, minute=0) + timedelta(days=days)
+                  for days in range(3))
+
+
+def _event(random):
+    start = random.choice(HOT_TIMES)
+    recurrence = None
+    if random.random() < 0.2:
+        # Open ended events share the row of the open end.
+        recurrence = 'RRULE:FREQ=WEEKLY'
+    return Event('single', start, start + timedelta(hours=1), recurrence)
+
+
+def run(threads=4, transactions=100, events=10, legacy=False, seed=0):
+    """Run the threads, each committing ``transactions`` transactions.
+
+    Every thread has ``events`` events of its own, and moves one of them in
+    every transaction. Transactions failing with a ConflictError are
+    aborted and retried. If ``legacy`` is set, the index has plain rows
+    which are removed when they become empty. Returns a dictionary with the
+    number of ``commits``, the number of ``conflicts`` and the conflict
+    ``rate``, the fraction of the attempted commits that conflicted.
+    """
+    directory = tempfile.mkdtemp()
+    try:
+        db = DB(FileStorage(os.path.join(directory, 'Data.fs')))
+        connection = db.open()
+        index = connection.root()['index'] = EventIndex('index')
+        if legacy:
+            index.keep_empty_rows = False
+            index._row_type = IITreeSet
+            index._grid_overflow = IITreeSet()
+        random = Random(seed)
+        for documentId in range(1, threads * events + 1):
+            index.index_object(documentId, _event(random))
+        transaction.commit()
+        connection.close()
+
+        counts = {'commits': 0, 'conflicts': 0}
+        lock = threading.Lock()
+
+        def work(number):
+            random = Random('%s-%s' % (seed, number))
+            documentIds = range(number * events + 1, (number + 1) * events + 1)
+            connection = db.open()
+            index = connection.root()['index']
+            commits = conflicts = 0
+            while commits < transactions:
+                try:
+                    index.index_object(random.choice(documentIds),
+                                       _event(random))
+                    transaction.commit()
+                    commits += 1
+                except ConflictError:
+                    transaction.abort()
+                    conflicts += 1
+            connection.close()
+            lock.acquire()
+            counts['commits'] += commits
+            counts['conflicts'] += conflicts
+            lock.release()
+
+        workers = [threading.Thread(target=work, args=(number,))
+                   for number in range(threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        db.close()
+    finally:
+        shutil.rmtree(directory)
+
+    attempts = counts['commits'] + counts['conflicts']
+    counts['rate'] = attempts and float(counts['conflicts']) / attempts
+    return counts
+
+
+def main(argv=None):
+    parser = OptionParser(
+        usage='%prog [options]',
+        description='Measure the conflict rate of concurrent indexing, '
+        'with the plain rows of old indexes and the conflict resolving '
+        'rows.')
+    parser.add_option('-t', '--threads', type='int', default=4,
+                      help='The number of threads [default: %default]')
+    parser.add_option('-n', '--transactions', type='int', default=200,
+                      help='The number of transactions per thread '
+                      '[default: %default]')
+    parser.add_option('-e', '--events', type='int', default=10,
+                      help='The number of events per thread '
+                      '[default: %default]')
+    parser.add_option('-s', '--seed', type='int', default=0,
+                      help='The random seed [default: %default]')
+    options, args = parser.parse_args(argv)
+
+    sys.stdout.write('%-16s %10s %10s %8s\n' % (
+        'rows', 'commits', 'conflicts', 'rate'))
+    for name, legacy in (('plain', True), ('resolving', False)):
+        result = run(options.threads, options.transactions, options.events,
+                     legacy, options.seed)
+        sys.stdout.write('%-16s %10d %10d %7.1f%%\n' % (
+            name, result['commits'], result['conflicts'],
+            result['rate'] * 100))
@@ -0,0 +1,92 @@
+from datetime import datetime
+from datetime import timedelta
+from pytz import timezone
+from random import Random
+
+
+# The benchmarks are run as if it was this moment, so they are reproducible.
+NOW = datetime(2012, 6, 1, 12, 0)
+
+# The default mix of kinds of events.
+MIX = (
+    ('single', 0.6),
+    ('bounded', 0.25),
+    ('open', 0.1),
+    ('exdates', 0.05),
+)
+
+_WEEKDAYS = ('MO', 'TU', 'WE', 'TH', 'FR', 'SA', 'SU')
+
+
+class Event(object):
+    """A synthetic event, with the attributes the index expects."""
+
+    def __init__(self, kind, start, end, recurrence=None):
+        self.kind = kind
+        self.start = start
+        self.end = end
+        self.recurrence = recurrence
+
+    def shifted(self, delta):
+        """Get a copy of the event moved by a timedelta."""
+        return Event(self.kind, self.start + delta, self.end + delta,
+                     self.recurrence)
+
+
+def _recurrence(random, kind, start):
+    weekday = _WEEKDAYS[start.weekday()]
+    if kind == 'bounded':
+        return random.choice([
+            'RRULE:FREQ=DAILY;COUNT=%s' % random.randint(2, 30),
+            'RRULE:FREQ=WEEKLY;BYDAY=%s;COUNT=%s' % (weekday,
+                                                    random.randint(2, 52)),
+            'RRULE:FREQ=MONTHLY;UNTIL=%s' % (
+                start + timedelta(days=random.randint(60, 1000))
+            ).strftime('%Y%m%dT%H%M%S'),
+        ])
+    elif kind == 'open':
+        return random.choice([
+            'RRULE:FREQ=WEEKLY;BYDAY=%s' % weekday,
+            'RRULE:FREQ=DAILY;INTERVAL=%s' % random.randint(1, 14),
+            'RRULE:FREQ=MONTHLY;BYDAY=+1%s' % weekday,
+            'RRULE:FREQ=YEARLY',
+        ])
+    elif kind == 'exdates':
+        exdates = [start + timedelta(weeks=random.randint(1, 500))
+                   for i in range(random.randint(10, 100))]
+        return 'RRULE:FREQ=WEEKLY\nEXDATE:%s' % ','.join(
+            sorted(set(x.strftime('%Y%m%dT%H%M%S') for x in exdates)))
+    return None
+
+
+def generate(size, mix=MIX, seed=0, zone='Europe/Helsinki'):
+    """Generate a synthetic calendar.
+
+    Yields ``size`` (documentId, event) pairs of the kinds in ``mix``, a
+    sequence of (kind, weight) pairs. The kinds are 'single' events,
+    'bounded' recurrences, 'open' ended recurrences and weekly recurrences
+    with many 'exdates'. The events start within three years before and one
+    year after ``NOW``, and half of them are in the timezone ``zone``. The
+    same seed always gives the same calendar.
+    """
+    random = Random(seed)
+    tz = timezone(zone)
+    total = float(sum(weight for kind, weight in mix))
+
+    for documentId in range(1, size + 1):
+        choice = random.random() * total
+        for kind, weight in mix:
+            choice -= weight
+            if choice < 0:
+                break
+
+        start = NOW + timedelta(days=random.randint(-3 * 365, 365))
+        start = start.replace(hour=random.randint(7, 20),
+                              minute=random.choice((0, 15, 30, 45)))
+        end = start + timedelta(minutes=random.choice(
+            (30, 60, 60, 90, 120, 480, 24 * 60, 3 * 24 * 60)))
+        recurrence = _recurrence(random, kind, start)
+        if random.random() < 0.5:
+            start = tz.localize(start)
+            end = tz.localize(end)
+        yield documentId, Event(kind, start, end, recurrence)
@@ -0,0 +1,238 @@
+"""Benchmark indexing and querying an event index.
+
+The index is stored in an in-memory ZODB, and every phase reports the
+operations per second, the median and 99th percentile latency and the
+number of bytes written to the database. The result cache is cleared
+before every query, so the queries are measured, not the cache.
+"""
+from ZODB.DB import DB
+from ZODB.MappingStorage import MappingStorage
+from datetime import timedelta
+from optparse import OptionParser
+from plone.app.eventindex import EventIndex
+from plone.app.eventindex import result_cache
+from plone.app.eventindex.benchmark.generate import Event
+from plone.app.eventindex.benchmark.generate import MIX
+from plone.app.eventindex.benchmark.generate import NOW
+from plone.app.eventindex.benchmark.generate import generate
+from plone.app.eventindex.ical import parse_events
+from random import Random
+from time import time
+
+import sys
+import transaction
+
+
+_DAY = NOW.replace(hour=0, minute=0)
+
+# The query shapes, as (name, start, end) with times relative to NOW.
+QUERIES = (
+    ('today', _DAY, _DAY + timedelta(days=1)),
+    ('week', _DAY - timedelta(days=NOW.weekday()),
+     _DAY + timedelta(days=7 - NOW.weekday())),
+    ('year', NOW, NOW + timedelta(days=365)),
+    ('upcoming', NOW, None),
+    ('ended', None, NOW),
+)
+
+# The six weeks of a month view, as one calendar() call by day.
+MONTH_VIEW = (_DAY - timedelta(days=NOW.day - 1 + NOW.weekday()),
+              timedelta(days=42))
+
+
+class CountingStorage(MappingStorage):
+    """A MappingStorage counting the bytes stored in it."""
+
+    bytes_written = 0
+
+    def store(self, oid, serial, data, version, transaction):
+        self.bytes_written += len(data)
+        return MappingStorage.store(self, oid, serial, data, version,
+                                    transaction)
+
+
+def percentile(values, fraction):
+    """Get the value below which ``fraction`` of the sorted values are."""
+    if not values:
+        return 0.0
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+class Phase(object):
+    """Measures the latencies and bytes written of a benchmark phase."""
+
+    def __init__(self, name, storage):
+        self.name = name
+        self.storage = storage
+        self.latencies = []
+        self.operations = 0
+
+    def __enter__(self):
+        self.bytes_before = self.storage.bytes_written
+        self.started = time()
+        return self
+
+    def __exit__(self, *exc_info):
+        transaction.commit()
+        self.seconds = time() - self.started
+        self.bytes = self.storage.bytes_written - self.bytes_before
+
+    def call(self, func, *args, **kw):
+        """Call func and record its latency.
+
+        The call counts as one operation, or as the number of operations
+        given as the ``operations`` keyword argument.
+        """
+        operations = kw.pop('operations', 1)
+        started = time()
+        result = func(*args, **kw)
+        self.latencies.append(time() - started)
+        self.operations += operations
+        return result
+
+    def result(self):
+        latencies = sorted(self.latencies)
+        return {
+            'name': self.name,
+            'operations': self.operations,
+            'seconds': self.seconds,
+            'ops': self.operations / (self.seconds or 1e-9),
+            'p50': percentile(latencies, 0.5),
+            'p99': percentile(latencies, 0.99),
+            'bytes': self.bytes,
+        }
+
+
+def run(size=10000, mix=MIX, seed=0, queries=100, batch=1000, events=None):
+    """Run the benchmarks and return the results of the phases.
+
+    ``size`` events of the kinds in ``mix`` are indexed one by one, and
+    ``batch`` at a time with ``index_objects``, then each of the query
+    shapes in ``QUERIES`` and the month view of ``calendar()`` are run
+    ``queries`` times, moved by a random number of days, and finally a
+    tenth of the events are reindexed and unindexed. Transactions are
+    committed every ``batch`` events.
+
+    Instead of a synthetic calendar, a list of (documentId, event) pairs
+    can be given as ``events``.
+    """
+    random = Random(seed)
+    if events is None:
+        events = list(generate(size, mix, seed))
+    size = len(events)
+    storage = CountingStorage()
+    db = DB(storage)
+    connection = db.open()
+    root = connection.root()
+    root['index'] = index = EventIndex('event')
+    root['bulk'] = bulk = EventIndex('event')
+    transaction.commit()
+    results = []
+
+    with Phase('index_object', storage) as phase:
+        for documentId, event in events:
+            phase.call(index.index_object, documentId, event)
+            if documentId % batch == 0:
+                transaction.commit()
+    results.append(phase.result())
+
+    with Phase('index_objects', storage) as phase:
+        for i in range(0, size, batch):
+            chunk = events[i:i + batch]
+            phase.call(bulk.index_objects, chunk, operations=len(chunk))
+            transaction.commit()
+    results.append(phase.result())
+
+    for name, start, end in QUERIES:
+        with Phase('query %s' % name, storage) as phase:
+            for i in range(queries):
+                delta = timedelta(days=random.randint(-30, 30))
+                query = {}
+                if start is not None:
+                    query['start'] = start + delta
+                if end is not None:
+                    query['end'] = end + delta
+                # Measure the queries themselves, not the result cache.
+                result_cache.clear()
+                phase.call(index._apply_index, {'event': query})
+        results.append(phase.result())
+
+    with Phase('calendar month', storage) as phase:
+        start, length = MONTH_VIEW
+        for i in range(queries):
+            delta = timedelta(days=random.randint(-30, 30))
+            phase.call(index.calendar, start + delta,
+                       start + delta + length, 'day')
+    results.append(phase.result())
+
+    changed = random.sample(events, size // 10)
+    with Phase('reindex', storage) as phase:
+        for i, (documentId, event) in enumerate(changed):
+            phase.call(index.index_object, documentId,
+                       event.shifted(timedelta(days=1)))
+            if i % batch == 0:
+                transaction.commit()
+    results.append(phase.result())
+
+    with Phase('unindex', storage) as phase:
+        for i, (documentId, event) in enumerate(changed):
+            phase.call(index.unindex_object, documentId)
+            if i % batch == 0:
+                transaction.commit()
+    results.append(phase.result())
+
+    connection.close()
+    db.close()
+    return results
+
+
+def report(results, out=sys.stdout):
+    """Print the results of ``run`` as a table.
+
+    The latencies are per call, which for ``index_objects`` is a batch.
+    """
+    out.write('%-16s %10s %12s %10s %10s %12s\n' % (
+        'phase', 'operations', 'ops/sec', 'p50 ms', 'p99 ms', 'bytes'))
+    for result in results:
+        out.write('%-16s %10d %12.1f %10.3f %10.3f %12d\n' % (
+            result['name'], result['operations'], result['ops'],
+            result['p50'] * 1000, result['p99'] * 1000, result['bytes']))
+
+
+def parse_mix(option, opt, value, parser):
+    mix = []
+    for part in value.split(','):
+        kind, weight = part.split('=')
+        mix.append((kind.strip(), float(weight)))
+    parser.values.mix = tuple(mix)
+
+
+def main(argv=None):
+    parser = OptionParser(usage='%prog [options]',
+                          description='Benchmark the event index.')
+    parser.add_option('-n', '--size', type='int', default=10000,
+                      help='The number of events [default: %default]')
+    parser.add_option('-q', '--queries', type='int', default=100,
+                      help='The number of queries of each shape '
+                      '[default: %default]')
+    parser.add_option('-b', '--batch', type='int', default=1000,
+                      help='The number of events per transaction '
+                      '[default: %default]')
+    parser.add_option('-s', '--seed', type='int', default=0,
+                      help='The random seed [default: %default]')
+    parser.add_option('-m', '--mix', type='string', action='callback',
+                      callback=parse_mix, default=MIX,
+                      help='The mix of events, for example '
+                      'single=0.6,bounded=0.25,open=0.1,exdates=0.05')
+    parser.add_option('-i', '--ical', metavar='FILE',
+                      help='Use the events of an iCalendar file instead of a '
+                      'synthetic calendar')
+    options, args = parser.parse_args(argv)
+    events = None
+    if options.ical:
+        events = [(documentId, Event('ical', record.start, record.end,
+                                     record.recurrence))
+                  for documentId, record in enumerate(
+                      parse_events(open(options.ical, 'rb')), 1)]
+    report(run(options.size, options.mix, options.seed, options.queries,
+               options.batch, events))
@@ -0,0 +1,97 @@
+from time import time
+
+
+class ExpansionBudgetExceeded(Exception):
+    """Expanding recurrences took more occurrences or time than allowed.
+
+    ``documentId`` is the document that was being expanded, or None if the
+    budget of the query was used up before it was expanded at all.
+    """
+
+    def __init__(self, message, documentId=None):
+        Exception.__init__(self, message)
+        self.documentId = documentId
+
+
+class ExpansionBudget(object):
+    """Counts the occurrences examined while expanding recurrences.
+
+    Every event may skip at most ``max_occurrences`` occurrences to get to
+    the query period, and all events of a query together at most
+    ``max_total`` occurrences within ``timeout`` seconds. Either of the
+    query limits may be None for no limit.
+    """
+
+    # How many occurrences to examine between looking at the clock.
+    check_interval = 100
+
+    def __init__(self, max_occurrences, max_total=None, timeout=None):
+        self.max_occurrences = max_occurrences
+        self.remaining = max_total
+        self.deadline = timeout and time() + timeout
+        self.documentId = None
+        self.event_remaining = max_occurrences
+        self.examined = 0
+
+    def start(self, documentId):
+        """Start expanding the recurrence of a document."""
+        if self.exhausted():
+            raise ExpansionBudgetExceeded(
+                'The expansion budget of the query is used up')
+        self.documentId = documentId
+        self.event_remaining = self.max_occurrences
+
+    def exhausted(self):
+        """Check if the budget of the query is used up."""
+        if self.remaining is not None and self.remaining <= 0:
+            return True
+        return bool(self.deadline) and time() > self.deadline
+
+    def spend(self):
+        """Count an occurrence examined outside the query period."""
+        self.event_remaining -= 1
+        self._spend(self.documentId, self.event_remaining)
+
+    def event(self, documentId):
+        """Get the budget of a document, for expanding several at once.
+
+        Unlike ``start``, this doesn't end the budget of the document being
+        expanded: the occurrences spent through the ``EventBudget`` count
+        against its own ``max_occurrences`` and the limits of the query.
+        """
+        if self.exhausted():
+            raise ExpansionBudgetExceeded(
+                'The expansion budget of the query is used up')
+        return EventBudget(self, documentId)
+
+    def _spend(self, documentId, event_remaining):
+        self.examined += 1
+        if event_remaining < 0:
+            raise ExpansionBudgetExceeded(
+                'Document %s has more than %s occurrences to expand' % (
+                    documentId, self.max_occurrences),
+                documentId)
+        if self.remaining is not None:
+            self.remaining -= 1
+            if self.remaining < 0:
+                raise ExpansionBudgetExceeded(
+                    'The expansion budget of the query is used up',
+                    documentId)
+        if (self.deadline and self.examined % self.check_interval == 0 and
+                time() > self.deadline):
+            raise ExpansionBudgetExceeded(
+                'The expansion of the query took too long', documentId)
+
+
+class EventBudget(object):
+    """The budget of one document of an ``ExpansionBudget``."""
+
+    def __init__(self, budget, documentId):
+        self.budget = budget
+        self.documentId = documentId
+        self.remaining = budget.max_occurrences
+
+    def spend(self):
+        """Count an occurrence examined for the document."""
+        self.remaining -= 1
+        self.budget._spend(self.documentId, self.remaining)
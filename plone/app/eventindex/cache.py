@@ -0,0 +1,56 @@
+from collections import OrderedDict
+
+import threading
+
+
+class LRUCache(object):
+    """A bounded, thread safe mapping for per-process caches.
+
+    When more than ``maxsize`` entries are stored, the least recently used
+    entries are dropped. The ``hits`` and ``misses`` counters count the
+    lookups.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        self._lock.acquire()
+        try:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            # Move the entry to the end, as the most recently used.
+            self._data[key] = value
+            self.hits += 1
+            return value
+        finally:
+            self._lock.release()
+
+    def set(self, key, value):
+        self._lock.acquire()
+        try:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+        finally:
+            self._lock.release()
@@ -0,0 +1,279 @@
+"""Load the events of iCalendar files into an event index.
+
+The files are parsed line by line, and the events are indexed in batches
+as lightweight records, so even very large calendars, for example the
+anonymized ones made by anonical.py, can be loaded without content objects
+and with a flat memory use.
+"""
+from ZODB.DB import DB
+from ZODB.FileStorage import FileStorage
+from datetime import datetime
+from datetime import timedelta
+from dateutil import rrule
+from optparse import OptionParser
+from plone.app.eventindex import EventIndex
+
+import logging
+import pytz
+import re
+import sys
+import transaction
+
+logger = logging.getLogger('plone.app.eventindex')
+
+_DURATION = re.compile(r'^([+-])?P(?:(\d+)W)?(?:(\d+)D)?'
+                       r'(?:T(?:(\d+)H)?(?:(\d+)M)?(?:(\d+)S)?)?$')
+
+# Timezones by their upper case names, as anonical.py upper cases calendars.
+_ZONES = dict((zone.upper(), zone) for zone in pytz.all_timezones)
+
+
+class Record(object):
+    """An event read from a calendar, with the attributes of the index."""
+
+    __slots__ = ('start', 'end', 'recurrence')
+
+    def __init__(self, start, end, recurrence=None):
+        self.start = start
+        self.end = end
+        self.recurrence = recurrence
+
+
+def unfold(lines):
+    """Join the folded content lines of a calendar.
+
+    Lines starting with a space or a tab continue the previous line.
+    """
+    for number, line in _unfold_numbered(lines):
+        yield line
+
+
+def _unfold_numbered(lines):
+    # Like unfold(), with the number of the first line of each content line.
+    current = None
+    start = 0
+    for number, line in enumerate(lines, 1):
+        line = line.rstrip('\r\n')
+        if line[:1] in (' ', '\t'):
+            if current is not None:
+                current += line[1:]
+            continue
+        if current is not None:
+            yield start, current
+        current = line
+        start = number
+    if current is not None:
+        yield start, current
+
+
+def parse_line(line):
+    """Split a content line into its name, parameters and value."""
+    head, sep, value = line.partition(':')
+    parts = head.split(';')
+    params = {}
+    for part in parts[1:]:
+        key, sep, param = part.partition('=')
+        params[key.upper()] = param.strip('"')
+    return parts[0].upper(), params, value
+
+
+def get_timezone(name):
+    """Get a pytz timezone by its name, in any case, or None."""
+    zone = _ZONES.get(name.upper())
+    if zone is None:
+        return None
+    return pytz.timezone(zone)
+
+
+def parse_datetime(value, params):
+    """Parse a DATE or DATE-TIME value.
+
+    Values in UTC get the pytz UTC timezone, and values with a TZID the
+    timezone it names. Floating times, and times in unknown timezones, are
+    naive, and dates are naive datetimes at midnight.
+    """
+    value = value.strip().upper()
+    if 'T' not in value:
+        return datetime.strptime(value[:8], '%Y%m%d')
+    dt = datetime.strptime(value[:15], '%Y%m%dT%H%M%S')
+    if value.endswith('Z'):
+        return pytz.utc.localize(dt)
+    tz = 'TZID' in params and get_timezone(params['TZID']) or None
+    if tz is not None:
+        return tz.localize(dt)
+    return dt
+
+
+def parse_duration(value):
+    """Parse a DURATION value into a timedelta."""
+    match = _DURATION.match(value.strip().upper())
+    if match is None:
+        raise ValueError('Invalid duration %r' % value)
+    sign, weeks, days, hours, minutes, seconds = match.groups()
+    delta = timedelta(weeks=int(weeks or 0), days=int(days or 0),
+                      hours=int(hours or 0), minutes=int(minutes or 0),
+                      seconds=int(seconds or 0))
+    if sign == '-':
+        return -delta
+    return delta
+
+
+def _format_dates(values, params):
+    # RDATE and EXDATE parameters like TZID aren't understood by rrulestr,
+    # so the dates are written in UTC, or as floating times.
+    result = []
+    for value in values.split(','):
+        if not value.strip():
+            continue
+        dt = parse_datetime(value, params)
+        if dt.tzinfo is not None:
+            result.append(dt.astimezone(pytz.utc).strftime('%Y%m%dT%H%M%SZ'))
+        else:
+            result.append(dt.strftime('%Y%m%dT%H%M%S'))
+    return ','.join(result)
+
+
+def _make_record(properties):
+    start = end = duration = None
+    rules = []
+    for name, params, value in properties:
+        if name == 'DTSTART':
+            start = parse_datetime(value, params)
+            date_only = params.get('VALUE') == 'DATE' or 'T' not in value
+        elif name == 'DTEND':
+            end = parse_datetime(value, params)
+        elif name == 'DURATION':
+            duration = parse_duration(value)
+        elif name in ('RRULE', 'EXRULE'):
+            rules.append('%s:%s' % (name, value.strip().upper()))
+        elif name in ('RDATE', 'EXDATE'):
+            if params.get('VALUE') == 'PERIOD':
+                continue
+            dates = _format_dates(value, params)
+            if dates:
+                rules.append('%s:%s' % (name, dates))
+
+    if start is None:
+        return None
+    if end is None:
+        if duration is not None:
+            end = start + duration
+        elif date_only:
+            # All day events last until the next day.
+            end = start + timedelta(days=1)
+        else:
+            end = start
+    if not [rule for rule in rules if rule.startswith('RRULE')]:
+        # Dates alone aren't supported as a recurrence by the index.
+        rules = []
+    recurrence = '\n'.join(rules) or None
+    if recurrence is not None:
+        # Parse the rules like the index will, so that an invalid rule
+        # skips this event instead of failing a whole batch of indexing.
+        rrule.rrulestr(recurrence, dtstart=start)
+    return Record(start, end, recurrence)
+
+
+def parse_events(lines, skipped=None):
+    """Iterate over the events of a calendar.
+
+    ``lines`` is an iterable of the lines of an iCalendar file, for example
+    the file itself. Yields a ``Record`` for every VEVENT with a DTSTART.
+    The events are parsed one at a time, so the whole calendar is never in
+    memory.
+
+    Events with invalid values, like an unparsable DTSTART or RRULE, are
+    logged and skipped. If ``skipped`` is given, a ``(line, uid, error)``
+    tuple is appended to it for each of them, with the number of the
+    BEGIN:VEVENT line.
+    """
+    properties = None
+    for number, line in _unfold_numbered(lines):
+        name, params, value = parse_line(line)
+        if name == 'BEGIN' and value.strip().upper() == 'VEVENT':
+            properties = []
+            begin = number
+        elif name == 'END' and value.strip().upper() == 'VEVENT':
+            if properties is not None:
+                try:
+                    record = _make_record(properties)
+                except ValueError, e:
+                    uid = dict((key, value) for key, params, value
+                               in properties).get('UID')
+                    logger.warning('Skipped the event %s at line %s: %s',
+                                   uid, begin, e)
+                    if skipped is not None:
+                        skipped.append((begin, uid, str(e)))
+                    record = None
+                if record is not None:
+                    yield record
+            properties = None
+        elif properties is not None:
+            properties.append((name, params, value))
+
+
+def load(index, lines, first_id=1, batch=1000, commit=True, skipped=None):
+    """Load the events of a calendar into an index.
+
+    The events get consecutive documentIds starting with ``first_id``, and
+    are indexed ``batch`` at a time with ``index_objects``. Unless
+    ``commit`` is False, the transaction is committed after every batch.
+    Invalid events are skipped, and added to ``skipped``, see
+    ``parse_events``.
+
+    Returns the number of events indexed.
+    """
+    count = 0
+    records = []
+    documentId = first_id
+    for record in parse_events(lines, skipped):
+        records.append((documentId, record))
+        documentId += 1
+        if len(records) >= batch:
+            count += index.index_objects(records)
+            records = []
+            if commit:
+                transaction.commit()
+    if records:
+        count += index.index_objects(records)
+        if commit:
+            transaction.commit()
+    return count
+
+
+def main(argv=None):
+    parser = OptionParser(
+        usage='%prog [options] <Data.fs> <calendar.ics>',
+        description='Load the events of an iCalendar file into an event '
+        'index in a ZODB file storage.')
+    parser.add_option('-i', '--index', default='event_index',
+                      help='The name of the index in the database root '
+                      '[default: %default]')
+    parser.add_option('-b', '--batch', type='int', default=1000,
+                      help='The number of events per transaction '
+                      '[default: %default]')
+    options, args = parser.parse_args(argv)
+    if len(args) != 2:
+        parser.error('A database and a calendar are required')
+
+    db = DB(FileStorage(args[0]))
+    connection = db.open()
+    root = connection.root()
+    index = root.get(options.index)
+    if index is None:
+        index = root[options.index] = EventIndex(options.index)
+    try:
+        first_id = index._uid2start.maxKey() + 1
+    except ValueError:
+        first_id = 1
+
+    if args[1] == '-':
+        lines = sys.stdin
+    else:
+        lines = open(args[1], 'rb')
+    skipped = []
+    count = load(index, lines, first_id, options.batch, skipped=skipped)
+    sys.stderr.write('Indexed %s events, skipped %s invalid events\n' % (
+        count, len(skipped)))
+    connection.close()
+    db.close()
@@ -0,0 +1,122 @@
+"""Filter recurring events in a pool of processes.
+
+Only plain integers and the compact form of the rules, see
+``plone.app.eventindex.recurrence.canonical_rule``, cross the process
+boundary, never any ZODB objects or rrule objects. Rules that aren't stored
+in the compact form are expanded by the index itself.
+
+The pools are forked from the Zope process. Forking a process serving
+requests in threads copies the locks held by the other threads, like the
+lock of the rule cache that ``compile_rule`` uses, which then stay locked
+in the workers. The workers replace that lock, but it is better to fork
+before any requests are served: the pool of ``parallel_processes`` set in
+the ``plone.app.eventindex`` product config of zope.conf is started when
+Zope starts, see ``start()``.
+"""
+from multiprocessing import Pool
+from plone.app.eventindex.budget import ExpansionBudget
+from plone.app.eventindex.budget import ExpansionBudgetExceeded
+from plone.app.eventindex.recurrence import compile_rule
+from plone.app.eventindex.recurrence import expand_seconds
+from plone.app.eventindex.recurrence import rule_cache
+
+import threading
+
+
+_pools = {}  # The pools by their number of processes
+_lock = threading.Lock()
+
+
+def get_pool(processes):
+    """Get the pool of ``processes`` processes, starting it if needed.
+
+    Every size has a pool of its own, so indexes with different
+    ``parallel_processes`` don't stop each other's pools while they are
+    used. Pools are only stopped by ``shutdown()``.
+    """
+    _lock.acquire()
+    try:
+        pool = _pools.get(processes)
+        if pool is None:
+            pool = _pools[processes] = Pool(processes, _init_worker)
+        return pool
+    finally:
+        _lock.release()
+
+
+def _init_worker():
+    # The worker has a single thread, and the lock may have been held by
+    # another thread of the parent when it was forked.
+    rule_cache._lock = threading.Lock()
+
+
+def start(config):
+    """Start the pool configured in the product config of zope.conf.
+
+    ``config`` is the product config of the package, if any, like::
+
+      <product-config plone.app.eventindex>
+        parallel_processes 4
+      </product-config>
+    """
+    processes = int((config or {}).get('parallel_processes', 0))
+    if processes > 0:
+        get_pool(processes)
+
+
+def shutdown():
+    """Stop the process pools, if they are running."""
+    _lock.acquire()
+    try:
+        for pool in _pools.values():
+            pool.terminate()
+        _pools.clear()
+    finally:
+        _lock.release()
+
+
+def filter_chunk(args):
+    """Find the recurring events with an occurrence within a period.
+
+    This runs in the worker processes. ``args`` is a ``(start, end,
+    max_occurrences, events)`` tuple, where ``start`` and ``end`` are
+    seconds since the epoch or None, and ``events`` is a list of
+    ``(documentId, duration, recurrence)`` tuples with the duration in
+    seconds and the recurrence in its compact form.
+
+    Returns a list of the documentIds that match and a list of those that
+    skip more than ``max_occurrences`` occurrences before the period.
+    """
+    start, end, max_occurrences, events = args
+    budget = ExpansionBudget(max_occurrences)
+    matches = []
+    over_budget = []
+    for documentId, duration, recurrence in events:
+        budget.start(documentId)
+        try:
+            for occurrence in expand_seconds(compile_rule(recurrence),
+                                             duration, start, end,
+                                             budget.spend):
+                matches.append(documentId)
+                break
+        except ExpansionBudgetExceeded:
+            over_budget.append(documentId)
+    return matches, over_budget
+
+
+def filter_parallel(processes, chunk_size, start, end, max_occurrences,
+                    events):
+    """Run ``filter_chunk`` over the events in chunks of ``chunk_size``.
+
+    Returns the results of the chunks merged into one list of matches and
+    one list of events over the budget.
+    """
+    chunks = [(start, end, max_occurrences, events[i:i + chunk_size])
+              for i in range(0, len(events), chunk_size)]
+    matches = []
+    over_budget = []
+    for chunk_matches, chunk_over_budget in get_pool(processes).map(
+            filter_chunk, chunks):
+        matches.extend(chunk_matches)
+        over_budget.extend(chunk_over_budget)
+    return matches, over_budget
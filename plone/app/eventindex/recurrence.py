@@ -0,0 +1,858 @@
+from calendar import timegm
+from datetime import datetime
+from datetime import timedelta
+from dateutil import rrule
+from dateutil.tz import tzoffset
+from dateutil.tz import tzutc
+from plone.app.eventindex.budget import ExpansionBudgetExceeded
+from plone.app.eventindex.cache import LRUCache
+
+import pytz
+import pytz.tzinfo
+
+
+UTC = tzutc()
+
+# Times are stored as integer seconds since the epoch, in UTC.
+EPOCH = datetime(1970, 1, 1)
+EPOCH_ORDINAL = EPOCH.toordinal()
+
+# The UTC offsets in seconds of the pytz tzinfos, see fixed_offset(). pytz
+# has one tzinfo for every offset of a timezone, also when they are
+# unpickled, so this doesn't grow beyond the offsets of the timezones used.
+_fixed_offsets = {}
+_PYTZ_TIMEZONES = (pytz.tzinfo.BaseTzInfo, type(pytz.utc))
+
+# Compiled recurrence rules, shared by all ZODB connections of the process
+# and keyed on the compact form the rules are stored in.
+rule_cache = LRUCache(10000)
+
+_FREQNAMES = ('YEARLY', 'MONTHLY', 'WEEKLY', 'DAILY', 'HOURLY', 'MINUTELY',
+              'SECONDLY')
+_WEEKDAYS = ('MO', 'TU', 'WE', 'TH', 'FR', 'SA', 'SU')
+
+
+def to_seconds(dt):
+    """Convert a datetime to seconds since the epoch.
+
+    Naive datetimes are assumed to be in UTC.
+    """
+    return timegm(dt.utctimetuple())
+
+
+def from_seconds(seconds):
+    """Convert seconds since the epoch to a naive UTC datetime."""
+    return EPOCH + timedelta(seconds=seconds)
+
+
+def fixed_offset(tzinfo):
+    """Get the UTC offset in seconds of a timezone, if it doesn't vary.
+
+    The tzinfos of pytz have one offset each, pytz gives every offset of a
+    timezone its own tzinfo, and the occurrences of a rule all have the
+    tzinfo of the start of the rule, see ``sync_timezone``. The offsets of
+    UTC and of the fixed offset timezones of dateutil don't vary either.
+    Returns None for other timezones, like the zoneinfo files of dateutil,
+    whose offset depends on the time. The offsets of the pytz tzinfos are
+    cached.
+    """
+    if isinstance(tzinfo, _PYTZ_TIMEZONES):
+        try:
+            return _fixed_offsets[tzinfo]
+        except KeyError:
+            pass
+        # pytz looks at the tzinfo of the datetime, not at its time.
+        offset = _seconds(tzinfo.utcoffset(EPOCH.replace(tzinfo=tzinfo)))
+        _fixed_offsets[tzinfo] = offset
+        return offset
+    if isinstance(tzinfo, (tzutc, tzoffset)):
+        # These are unpickled as new instances, so they aren't cached.
+        return _seconds(tzinfo.utcoffset(None))
+    return None
+
+
+def zone_offsets(tzinfo):
+    """Get the UTC offsets in seconds a timezone can have, in order.
+
+    Naive datetimes have an offset of 0. Returns None for timezones whose
+    offsets aren't known.
+    """
+    if tzinfo is None:
+        return (0,)
+    offset = fixed_offset(tzinfo)
+    if offset is not None:
+        return (offset,)
+    offsets = None
+    ttinfos = getattr(tzinfo, '_ttinfo_list', None)  # dateutil tzfile
+    if ttinfos:
+        offsets = [ttinfo.offset for ttinfo in ttinfos]
+    elif getattr(tzinfo, '_dst_offset', None) is not None:
+        # dateutil tzlocal, tzrange and tzstr
+        offsets = [tzinfo._std_offset, tzinfo._dst_offset]
+    if offsets is None:
+        return None
+    return tuple(sorted(set(
+        isinstance(offset, timedelta) and _seconds(offset) or offset
+        for offset in offsets)))
+
+
+def utc_seconds(dt):
+    """Convert a datetime to seconds since the epoch.
+
+    This gives the same result as ``to_seconds``, but is computed from the
+    fields of the datetime, without the time tuple and the timezone lookups
+    of ``utctimetuple``.
+    """
+    seconds = ((dt.toordinal() - EPOCH_ORDINAL) * 86400 +
+               dt.hour * 3600 + dt.minute * 60 + dt.second)
+    tzinfo = dt.tzinfo
+    if tzinfo is None:
+        return seconds
+    offset = fixed_offset(tzinfo)
+    if offset is None:
+        delta = tzinfo.utcoffset(dt)
+        offset = delta is not None and _seconds(delta) or 0
+    return seconds - offset
+
+
+def local_datetime(seconds, tzinfo):
+    """Convert seconds since the epoch to a datetime in a timezone.
+
+    The timezone must have a fixed offset, see ``fixed_offset``, or be None
+    for naive UTC datetimes. Comparing datetimes with the same tzinfo is
+    done on their fields alone, without looking up their offsets.
+    """
+    if tzinfo is None:
+        return from_seconds(seconds)
+    return from_seconds(seconds + fixed_offset(tzinfo)).replace(tzinfo=tzinfo)
+
+
+def utc_datetime(dt):
+    """Convert a datetime to a naive datetime in UTC.
+
+    Naive datetimes are assumed to be in UTC already.
+    """
+    if dt is None:
+        return None
+    return datetime(*dt.utctimetuple()[:6])
+
+
+def is_open_ended(rule):
+    if isinstance(rule, rrule.rruleset):
+        rules = rule._rrule
+    else:
+        rules = [rule]
+
+    for r in rules:
+        if r._count is None and r._until is None:
+            return True
+
+    return False
+
+
+def localize_datetime(dt, tz):
+    if not isinstance(dt, datetime):
+        return dt
+
+    if tz is None and dt.tzinfo is not None:
+        return dt.replace(tzinfo=None)
+    elif tz is not None and dt.tzinfo is None:
+        return tz.localize(dt)
+    else:
+        return dt
+
+
+def sync_timezone(rule, tz):
+    if isinstance(rule, rrule.rruleset):
+        if getattr(rule, '_exdate', None):
+            rule._exdate = [localize_datetime(x, tz) for x in rule._exdate]
+        if getattr(rule, '_rdate', None):
+            rule._rdate = [localize_datetime(x, tz) for x in rule._rdate]
+        for x in rule._rrule:
+            sync_timezone(x, tz)
+    else:
+        if getattr(rule, '_until', None):
+            rule._until = localize_datetime(rule._until, tz)
+        if getattr(rule, '_dtstart', None):
+            rule._dtstart = localize_datetime(rule._dtstart, tz)
+
+
+def _format_datetime(dt):
+    if dt.tzinfo is not None:
+        return '%04d%02d%02dT%02d%02d%02dZ' % dt.utctimetuple()[:6]
+    return '%04d%02d%02dT%02d%02d%02d' % dt.timetuple()[:6]
+
+
+def _format_numbers(numbers):
+    return ','.join([str(n) for n in numbers])
+
+
+def _rrule_to_text(r):
+    parts = ['FREQ=' + _FREQNAMES[r._freq],
+             'INTERVAL=%s' % r._interval,
+             'WKST=' + _WEEKDAYS[r._wkst]]
+    if r._count is not None:
+        parts.append('COUNT=%s' % r._count)
+    if r._until is not None:
+        parts.append('UNTIL=' + _format_datetime(r._until))
+    if r._bysetpos:
+        parts.append('BYSETPOS=' + _format_numbers(r._bysetpos))
+    if r._bymonth:
+        parts.append('BYMONTH=' + _format_numbers(r._bymonth))
+    if r._bymonthday or r._bynmonthday:
+        parts.append('BYMONTHDAY=' +
+                     _format_numbers(r._bymonthday + r._bynmonthday))
+    if r._byyearday:
+        parts.append('BYYEARDAY=' + _format_numbers(r._byyearday))
+    if r._byweekno:
+        parts.append('BYWEEKNO=' + _format_numbers(r._byweekno))
+    byday = [_WEEKDAYS[day] for day in r._byweekday or ()]
+    byday.extend(['%+d%s' % (n, _WEEKDAYS[day])
+                  for day, n in r._bynweekday or ()])
+    if byday:
+        parts.append('BYDAY=' + ','.join(byday))
+    if r._byhour is not None:
+        parts.append('BYHOUR=' + _format_numbers(r._byhour))
+    if r._byminute is not None:
+        parts.append('BYMINUTE=' + _format_numbers(r._byminute))
+    if r._bysecond is not None:
+        parts.append('BYSECOND=' + _format_numbers(r._bysecond))
+    if r._byeaster:
+        parts.append('BYEASTER=' + _format_numbers(r._byeaster))
+    return ';'.join(parts)
+
+
+def rule_to_text(rule):
+    """Serialize an rrule or rruleset to RRULE, EXRULE, RDATE and EXDATE
+    lines that rrulestr() parses back to the same recurrence.
+    """
+    if not isinstance(rule, rrule.rruleset):
+        return 'RRULE:' + _rrule_to_text(rule)
+
+    lines = ['RRULE:' + _rrule_to_text(r) for r in rule._rrule]
+    lines.extend(['EXRULE:' + _rrule_to_text(r) for r in rule._exrule])
+    if rule._rdate:
+        lines.append('RDATE:' +
+                     ','.join([_format_datetime(d) for d in rule._rdate]))
+    if rule._exdate:
+        lines.append('EXDATE:' +
+                     ','.join([_format_datetime(d) for d in rule._exdate]))
+    return '\n'.join(lines)
+
+
+def canonical_rule(rule, start, text=None):
+    """Get the compact form to store a recurrence in.
+
+    ``rule`` is the rrule or rruleset starting at the datetime ``start``,
+    and ``text`` the string it was parsed from, if any. The compact form is
+    a ``(text, start, zone)`` tuple of the rule text, the start in seconds
+    since the epoch and the name of the pytz timezone of the start, or None
+    for naive starts. Rules in other timezones are returned as they are.
+    """
+    zone = None
+    if start.tzinfo is not None:
+        zone = getattr(start.tzinfo, 'zone', None)
+        if zone is None:
+            return rule
+    if text is None:
+        text = rule_to_text(rule)
+    canonical = (text.strip(), to_seconds(start), zone)
+    rule_cache.set(canonical, rule)
+    return canonical
+
+
+def compile_rule(stored):
+    """Get the rrule or rruleset of a recurrence in its stored form.
+
+    Compiled rules are cached in ``rule_cache``. Recurrences that weren't
+    stored in the compact form are returned as they are.
+    """
+    if not isinstance(stored, tuple):
+        return stored
+
+    rule = rule_cache.get(stored)
+    if rule is None:
+        text, start, zone = stored
+        dtstart = from_seconds(start)
+        if zone is not None:
+            dtstart = pytz.utc.localize(dtstart).astimezone(
+                pytz.timezone(zone))
+        rule = rrule.rrulestr(text, dtstart=dtstart)
+        sync_timezone(rule, dtstart.tzinfo)
+        rule_cache.set(stored, rule)
+    return rule
+
+
+_UNITS = {
+    rrule.WEEKLY: timedelta(days=7),
+    rrule.DAILY: timedelta(days=1),
+    rrule.HOURLY: timedelta(hours=1),
+    rrule.MINUTELY: timedelta(minutes=1),
+    rrule.SECONDLY: timedelta(seconds=1),
+}
+
+
+def _seconds(delta):
+    return delta.days * 86400 + delta.seconds
+
+
+def _period_start(r, wall):
+    """Get the start of the period of ``r`` that contains ``wall``.
+
+    ``wall`` is a naive datetime in the wall clock time of the rule.
+    """
+    freq = r._freq
+    if freq == rrule.YEARLY:
+        return datetime(wall.year, 1, 1)
+    elif freq == rrule.MONTHLY:
+        return datetime(wall.year, wall.month, 1)
+    elif freq == rrule.WEEKLY:
+        day = datetime(wall.year, wall.month, wall.day)
+        return day - timedelta(days=(day.weekday() - r._wkst) % 7)
+    elif freq == rrule.DAILY:
+        return datetime(wall.year, wall.month, wall.day)
+    elif freq == rrule.HOURLY:
+        return wall.replace(minute=0, second=0, microsecond=0)
+    elif freq == rrule.MINUTELY:
+        return wall.replace(second=0, microsecond=0)
+    return wall.replace(microsecond=0)
+
+
+def _add_periods(r, period, k):
+    """Move ``period`` forward by ``k`` intervals of the rule."""
+    n = k * r._interval
+    if r._freq == rrule.YEARLY:
+        return period.replace(year=period.year + n)
+    elif r._freq == rrule.MONTHLY:
+        months = period.year * 12 + period.month - 1 + n
+        return datetime(months // 12, months % 12 + 1, 1)
+    return period + _UNITS[r._freq] * n
+
+
+def _intervals_between(r, first, wall):
+    """Count the whole intervals of the rule from ``first`` to ``wall``."""
+    if r._freq == rrule.YEARLY:
+        units = wall.year - first.year
+    elif r._freq == rrule.MONTHLY:
+        units = (wall.year - first.year) * 12 + wall.month - first.month
+    else:
+        units = _seconds(wall - first) // _seconds(_UNITS[r._freq])
+    return units // r._interval
+
+
+def occurrences_per_period(r):
+    """Get the number of occurrences in every full period of the rule.
+
+    Returns None if the number varies between periods, for example for
+    monthly rules on the 31st or weekly rules limited to some months.
+    """
+    if r._freq < rrule.HOURLY:
+        times = len(r._byhour) * len(r._byminute) * len(r._bysecond)
+    elif r._freq == rrule.HOURLY:
+        times = len(r._byminute) * len(r._bysecond)
+    elif r._freq == rrule.MINUTELY:
+        times = len(r._bysecond)
+    else:
+        times = 1
+
+    if r._freq == rrule.YEARLY:
+        if (r._byweekday or not r._bymonth or not r._bymonthday or
+                max(r._bymonthday) > 28):
+            return None
+        return len(r._bymonth) * len(r._bymonthday) * times
+    elif r._freq == rrule.MONTHLY:
+        if (r._bymonth or r._byweekday or not r._bymonthday or
+                max(r._bymonthday) > 28):
+            return None
+        return len(r._bymonthday) * times
+    elif r._freq == rrule.WEEKLY:
+        if r._bymonth or r._bymonthday:
+            return None
+        return len(r._byweekday) * times
+    elif r._bymonth or r._bymonthday or r._byweekday:
+        return None
+    return times
+
+
+def is_seekable(r):
+    """Check if the occurrences of a single rrule can be skipped ahead.
+
+    This is the case for rules with a FREQ and INTERVAL, optionally limited
+    by BYMONTH, BYMONTHDAY, BYDAY and the times of day, and a COUNT or an
+    UNTIL. Rules with BYSETPOS, BYWEEKNO, BYYEARDAY, BYEASTER or relative
+    BYDAY and BYMONTHDAY values are not seekable.
+    """
+    if (r._bysetpos or r._byweekno or r._byyearday or r._byeaster or
+            r._bynmonthday or r._bynweekday):
+        return False
+    if r._freq >= rrule.HOURLY:
+        if r._bymonth or r._bymonthday or r._byweekday:
+            return False
+        if r._byhour is not None:
+            return False
+        if r._freq >= rrule.MINUTELY and r._byminute is not None:
+            return False
+        if r._freq == rrule.SECONDLY and r._bysecond is not None:
+            return False
+    if r._count is not None:
+        return occurrences_per_period(r) is not None
+    return True
+
+
+def seek_rule(r, dt):
+    """Skip a single rrule ahead to the period containing ``dt``.
+
+    ``dt`` is a naive UTC datetime. Returns an rrule that generates the
+    same occurrences as ``r`` from the start of that period on, or ``r``
+    itself if the rule is not seekable or can't be skipped ahead, or None
+    if the rule has no occurrences left.
+
+    For timezones whose offset varies, the period containing ``dt`` in
+    the smallest offset of the timezone is used, as occurrences starting
+    after ``dt`` can't be at an earlier wall clock time than that.
+    """
+    if not is_seekable(r):
+        return r
+
+    tzinfo = r._tzinfo
+    if tzinfo is None:
+        wall = dt
+    elif fixed_offset(tzinfo) is not None:
+        wall = dt + timedelta(seconds=fixed_offset(tzinfo))
+    else:
+        offsets = zone_offsets(tzinfo)
+        if offsets is None:
+            return r
+        wall = dt + timedelta(seconds=offsets[0])
+    first = _period_start(r, r._dtstart.replace(tzinfo=None))
+    k = _intervals_between(r, first, wall)
+    if k < 1:
+        # The first period may start before dtstart, we can't skip it.
+        return r
+
+    try:
+        period = _add_periods(r, first, k)
+    except (ValueError, OverflowError):
+        # Beyond the year 9999.
+        return None
+
+    count = r._count
+    if count is not None:
+        # Count the occurrences of the first, partial, period and add the
+        # constant number of occurrences of the following periods.
+        second = _add_periods(r, first, 1).replace(tzinfo=r._tzinfo)
+        consumed = 0
+        for occurrence in r._iter():
+            if occurrence >= second:
+                break
+            consumed += 1
+        consumed += (k - 1) * occurrences_per_period(r)
+        count -= consumed
+        if count <= 0:
+            return None
+
+    return rrule.rrule(r._freq,
+                       dtstart=period.replace(tzinfo=r._tzinfo),
+                       interval=r._interval,
+                       wkst=r._wkst,
+                       count=count,
+                       until=r._until,
+                       bymonth=r._bymonth,
+                       bymonthday=r._bymonthday or None,
+                       byweekday=r._byweekday,
+                       byhour=r._byhour,
+                       byminute=r._byminute,
+                       bysecond=r._bysecond)
+
+
+def _tzinfo(rule):
+    if isinstance(rule, rrule.rruleset):
+        for r in rule._rrule:
+            return r._tzinfo
+        for d in rule._rdate:
+            return d.tzinfo
+        return None
+    return rule._tzinfo
+
+
+def seek(rule, dt, skipped=None):
+    """Iterate over the occurrences of a recurrence at or after ``dt``.
+
+    ``rule`` is an rrule or an rruleset and ``dt`` a naive UTC datetime.
+    For the common rule shapes, see ``is_seekable``, the expansion jumps
+    directly to the period containing ``dt``, so the cost doesn't depend on
+    how long ago the recurrence started. Other rules are expanded from their
+    start. If given, ``skipped`` is called for every occurrence that is
+    expanded before ``dt``.
+    """
+    if isinstance(rule, rrule.rruleset):
+        shifted = rrule.rruleset()
+        for r in rule._rrule:
+            r = seek_rule(r, dt)
+            if r is not None:
+                shifted.rrule(r)
+        for r in rule._exrule:
+            r = seek_rule(r, dt)
+            if r is not None:
+                shifted.exrule(r)
+        for d in rule._rdate:
+            shifted.rdate(d)
+        for d in rule._exdate:
+            shifted.exdate(d)
+    else:
+        shifted = seek_rule(rule, dt)
+        if shifted is None:
+            return
+
+    tzinfo = _tzinfo(rule)
+    if tzinfo is not None:
+        if fixed_offset(tzinfo) is None:
+            dt = dt.replace(tzinfo=UTC)
+        else:
+            dt = local_datetime(to_seconds(dt), tzinfo)
+    for occurrence in shifted._iter():
+        if occurrence >= dt:
+            yield occurrence
+        elif skipped is not None:
+            skipped()
+
+
+def expand(rule, duration, start, end, skipped=None):
+    """Iterate over the occurrences of a recurrence within a period.
+
+    ``duration`` is the timedelta of an occurrence, and ``start`` and
+    ``end`` are naive UTC datetimes or None. Yields ``(occurrence_start,
+    occurrence_end)`` tuples of naive UTC datetimes for every occurrence
+    that ends after ``start`` and starts before or at ``end``. If given,
+    ``skipped`` is called for every occurrence expanded before the period.
+    """
+    if start is not None:
+        start = to_seconds(start)
+    if end is not None:
+        end = to_seconds(end)
+    for occurrence_start, occurrence_end in expand_seconds(
+            rule, _seconds(duration), start, end, skipped):
+        yield from_seconds(occurrence_start), from_seconds(occurrence_end)
+
+
+def expand_seconds(rule, duration, start, end, skipped=None):
+    """Iterate over the occurrences of a recurrence within a period.
+
+    This is ``expand`` with all times in seconds since the epoch: the
+    ``duration``, the ``start`` and ``end`` of the period, which may be
+    None, and the ``(occurrence_start, occurrence_end)`` tuples yielded.
+
+    If the timezone of the rule has a fixed offset, the period is converted
+    to it once, and the occurrences are compared with it as they are, so
+    only the occurrences within the period are converted to UTC.
+    """
+    if start is None:
+        occurrences = rule._iter()
+    else:
+        # Skip straight to the occurrences that can end after the start.
+        occurrences = seek(rule, from_seconds(start - duration), skipped)
+
+    tzinfo = _tzinfo(rule)
+    if tzinfo is not None and fixed_offset(tzinfo) is None:
+        for occurrence in occurrences:
+            occurrence_start = utc_seconds(occurrence)
+            if start is not None and occurrence_start + duration <= start:
+                if skipped is not None:
+                    skipped()
+                continue
+            if end is not None and occurrence_start > end:
+                break
+            yield occurrence_start, occurrence_start + duration
+        return
+
+    # Occurrences starting at or before lo end at or before the start.
+    lo = hi = None
+    if start is not None:
+        lo = local_datetime(start - duration, tzinfo)
+    if end is not None:
+        hi = local_datetime(end, tzinfo)
+    for occurrence in occurrences:
+        if lo is not None and occurrence <= lo:
+            if skipped is not None:
+                skipped()
+            continue
+        if hi is not None and occurrence > hi:
+            break
+        occurrence_start = utc_seconds(occurrence)
+        yield occurrence_start, occurrence_start + duration
+
+
+# Recurrence signatures summarize when the occurrences of a rule can start,
+# as a mask of the hours of a UTC week, starting on Monday, and a mask of the
+# months of the year.
+HOURS_PER_WEEK = 168
+ALL_HOURS = (1 << HOURS_PER_WEEK) - 1
+ALL_MONTHS = (1 << 12) - 1
+
+# The epoch was a Thursday, three days after the start of its week.
+_WEEK_OFFSET = 3 * 86400
+
+
+def rule_signature(rule):
+    """Summarize when the occurrences of a recurrence can start.
+
+    Returns a ``(weekmask, monthmask)`` tuple, where bit ``h`` of the
+    weekmask is set if an occurrence may start in hour ``h`` of a UTC week,
+    and bit ``m - 1`` of the monthmask if it may start in local month
+    ``m``. Occurrences are only known to match the BYDAY, BYMONTH, BYHOUR and
+    BYMINUTE parts of the rule, but as all other parts only restrict them
+    further, this is enough to rule out query periods.
+
+    Returns None for recurrences with RDATEs, whose occurrences aren't
+    described by the rules, and for timezones whose offsets aren't known.
+    """
+    if isinstance(rule, rrule.rruleset):
+        if rule._rdate or not rule._rrule:
+            return None
+        rules = rule._rrule
+    else:
+        rules = [rule]
+
+    weekmask = monthmask = 0
+    for r in rules:
+        weekdays = set(r._byweekday or ())
+        weekdays.update(weekday for weekday, n in r._bynweekday or ())
+        if not weekdays:
+            weekdays = range(7)
+        # The occurrences may have any of the offsets of the timezone.
+        offsets = zone_offsets(r._tzinfo)
+        if offsets is None:
+            return None
+
+        for weekday in weekdays:
+            for hour in r._byhour or range(24):
+                for minute in r._byminute or range(60):
+                    for offset in offsets:
+                        # The seconds of the minute may cross into the next
+                        # hour for timezones with odd offsets:
+                        t = (weekday * 86400 + hour * 3600 + minute * 60 -
+                             offset)
+                        weekmask |= 1 << (t // 3600 % HOURS_PER_WEEK)
+                        weekmask |= 1 << ((t + 59) // 3600 % HOURS_PER_WEEK)
+
+        for month in r._bymonth or range(1, 13):
+            monthmask |= 1 << (month - 1)
+
+    return weekmask, monthmask
+
+
+def period_signature(start, end):
+    """Get the masks of a period, as in ``rule_signature``.
+
+    ``start`` and ``end`` are seconds since the epoch. An occurrence starting
+    within the period has the bits of its hour and month set in these masks.
+    """
+    first = (start + _WEEK_OFFSET) // 3600
+    last = (end + _WEEK_OFFSET) // 3600
+    if last - first >= HOURS_PER_WEEK - 1:
+        weekmask = ALL_HOURS
+    else:
+        weekmask = 0
+        for hour in range(first, last + 1):
+            weekmask |= 1 << (hour % HOURS_PER_WEEK)
+
+    # Local months can differ from the UTC month by the timezone offset:
+    first = from_seconds(start - 86400)
+    last = from_seconds(end + 86400)
+    first = first.year * 12 + first.month - 1
+    last = last.year * 12 + last.month - 1
+    if last - first >= 11:
+        monthmask = ALL_MONTHS
+    else:
+        monthmask = 0
+        for month in range(first, last + 1):
+            monthmask |= 1 << (month % 12)
+
+    return weekmask, monthmask
+
+
+# Cost classes of recurrences, in the order they are expanded by queries.
+COST_SEEKABLE = 0  # Skips ahead to the query period
+COST_EXPANDED = 1  # Expanded from its start
+COST_FINE = 2  # Expanded from its start, hourly or more often
+
+
+def rule_cost(rule):
+    """Classify how expensive a recurrence is to expand.
+
+    Returns one of ``COST_SEEKABLE``, ``COST_EXPANDED`` and ``COST_FINE``.
+    """
+    if isinstance(rule, rrule.rruleset):
+        rules = rule._rrule + rule._exrule
+    else:
+        rules = [rule]
+
+    cost = COST_SEEKABLE
+    for r in rules:
+        if is_seekable(r):
+            continue
+        if r._freq >= rrule.HOURLY:
+            return COST_FINE
+        cost = COST_EXPANDED
+    return cost
+
+
+def rule_step(rule):
+    """Get the seconds between the occurrences of a regular recurrence.
+
+    A recurrence is regular if its occurrences are an arithmetic progression
+    in UTC, starting with its start. This is the case for single rules with
+    a WEEKLY or finer frequency and no BY parts other than those dateutil
+    fills in from the start, in timezones with a fixed offset. Returns None
+    for all other recurrences.
+    """
+    if isinstance(rule, rrule.rruleset):
+        if (rule._rdate or rule._exrule or rule._exdate or
+                len(rule._rrule) != 1):
+            return None
+        rule = rule._rrule[0]
+
+    r = rule
+    if r._freq not in _UNITS:
+        return None
+    if (r._bysetpos or r._bymonth or r._bymonthday or r._bynmonthday or
+            r._byyearday or r._byweekno or r._bynweekday or r._byeaster):
+        return None
+
+    dtstart = r._dtstart
+    tzinfo = dtstart.tzinfo
+    if tzinfo is not None and tzinfo is not UTC and not hasattr(
+            tzinfo, 'localize'):
+        # Only the tzinfos of pytz have a fixed offset for all occurrences.
+        return None
+    if r._freq == rrule.WEEKLY:
+        if tuple(r._byweekday or ()) != (dtstart.weekday(),):
+            return None
+    elif r._byweekday:
+        return None
+
+    times = ((r._byhour, dtstart.hour, rrule.HOURLY),
+             (r._byminute, dtstart.minute, rrule.MINUTELY),
+             (r._bysecond, dtstart.second, rrule.SECONDLY))
+    for by, value, freq in times:
+        if r._freq < freq:
+            if tuple(by or ()) != (value,):
+                return None
+        elif by is not None:
+            return None
+
+    if r._count == 0 or (r._until is not None and r._until < dtstart):
+        return None
+    return _seconds(_UNITS[r._freq]) * r._interval
+
+
+def last_occurrence(rule, limit=None):
+    """Get the last occurrence of a recurrence with a COUNT or an UNTIL.
+
+    The last occurrence of regular recurrences, see ``rule_step``, is
+    computed with arithmetic, and single seekable rules are skipped ahead
+    to their last periods, see ``seek_rule``. Other recurrences are
+    expanded, keeping only the latest occurrence, and raise
+    ``ExpansionBudgetExceeded`` if they have more than ``limit``
+    occurrences. Returns None for recurrences without any occurrences.
+    """
+    r = rule
+    if (isinstance(rule, rrule.rruleset) and len(rule._rrule) == 1 and
+            not (rule._rdate or rule._exrule or rule._exdate)):
+        r = rule._rrule[0]
+    if isinstance(r, rrule.rruleset):
+        return _last_expanded(rule, limit)
+
+    step = rule_step(r)
+    if step is not None:
+        try:
+            return _last_regular(r, step)
+        except OverflowError:
+            # Beyond the year 9999.
+            return _last_expanded(r, limit)
+    if is_seekable(r):
+        if r._until is not None:
+            return _last_before_until(r, limit)
+        if r._count is not None:
+            return _last_counted(r, limit)
+    return _last_expanded(r, limit)
+
+
+def _last_expanded(rule, limit):
+    last = None
+    count = 0
+    for occurrence in rule._iter():
+        count += 1
+        if limit is not None and count > limit:
+            raise ExpansionBudgetExceeded(
+                'The recurrence has more than %s occurrences' % limit)
+        last = occurrence
+    return last
+
+
+def _last_regular(r, step):
+    dtstart = r._dtstart
+    n = None
+    if r._count is not None:
+        n = r._count - 1
+    if r._until is not None:
+        k = _seconds(r._until - dtstart) // step
+        if n is None or k < n:
+            n = k
+    if n is None or n < 0:
+        return None
+    return dtstart + timedelta(seconds=n * step)
+
+
+def _last_before_until(r, limit):
+    # Seek to ever earlier times before the UNTIL, until there are
+    # occurrences between the time and the UNTIL.
+    until = utc_datetime(r._until)
+    dtstart = utc_datetime(r._dtstart)
+    span = _add_periods(r, datetime(2000, 1, 1), 1) - datetime(2000, 1, 1)
+    while until - span > dtstart:
+        last = None
+        for occurrence in seek(r, until - span):
+            last = occurrence
+        if last is not None:
+            return last
+        span *= 2
+    return _last_expanded(r, limit)
+
+
+def _last_counted(r, limit):
+    # Seekable rules have the same number of occurrences in every period
+    # but the first, so the period of the last occurrence can be computed.
+    first = _period_start(r, r._dtstart.replace(tzinfo=None))
+    try:
+        second = _add_periods(r, first, 1).replace(tzinfo=r._tzinfo)
+    except (ValueError, OverflowError):
+        return _last_expanded(r, limit)
+    consumed = 0
+    for occurrence in r._iter():
+        if occurrence >= second or consumed == r._count:
+            break
+        consumed += 1
+    remaining = r._count - consumed
+    if remaining <= 0:
+        return _last_expanded(r, limit)
+
+    per_period = occurrences_per_period(r)
+    k = (remaining + per_period - 1) // per_period
+    try:
+        period = _add_periods(r, first, k)
+    except (ValueError, OverflowError):
+        return _last_expanded(r, limit)
+    # The UTC time of the period is at least its wall clock time minus the
+    # largest offset of the timezone.
+    offsets = zone_offsets(r._tzinfo)
+    if offsets is None:
+        return _last_expanded(r, limit)
+    period -= timedelta(seconds=offsets[-1])
+    shifted = seek_rule(r, period)
+    if shifted is None:
+        return None
+    last = None
+    for occurrence in shifted._iter():
+        last = occurrence
+    return last
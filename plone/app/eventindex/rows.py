@@ -0,0 +1,38 @@
+from BTrees.IIBTree import IITreeSet
+
+
+def _keys(state):
+    """Get the documentIds of the state of a row held in a single bucket.
+
+    Returns None for the states of larger rows, which refer to buckets
+    stored as objects of their own.
+    """
+    if state is None:
+        return set()
+    if (len(state) == 1 and len(state[0]) == 1 and
+            isinstance(state[0][0], tuple)):
+        return set(state[0][0][0])
+    return None
+
+
+class Row(IITreeSet):
+    """A set of documentIds, whose concurrent changes don't conflict.
+
+    The rows of the trees keyed on times are changed by every transaction
+    indexing an event at that time. ZODB can resolve the conflicts of such
+    changes to a set, except when one of the transactions removes its
+    smallest documentId. Rows solve this with a three way merge: the
+    documentIds added by either transaction are added, and those removed by
+    either are removed. This works for rows small enough to be stored in a
+    single bucket, conflicts of larger rows are resolved by their buckets.
+    """
+
+    def _p_resolveConflict(self, old, committed, new):
+        states = [_keys(state) for state in (old, committed, new)]
+        if None in states:
+            return IITreeSet._p_resolveConflict(self, old, committed, new)
+        old, committed, new = states
+        result = (committed - (old - new)) | (new - old)
+        if not result:
+            return None
+        return (((tuple(sorted(result)),),),)
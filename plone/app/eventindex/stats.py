@@ -0,0 +1,238 @@
+"""Statistics of the queries of event indexes.
+
+Every query of an index records a ``QueryStats``, with the sizes of the
+range scans, the number of candidates and of recurring candidates, the
+occurrences iterated while expanding recurrences and the time taken by each
+phase of the query. The records are logged at the DEBUG level of the
+``plone.app.eventindex.stats`` logger, passed to the functions in ``hooks``
+and aggregated per index and per process into ``Statistics``, which are
+shown on the Statistics tab of the index in the ZMI. The statistics also
+count the reindexes that were skipped because nothing changed, and how
+often the expansion of each document went over the budget.
+"""
+from collections import deque
+from heapq import nlargest
+from operator import itemgetter
+from time import time
+
+import logging
+import threading
+
+
+logger = logging.getLogger('plone.app.eventindex.stats')
+
+# Functions called with the index and the QueryStats of every query.
+hooks = []
+
+# The number of most expensive documents kept for a query.
+TOP_COSTS = 10
+
+_statistics = {}
+_lock = threading.Lock()
+
+
+class QueryStats(object):
+    """The counters of a single query.
+
+    ``start`` and ``end`` are the query period, as naive UTC datetimes or
+    None, and ``limit`` the number of occurrences asked for, if any.
+    """
+
+    def __init__(self, start=None, end=None, limit=None):
+        self.start = start
+        self.end = end
+        self.limit = limit
+        self.scans = {}  # Keys counted in the range scans, by tree
+        self.candidates = 0
+        self.recurring = 0
+        self.rejected = 0
+        self.materialized = 0
+        self.regular = 0
+        self.expanded = 0
+        self.occurrences = 0
+        self.over_budget = 0
+        self.results = 0
+        self.exit = None  # Why the query was answered early, if it was
+        self.costs = {}  # Occurrences iterated, by documentId
+        self.phases = {}
+        self.elapsed = 0.0
+        self._started = self._mark = time()
+
+    def phase(self, name):
+        """Count the time since the end of the previous phase for ``name``.
+        """
+        now = time()
+        self.phases[name] = self.phases.get(name, 0.0) + now - self._mark
+        self._mark = now
+
+    def cost(self, documentId, occurrences):
+        """Count the occurrences iterated for the recurrence of a document.
+        """
+        self.occurrences += occurrences
+        self.costs[documentId] = self.costs.get(documentId, 0) + occurrences
+
+    def finish(self, results):
+        self.results = results
+        self.elapsed = time() - self._started
+
+    def top_costs(self, count=TOP_COSTS):
+        """Get the (documentId, occurrences) pairs of the most expensive
+        recurrences, the most expensive first."""
+        return nlargest(count, self.costs.items(), key=itemgetter(1))
+
+    def as_dict(self):
+        return {
+            'start': self.start,
+            'end': self.end,
+            'limit': self.limit,
+            'scans': dict(self.scans),
+            'candidates': self.candidates,
+            'recurring': self.recurring,
+            'rejected': self.rejected,
+            'materialized': self.materialized,
+            'regular': self.regular,
+            'expanded': self.expanded,
+            'occurrences': self.occurrences,
+            'over_budget': self.over_budget,
+            'results': self.results,
+            'exit': self.exit,
+            'phases': dict(self.phases),
+            'elapsed': self.elapsed,
+            'top_costs': self.top_costs(),
+        }
+
+    def __repr__(self):
+        return ('<QueryStats %s - %s: %s candidates, %s recurring, '
+                '%s occurrences, %s results in %.3fs>' % (
+                    self.start, self.end, self.candidates, self.recurring,
+                    self.occurrences, self.results, self.elapsed))
+
+
+class Statistics(object):
+    """The statistics of the queries of an index in this process.
+
+    The queries taking at least the slow query threshold of the index are
+    kept in the slow query log, which holds the last ``slow_log_size`` of
+    them.
+    """
+
+    slow_log_size = 50
+
+    # The counters of QueryStats that are summed up.
+    totals = ('candidates', 'recurring', 'rejected', 'materialized',
+              'regular', 'expanded', 'occurrences', 'over_budget',
+              'results')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.skipped = 0
+        self.queries = 0
+        self.elapsed = 0.0
+        self.max_elapsed = 0.0
+        self.counters = dict.fromkeys(self.totals, 0)
+        self.scans = {}
+        self.phases = {}
+        self.exits = {}
+        self.slow = deque(maxlen=self.slow_log_size)
+        self.exceeded = {}  # Times over the expansion budget, by documentId
+
+    def record(self, stats, slow=False):
+        """Add the counters of a query."""
+        self._lock.acquire()
+        try:
+            self.queries += 1
+            self.elapsed += stats.elapsed
+            self.max_elapsed = max(self.max_elapsed, stats.elapsed)
+            for name in self.totals:
+                self.counters[name] += getattr(stats, name)
+            for name, count in stats.scans.items():
+                self.scans[name] = self.scans.get(name, 0) + count
+            for name, elapsed in stats.phases.items():
+                self.phases[name] = self.phases.get(name, 0.0) + elapsed
+            if stats.exit is not None:
+                self.exits[stats.exit] = self.exits.get(stats.exit, 0) + 1
+            if slow:
+                self.slow.appendleft(stats.as_dict())
+        finally:
+            self._lock.release()
+
+    def unchanged(self):
+        """Count a reindex skipped because the values didn't change."""
+        self._lock.acquire()
+        try:
+            self.skipped += 1
+        finally:
+            self._lock.release()
+
+    def over_budget(self, documentId):
+        """Count an expansion of a document that went over the budget.
+
+        Returns the number of times the document went over the budget.
+        """
+        self._lock.acquire()
+        try:
+            count = self.exceeded[documentId] = self.exceeded.get(
+                documentId, 0) + 1
+            return count
+        finally:
+            self._lock.release()
+
+    def summary(self):
+        """Get the statistics as a dictionary, for display."""
+        self._lock.acquire()
+        try:
+            queries = self.queries or 1
+            return {
+                'unchanged': self.skipped,
+                'queries': self.queries,
+                'elapsed': self.elapsed,
+                'mean_elapsed': self.elapsed / queries,
+                'max_elapsed': self.max_elapsed,
+                'counters': sorted(
+                    (name, total, float(total) / queries)
+                    for name, total in self.counters.items()),
+                'scans': sorted(self.scans.items()),
+                'phases': sorted(self.phases.items()),
+                'exits': sorted(self.exits.items()),
+                'slow': list(self.slow),
+                'over_budget': nlargest(TOP_COSTS, self.exceeded.items(),
+                                        key=itemgetter(1)),
+            }
+        finally:
+            self._lock.release()
+
+
+def get_statistics(key):
+    """Get the statistics of the index identified by ``key``."""
+    _lock.acquire()
+    try:
+        statistics = _statistics.get(key)
+        if statistics is None:
+            statistics = _statistics[key] = Statistics()
+        return statistics
+    finally:
+        _lock.release()
+
+
+def report(index, statistics, stats, threshold=None):
+    """Report the counters of a finished query of an index.
+
+    The counters are added to ``statistics``, the ``Statistics`` of the
+    index. Queries taking at least ``threshold`` seconds are logged as
+    warnings and added to the slow query log.
+    """
+    slow = threshold is not None and stats.elapsed >= threshold
+    statistics.record(stats, slow)
+    if slow:
+        logger.warning(
+            '%s: slow query from %s to %s took %.3fs, %s candidates, '
+            '%s occurrences, most expensive documents %s' % (
+                index.getId(), stats.start, stats.end, stats.elapsed,
+                stats.candidates, stats.occurrences, stats.top_costs()))
+    elif logger.isEnabledFor(logging.DEBUG):
+        logger.debug('%s: %r' % (index.getId(), stats))
+    for hook in hooks:
+        hook(index, stats)
@@ -1,8 +1,17 @@
+from BTrees.IIBTree import IITreeSet
+from BTrees.IIBTree import intersection
 from DateTime import DateTime
 from datetime import datetime
+from datetime import timedelta
 from plone.app.eventindex import EventIndex
+from plone.app.eventindex import INDEX_VERSION
+from plone.app.eventindex import OPEN_END
+from plone.app.eventindex import UpgradeRequired
+from plone.app.eventindex import to_seconds
 from pytz import timezone
+from random import Random
 
+import mock
 import unittest2 as unittest
 
 
@@ -37,8 +46,11 @@ class EventIndexTests(unittest.TestCase):
         for uid, ob in test_objects.items():
             index.index_object(uid, ob)
 
+        # Not applicable to queries without the index:
+        self.assertEqual(index._apply_index({}), None)
+
         # Return all
-        res = index._apply_index({})
+        res = index._apply_index({'event': {}})
         self.assertEqual(len(res[0]), 5)
 
         # Return one
@@ -89,7 +101,7 @@ class EventIndexTests(unittest.TestCase):
             index.index_object(uid, ob)
 
         # Return all
-        res = index._apply_index({})
+        res = index._apply_index({'event': {}})
         self.assertEqual(len(res[0]), 5)
 
         # Return one
@@ -145,7 +157,7 @@ class EventIndexTests(unittest.TestCase):
             index.index_object(uid, ob)
 
         # Return all
-        res = index._apply_index({})
+        res = index._apply_index({'event': {}})
         self.assertEqual(len(res[0]), 5)
 
         # Return one
@@ -199,12 +211,19 @@ class EventIndexTests(unittest.TestCase):
             index.unindex_object(uid)
 
         # Make sure all indexes are clean (yes, this tests internal state)
+        self.assertEqual(index.numObjects(), 0)
+        # The empty rows are kept until they are pruned:
+        self.assertFalse([row for row in index._end2uid.values() if row])
+        self.assertEqual(index.prune_rows(), 14)
         self.assertEqual(len(index._end2uid), 0)
         self.assertEqual(len(index._start2uid), 0)
         self.assertEqual(len(index._uid2duration), 0)
         self.assertEqual(len(index._uid2end), 0)
         self.assertEqual(len(index._uid2recurrence), 0)
         self.assertEqual(len(index._uid2start), 0)
+        for buckets in index._grid.values():
+            self.assertEqual(len(buckets), 0)
+        self.assertEqual(len(index._grid_overflow), 0)
 
     def test_basic_recurrence(self):
         test_objects = {
@@ -216,7 +235,7 @@ class EventIndexTests(unittest.TestCase):
             index.index_object(uid, ob)
 
         # Return all
-        res = index._apply_index({})
+        res = index._apply_index({'event': {}})
         self.assertTrue(1 in res[0])
 
         # Return one
@@ -439,3 +458,1147 @@ class EventIndexTests(unittest.TestCase):
             }
         })
         self.assertEqual(len(res[0]), 0)
+
+    def test_recurrence_between_occurrences(self):
+        index = EventIndex('event')
+        index.index_object(1, TestOb(
+            name='a',
+            start=datetime(2011, 4, 5, 12, 0),
+            end=datetime(2011, 4, 5, 13, 0),
+            recurrence='RRULE:FREQ=DAILY;INTERVAL=10;COUNT=5'))
+
+        # The period falls between the occurrences on the 15th and the 25th:
+        res = index._apply_index({'event': {'start': datetime(2011, 4, 20, 12, 0),
+                                            'end': datetime(2011, 4, 20, 13, 0)}})
+        self.assertEqual(len(res[0]), 0)
+
+        # An occurrence ending exactly at the start of the period is excluded:
+        res = index._apply_index({'event': {'start': datetime(2011, 4, 15, 13, 0),
+                                            'end': datetime(2011, 4, 15, 14, 0)}})
+        self.assertEqual(len(res[0]), 0)
+
+    def test_occurrences(self):
+        helsinki = timezone('Europe/Helsinki')
+        index = EventIndex('event')
+        index.index_object(1, TestOb(
+            name='a',
+            start=datetime(2011, 4, 5, 12, 0),
+            end=datetime(2011, 4, 5, 13, 0),
+            recurrence='RRULE:FREQ=DAILY;INTERVAL=10;COUNT=5'))
+        index.index_object(2, TestOb(
+            name='b',
+            start=helsinki.localize(datetime(2011, 4, 16, 10, 0)),
+            end=helsinki.localize(datetime(2011, 4, 16, 11, 0)),
+            recurrence=None))
+        index.index_object(3, TestOb(
+            name='c',
+            start=datetime(2011, 4, 1, 9, 0),
+            end=datetime(2011, 4, 1, 10, 0),
+            recurrence='RRULE:FREQ=WEEKLY'))
+
+        res = list(index.occurrences(DateTime('2011/4/14 00:00 UTC'),
+                                     datetime(2011, 4, 26, 0, 0)))
+        self.assertEqual(sorted(res), [
+            (1, datetime(2011, 4, 15, 12, 0), datetime(2011, 4, 15, 13, 0)),
+            (1, datetime(2011, 4, 25, 12, 0), datetime(2011, 4, 25, 13, 0)),
+            (2, datetime(2011, 4, 16, 7, 0), datetime(2011, 4, 16, 8, 0)),
+            (3, datetime(2011, 4, 15, 9, 0), datetime(2011, 4, 15, 10, 0)),
+            (3, datetime(2011, 4, 22, 9, 0), datetime(2011, 4, 22, 10, 0)),
+        ])
+
+        # Limited to a resultset:
+        res = list(index.occurrences(None, datetime(2011, 4, 10, 0, 0),
+                                     resultset=IITreeSet([1, 2])))
+        self.assertEqual(res, [
+            (1, datetime(2011, 4, 5, 12, 0), datetime(2011, 4, 5, 13, 0)),
+        ])
+
+        # The generator is lazy, so open ended recurrences need an end:
+        self.assertRaises(ValueError, list,
+                          index.occurrences(datetime(2011, 4, 1), None))
+
+    def test_materialization(self):
+        helsinki = timezone('Europe/Helsinki')
+        test_objects = {
+            1: TestOb('a', datetime(2011, 4, 5, 12, 0), datetime(2011, 4, 5, 13, 0),
+                      'RRULE:FREQ=DAILY;INTERVAL=10;COUNT=5'),
+            2: TestOb('b', helsinki.localize(datetime(2011, 1, 4, 10, 0)),
+                      helsinki.localize(datetime(2011, 1, 4, 11, 0)),
+                      'RRULE:FREQ=WEEKLY;BYDAY=TU,TH'),
+            3: TestOb('c', datetime(2011, 4, 6, 12, 0), datetime(2011, 4, 6, 13, 0), None),
+            4: TestOb('d', datetime(2011, 4, 1, 22, 0), datetime(2011, 4, 2, 2, 0),
+                      'RRULE:FREQ=WEEKLY'),
+        }
+        windows = [
+            (datetime(2011, 4, 5, 12, 0), datetime(2011, 4, 5, 13, 0)),
+            (datetime(2011, 4, 20, 12, 0), datetime(2011, 4, 20, 13, 0)),
+            (datetime(2011, 4, 9, 1, 0), datetime(2011, 4, 9, 1, 30)),
+            (datetime(2011, 4, 9, 2, 0), datetime(2011, 4, 9, 3, 0)),
+            (datetime(2011, 4, 1, 0, 0), datetime(2011, 5, 1, 0, 0)),
+            (datetime(2011, 5, 10, 0, 0), datetime(2011, 5, 11, 0, 0)),
+            (datetime(2011, 5, 12, 0, 0), datetime(2011, 5, 13, 0, 0)),
+        ]
+
+        live = EventIndex('event')
+        index = EventIndex('event')
+        for uid, ob in test_objects.items():
+            live.index_object(uid, ob)
+            index.index_object(uid, ob)
+        index.enable_materialization(before=30, after=60,
+                                     now=datetime(2011, 4, 15))
+
+        for start, end in windows:
+            query = {'event': {'start': start, 'end': end}}
+            self.assertTrue(index._materialized(start, end) is not None)
+            self.assertEqual(list(index._apply_index(query)[0]),
+                             list(live._apply_index(query)[0]))
+
+        # Outside of the horizon the recurrences are expanded:
+        start, end = datetime(2011, 8, 2, 0, 0), datetime(2011, 8, 3, 0, 0)
+        self.assertTrue(index._materialized(start, end) is None)
+        res = index._apply_index({'event': {'start': start, 'end': end}})
+        self.assertEqual(list(res[0]), [2])
+
+        # Moving the horizon forward covers it:
+        index.update_horizon(now=datetime(2011, 7, 15))
+        self.assertTrue(index._materialized(start, end) is not None)
+        res = index._apply_index({'event': {'start': start, 'end': end}})
+        self.assertEqual(list(res[0]), [2])
+        self.assertTrue(index._occurrence2uid.minKey() >=
+                        to_seconds(datetime(2011, 6, 15)))
+
+        # Unindexing removes the stored occurrences:
+        for uid in test_objects:
+            index.unindex_object(uid)
+        self.assertFalse([row for row in index._occurrence2uid.values()
+                          if row])
+        index.prune_rows()
+        self.assertEqual(len(index._occurrence2uid), 0)
+
+    def test_materialization_budget(self):
+        index = EventIndex('event')
+        index.max_occurrences = 1000
+        index.enable_materialization(before=1, after=30,
+                                     now=datetime(2011, 4, 15))
+        # Every minute, far more occurrences than the budget:
+        index.index_object(1, TestOb('a', datetime(2011, 4, 1, 12, 0),
+                                     datetime(2011, 4, 1, 12, 0, 30),
+                                     'RRULE:FREQ=MINUTELY'))
+        # Daily, which is stored:
+        index.index_object(2, TestOb('b', datetime(2011, 4, 1, 12, 0),
+                                     datetime(2011, 4, 1, 13, 0),
+                                     'RRULE:FREQ=DAILY'))
+        self.assertEqual(list(index._unmaterialized), [1])
+        self.assertEqual(
+            set(index._occurrence2uid.values()[0]), set([2]))
+        self.assertEqual(len(index._occurrence2uid), 31)
+
+        # The queries expand it instead:
+        start, end = datetime(2011, 4, 20, 9, 0), datetime(2011, 4, 20, 9, 1)
+        self.assertTrue(index._materialized(start, end) is not None)
+        res = index._apply_index({'event': {'start': start, 'end': end}})
+        self.assertEqual(list(res[0]), [1])
+
+        # A recurrence going over the budget when the horizon moves drops
+        # its stored occurrences:
+        index.max_occurrences = 10
+        index.update_horizon(now=datetime(2011, 5, 1))
+        self.assertEqual(list(index._unmaterialized), [1, 2])
+        self.assertFalse([row for row in index._occurrence2uid.values()
+                          if row])
+        for start, end in [
+                (datetime(2011, 5, 1, 12, 0), datetime(2011, 5, 1, 12, 1)),
+                (datetime(2011, 5, 20, 12, 0), datetime(2011, 5, 20, 12, 1))]:
+            self.assertTrue(index._materialized(start, end) is not None)
+            res = index._apply_index({'event': {'start': start, 'end': end}})
+            self.assertEqual(list(res[0]), [1, 2])
+
+        index.unindex_object(1)
+        index.unindex_object(2)
+        self.assertEqual(len(index._unmaterialized), 0)
+
+    def test_resultset_pushdown(self):
+        index = EventIndex('event')
+        for uid in range(1, 101):
+            start = datetime(2011, 4, 1 + uid % 28, uid % 24, 0)
+            if uid % 3:
+                recurrence = None
+            else:
+                recurrence = 'RRULE:FREQ=WEEKLY;INTERVAL=%s' % (uid % 5 + 1)
+            index.index_object(uid, TestOb(
+                'a', start, start + timedelta(hours=2), recurrence))
+
+        queries = [
+            {'start': datetime(2011, 4, 10), 'end': datetime(2011, 4, 11)},
+            {'start': datetime(2011, 4, 27)},
+            {'end': datetime(2011, 4, 3)},
+            {'start': datetime(2011, 5, 20), 'end': datetime(2011, 5, 27)},
+        ]
+        resultsets = [
+            IITreeSet(),
+            IITreeSet([3, 4, 30]),
+            IITreeSet(range(1, 101, 2)),
+            IITreeSet(range(1, 101)),
+        ]
+        for query in queries:
+            everything = index._apply_index({'event': query})[0]
+            for resultset in resultsets:
+                res = index._apply_index({'event': query}, resultset)
+                self.assertEqual(list(res[0]),
+                                 list(intersection(everything, resultset)))
+
+        # Recurrences are only checked for events in the resultset:
+        query = {'event': {'start': datetime(2011, 5, 20),
+                           'end': datetime(2011, 5, 27)}}
+        with mock.patch.object(index, '_filter_regular',
+                               wraps=index._filter_regular) as regular:
+            index._apply_index(query, IITreeSet([3, 4, 5, 6]))
+        self.assertEqual(regular.call_args[0][0], [3, 6])
+
+    def test_count_keys(self):
+        from plone.app.eventindex import count_keys
+        small = IITreeSet(range(3))
+        large = IITreeSet(range(100))
+        self.assertEqual(count_keys([large, small]), ([4, 3], 1))
+        self.assertEqual(count_keys([small, large]), ([3, 3], 0))
+        self.assertEqual(count_keys([large], 10), ([10], None))
+        self.assertEqual(count_keys([small], 0), ([0], None))
+
+    def test_interval_grid(self):
+        random = Random(42)
+        events = {}
+        for uid in range(1, 301):
+            start = datetime(2011, 1, 1) + timedelta(
+                minutes=random.randint(0, 60 * 24 * 365))
+            length = random.choice([0, 30, 60, 61, 60 * 24, 60 * 24 * 40,
+                                    random.randint(0, 60 * 24 * 3000)])
+            events[uid] = TestOb('a', start, start + timedelta(minutes=length),
+                                 None)
+        events[301] = TestOb('b', datetime(2011, 5, 1), datetime(2011, 5, 2),
+                             'RRULE:FREQ=WEEKLY')
+
+        index = EventIndex('event')
+        legacy = EventIndex('event')
+        legacy._grid = legacy._grid_overflow = None
+        for uid, ob in events.items():
+            index.index_object(uid, ob)
+            legacy.index_object(uid, ob)
+        self.assertTrue(301 in index._grid_overflow)
+
+        def expected(start, end):
+            result = []
+            for uid, ob in sorted(events.items()):
+                if ob.recurrence:
+                    if end is None or ob.start <= end:
+                        result.append(uid)
+                elif ((start is None or ob.end > start) and
+                      (end is None or ob.start <= end)):
+                    result.append(uid)
+            return result
+
+        windows = [(None, datetime(2011, 2, 1)), (datetime(2011, 11, 1), None)]
+        for i in range(50):
+            start = datetime(2011, 1, 1) + timedelta(
+                minutes=random.randint(0, 60 * 24 * 400))
+            windows.append((start, start + timedelta(
+                minutes=random.choice([0, 59, 60, 60 * 24, 60 * 24 * 30]))))
+        # Windows starting or ending exactly on an event:
+        windows.append((events[1].end, events[2].start))
+        windows.append((events[3].start, events[3].start))
+
+        for start, end in windows:
+            for idx in (index, legacy):
+                result, used_fields = idx._search(start, end)
+                self.assertEqual(list(result), expected(start, end))
+
+        # Indexes from before the grid existed can be migrated:
+        legacy.build_grid()
+        self.assertEqual(list(legacy._grid_overflow),
+                         list(index._grid_overflow))
+        for level, buckets in index._grid.items():
+            self.assertEqual(
+                [(key, list(row)) for key, row in buckets.items()],
+                [(key, list(row)) for key, row in legacy._grid[level].items()])
+
+    def test_upgrade_epoch_keys(self):
+        from BTrees.IOBTree import IOBTree
+        from BTrees.OOBTree import OOBTree
+        from Products.ZCatalog.ZCatalog import ZCatalog
+        from dateutil import rrule
+        from plone.app.eventindex.upgrade import upgrade_catalog
+
+        # Build an index with the data structures of version 0, which used
+        # UTC time tuples as keys and None for open ended events.
+        catalog = ZCatalog('catalog')
+        catalog.addIndex('event', EventIndex('event'))
+        index = catalog._catalog.indexes['event']
+        del index._version
+        index._grid = index._grid_overflow = None
+        index._start2uid = OOBTree()
+        index._end2uid = OOBTree()
+        index._uid2start = IOBTree()
+        index._uid2end = IOBTree()
+        index._uid2duration = IOBTree()
+        start = datetime(2011, 4, 5, 12, 0)
+        entries = [
+            (1, start, start + timedelta(hours=1), None),
+            (2, start + timedelta(days=1), start + timedelta(days=1, hours=2),
+             None),
+            (3, start, None, rrule.rrulestr('RRULE:FREQ=WEEKLY', dtstart=start)),
+        ]
+        for documentId, start_value, end_value, rule in entries:
+            start_value = start_value.utctimetuple()
+            if end_value is not None:
+                end_value = end_value.utctimetuple()
+            index._start2uid.setdefault(start_value, IITreeSet()).insert(
+                documentId)
+            index._end2uid.setdefault(end_value, IITreeSet()).insert(
+                documentId)
+            index._uid2start[documentId] = start_value
+            index._uid2end[documentId] = end_value
+            index._uid2duration[documentId] = timedelta(hours=documentId)
+            index._uid2recurrence[documentId] = rule
+
+        # Queries and indexing don't upgrade the index, but fail until it
+        # is upgraded:
+        query = {'event': {'start': datetime(2011, 4, 6, 13, 0),
+                           'end': datetime(2011, 4, 12, 12, 30)}}
+        self.assertTrue(index.needsUpgrade())
+        self.assertRaises(UpgradeRequired, index._apply_index, query)
+        self.assertRaises(UpgradeRequired, index.index_object, 4,
+                          TestOb('d', start, start, None))
+        self.assertRaises(UpgradeRequired, index.unindex_object, 1)
+        self.assertEqual(index.numObjects(), 3)
+        self.assertEqual(index._version, 0)
+
+        self.assertEqual(upgrade_catalog(catalog, commit=False), ['event'])
+        self.assertEqual(upgrade_catalog(catalog, commit=False), [])
+        self.assertFalse(index.needsUpgrade())
+        self.assertEqual(index._version, INDEX_VERSION)
+        res = index._apply_index(query)
+        self.assertEqual(list(res[0]), [2, 3])
+        self.assertEqual(index.numObjects(), 3)
+        self.assertEqual(index._uid2recurrence[3], (
+            'RRULE:FREQ=WEEKLY;INTERVAL=1;WKST=MO;BYDAY=TU;'
+            'BYHOUR=12;BYMINUTE=0;BYSECOND=0', to_seconds(start), None))
+        self.assertEqual(index.getEntryForObject(1), {
+            'start': to_seconds(start),
+            'end': to_seconds(start) + 3600,
+            'recurrence': None,
+            'duration': 3600,
+        })
+        self.assertEqual(list(index._end2uid.keys()),
+                         [to_seconds(start) + 3600,
+                          to_seconds(start) + 86400 + 7200,
+                          OPEN_END])
+        # The index has no grid until it is built:
+        self.assertEqual(index._grid, None)
+        index.build_grid()
+        self.assertEqual(list(index._grid_overflow), [3])
+        self.assertEqual(list(index._apply_index(query)[0]), [2, 3])
+
+        # Reindexing works on the upgraded index:
+        index.index_object(1, TestOb('a', start + timedelta(days=2),
+                                     start + timedelta(days=2, hours=1), None))
+        res = index._apply_index({'event': {'start': datetime(2011, 4, 7),
+                                            'end': datetime(2011, 4, 8)}})
+        self.assertEqual(list(res[0]), [1])
+
+    def test_compact_rule_storage(self):
+        from dateutil import rrule
+        from dateutil.tz import tzoffset
+        helsinki = timezone('Europe/Helsinki')
+        start = helsinki.localize(datetime(2011, 10, 3, 15, 40))
+        index = EventIndex('event')
+        index.index_object(1, TestOb('a', start, start + timedelta(hours=1),
+                                     'RRULE:FREQ=DAILY;COUNT=5\r\n'))
+        index.index_object(2, TestOb('b', start, start + timedelta(hours=1),
+                                     rrule.rrule(rrule.WEEKLY, dtstart=start)))
+        index.index_object(3, TestOb('c', start, start + timedelta(hours=1),
+                                     None))
+        other = datetime(2011, 10, 3, 15, 40, tzinfo=tzoffset('X', 7200))
+        index.index_object(4, TestOb('d', other, other + timedelta(hours=1),
+                                     'RRULE:FREQ=DAILY;COUNT=5'))
+
+        self.assertEqual(index._uid2recurrence[1],
+                         ('RRULE:FREQ=DAILY;COUNT=5', to_seconds(start),
+                          'Europe/Helsinki'))
+        self.assertEqual(index._uid2recurrence[2][1:],
+                         (to_seconds(start), 'Europe/Helsinki'))
+        self.assertEqual(index._uid2recurrence[3], None)
+        # Timezones that aren't from pytz can't be stored compactly:
+        self.assertTrue(isinstance(index._uid2recurrence[4], rrule.rrule))
+
+        rule = index.getEntryForObject(1)['recurrence']
+        self.assertEqual(list(rule), [start + timedelta(days=i)
+                                      for i in range(5)])
+
+    def test_index_objects(self):
+        random = Random(8)
+        events = {}
+        for uid in range(1, 201):
+            start = datetime(2011, 1, 1) + timedelta(
+                minutes=random.randint(0, 60 * 24 * 365))
+            length = random.choice([0, 60, 60 * 24, 60 * 24 * 5000])
+            recurrence = random.choice([None, None, 'RRULE:FREQ=DAILY;COUNT=3',
+                                        'RRULE:FREQ=WEEKLY'])
+            events[uid] = TestOb('a', start, start + timedelta(minutes=length),
+                                 recurrence)
+        events[201] = TestOb('b', None, None, None)
+
+        def dump(index):
+            result = {}
+            for name in ('_start2uid', '_end2uid', '_occurrence2uid'):
+                result[name] = [(key, list(row)) for key, row in
+                                getattr(index, name).items()]
+            for name in ('_uid2start', '_uid2end', '_uid2duration',
+                         '_uid2recurrence'):
+                result[name] = list(getattr(index, name).items())
+            result['_grid'] = [(level, [(key, list(row)) for key, row in
+                                        buckets.items()])
+                               for level, buckets in index._grid.items()]
+            result['_grid_overflow'] = list(index._grid_overflow)
+            result['_signature2uid'] = [(key, list(row)) for key, row in
+                                        index._signature2uid.items()]
+            result['_uid2signature'] = list(index._uid2signature.items())
+            return result
+
+        now = datetime(2011, 6, 1)
+        expected = EventIndex('event')
+        expected.enable_materialization(now=now)
+        for uid, ob in sorted(events.items()):
+            expected.index_object(uid, ob)
+
+        # Building an empty index:
+        index = EventIndex('event')
+        index.enable_materialization(now=now)
+        self.assertEqual(index.index_objects(events.items()), 200)
+        self.assertEqual(dump(index), dump(expected))
+
+        # Reindexing some of the events of an existing index:
+        for uid in range(1, 201, 3):
+            events[uid] = TestOb('c', events[uid].start + timedelta(days=1),
+                                 events[uid].end + timedelta(days=1),
+                                 events[uid].recurrence)
+            expected.index_object(uid, events[uid])
+        events[2] = TestOb('d', None, None, None)
+        expected.index_object(2, events[2])
+        self.assertEqual(index.index_objects(
+            [(uid, events[uid]) for uid in range(200, 0, -1)
+             if uid % 3 == 1 or uid == 2]), 67)
+        self.assertEqual(dump(index), dump(expected))
+
+    def test_signatures(self):
+        helsinki = timezone('Europe/Helsinki')
+        random = Random(9)
+        rules = ['RRULE:FREQ=WEEKLY;BYDAY=TU',
+                 'RRULE:FREQ=WEEKLY;BYDAY=MO,WE,FR;BYHOUR=8,20',
+                 'RRULE:FREQ=DAILY;BYMONTH=7,8',
+                 'RRULE:FREQ=MONTHLY;BYDAY=-1SA',
+                 'RRULE:FREQ=WEEKLY;INTERVAL=2;BYDAY=SU',
+                 'RRULE:FREQ=DAILY;BYHOUR=6,18;BYMINUTE=0,30',
+                 'RRULE:FREQ=YEARLY\r\nRDATE:20120101T000000']
+        events = {}
+        for uid in range(1, 101):
+            start = datetime(2011, 1, 1) + timedelta(
+                minutes=random.randint(0, 60 * 24 * 365))
+            if random.random() < 0.5:
+                start = helsinki.localize(start)
+            length = random.choice([0, 30, 60 * 5, 60 * 24 * 3])
+            events[uid] = TestOb('a', start, start + timedelta(minutes=length),
+                                 random.choice(rules))
+
+        index = EventIndex('event')
+        for uid, ob in events.items():
+            index.index_object(uid, ob)
+        # Rules with RDATEs have no signature:
+        self.assertTrue(len(index._uid2signature) < 100)
+        self.assertTrue(len(index._signature2uid) > 10)
+        plain = EventIndex('event')
+        for uid, ob in events.items():
+            plain.index_object(uid, ob)
+        plain._signature2uid.clear()
+
+        for i in range(100):
+            start = datetime(2011, 6, 1) + timedelta(
+                minutes=random.randint(0, 60 * 24 * 500))
+            end = start + timedelta(
+                minutes=random.choice([0, 59, 60 * 7, 60 * 24, 60 * 24 * 40]))
+            request = {'event': {'start': start, 'end': end}}
+            self.assertEqual(list(index._apply_index(request)[0]),
+                             list(plain._apply_index(request)[0]))
+
+        # A Saturday doesn't need to look at any of the weekly Tuesday rules:
+        index = EventIndex('event')
+        for uid in range(10):
+            start = datetime(2011, 1, 4, 10) + timedelta(minutes=uid)
+            index.index_object(uid, TestOb('a', start,
+                                           start + timedelta(hours=1),
+                                           'RRULE:FREQ=WEEKLY;BYDAY=TU'))
+        self.assertEqual(len(index._signature2uid), 1)
+        with mock.patch.object(index, '_iter_occurrence_seconds') as \
+                iter_occurrences:
+            result, used_fields = index._apply_index(
+                {'event': {'start': datetime(2012, 3, 3),
+                           'end': datetime(2012, 3, 3, 23, 59)}})
+        self.assertEqual(list(result), [])
+        self.assertFalse(iter_occurrences.called)
+
+    def test_expansion_budget(self):
+        from plone.app.eventindex import ExpansionBudgetExceeded
+        from plone.app.eventindex.recurrence import COST_EXPANDED
+        from plone.app.eventindex.recurrence import COST_SEEKABLE
+        index = EventIndex('event')
+        start = datetime(2000, 1, 3, 10)
+        end = datetime(2000, 1, 3, 11)
+        # The last Monday of every month can't be skipped ahead:
+        index.index_object(1, TestOb('a', start, end,
+                                     'RRULE:FREQ=MONTHLY;BYDAY=MO;BYSETPOS=-1'))
+        index.index_object(2, TestOb('b', start, end, 'RRULE:FREQ=DAILY'))
+        index.index_object(3, TestOb('c', start, end, None))
+        self.assertEqual(list(index._uid2cost.items()),
+                         [(1, COST_EXPANDED), (2, COST_SEEKABLE)])
+
+        request = {'event': {'start': datetime(2011, 3, 28),
+                             'end': datetime(2011, 3, 28, 23)}}
+        self.assertEqual(list(index._apply_index(request)[0]), [1, 2])
+
+        # Expanding event 1 skips 134 occurrences:
+        index.max_occurrences = 100
+        self.assertEqual(list(index._apply_index(request)[0]), [1, 2])
+        index.budget_policy = 'nomatch'
+        self.assertEqual(list(index._apply_index(request)[0]), [2])
+        index.budget_policy = 'raise'
+        with self.assertRaises(ExpansionBudgetExceeded) as cm:
+            index._apply_index(request)
+        self.assertEqual(cm.exception.documentId, 1)
+        self.assertEqual(index.getOverBudget(), {1: 3})
+
+        # The cheap recurrences are expanded first, so they fit in the
+        # budget of the query:
+        index.max_occurrences = 10000
+        index.query_budget = 50
+        index.budget_policy = 'nomatch'
+        self.assertEqual(list(index._apply_index(request)[0]), [2])
+        index.query_budget = None
+        self.assertEqual(list(index._apply_index(request)[0]), [1, 2])
+
+        index.max_occurrences = 100
+        self.assertEqual(
+            [documentId for documentId, s, e in index.occurrences(
+                datetime(2011, 3, 28), datetime(2011, 3, 28, 23))],
+            [2])
+        self.assertEqual(index.getOverBudget(), {1: 5})
+
+    def test_counter(self):
+        index = EventIndex('event')
+        self.assertEqual(index.getCounter(), 0)
+        start = datetime(2011, 1, 4, 10)
+        index.index_object(1, TestOb('a', start, start, None))
+        counter = index.getCounter()
+        self.assertTrue(counter > 0)
+        index.unindex_object(2)
+        self.assertEqual(index.getCounter(), counter)
+        index.unindex_object(1)
+        self.assertTrue(index.getCounter() > counter)
+        counter = index.getCounter()
+        index.index_objects([(1, TestOb('a', start, start, None))])
+        self.assertTrue(index.getCounter() > counter)
+        counter = index.getCounter()
+        index.clear()
+        self.assertTrue(index.getCounter() > counter)
+
+        # Indexes from before the counter existed:
+        del index._counter
+        self.assertEqual(index.getCounter(), 0)
+        index.index_object(1, TestOb('a', start, start, None))
+        self.assertTrue(index.getCounter() > 0)
+
+    def test_result_cache(self):
+        from ZODB.DB import DB
+        from plone.app.eventindex import result_cache
+        import transaction
+
+        db = DB(None)
+        connection = db.open()
+        index = connection.root()['index'] = EventIndex('event')
+        start = datetime(2011, 1, 4, 10)
+        index.index_object(1, TestOb('a', start, start + timedelta(hours=1),
+                                     'RRULE:FREQ=WEEKLY'))
+        index.index_object(2, TestOb('b', start, start + timedelta(hours=1),
+                                     None))
+        request = {'event': {'start': datetime(2011, 1, 4),
+                             'end': datetime(2011, 1, 5)}}
+        result_cache.clear()
+        try:
+            # Uncommitted changes aren't cached:
+            self.assertEqual(list(index._apply_index(request)[0]), [1, 2])
+            self.assertEqual(len(result_cache), 0)
+            transaction.commit()
+
+            self.assertEqual(list(index._apply_index(request)[0]), [1, 2])
+            with mock.patch.object(index, '_search') as search:
+                result, used_fields = index._apply_index(request)
+            self.assertFalse(search.called)
+            self.assertEqual(list(result), [1, 2])
+            self.assertEqual(used_fields, ('start', 'end', 'recurrence'))
+            self.assertEqual(result_cache.hits, 1)
+            # The cached result can't be changed by the caller:
+            result.remove(1)
+            self.assertEqual(list(index._apply_index(request)[0]), [1, 2])
+
+            # Changes invalidate the cache:
+            index.unindex_object(2)
+            self.assertEqual(list(index._apply_index(request)[0]), [1])
+            transaction.commit()
+            self.assertEqual(list(index._apply_index(request)[0]), [1])
+
+            # Quantized queries share the cache entries:
+            index.cache_quantum = 3600
+            hits = result_cache.hits
+            for minute in (0, 10, 59):
+                query = {'event': {
+                    'start': datetime(2011, 1, 11, 10, minute),
+                    'end': datetime(2011, 1, 11, 10, minute, 1)}}
+                self.assertEqual(list(index._apply_index(query)[0]), [1])
+            self.assertEqual(result_cache.hits, hits + 2)
+            # The period is only widened, the end is rounded up:
+            self.assertEqual(index._quantize(datetime(2011, 1, 11, 23, 30)),
+                             datetime(2011, 1, 11, 23))
+            self.assertEqual(
+                index._quantize(datetime(2011, 1, 11, 23, 30), up=True),
+                datetime(2011, 1, 12))
+            self.assertEqual(
+                index._quantize(datetime(2011, 1, 11, 23), up=True),
+                datetime(2011, 1, 11, 23))
+
+            # Settings changing the results change the key:
+            hits = result_cache.hits
+            for name, value in [('max_occurrences', 1),
+                                ('query_budget', 1),
+                                ('budget_policy', 'nomatch')]:
+                setattr(index, name, value)
+                self.assertEqual(list(index._apply_index(query)[0]), [1])
+                self.assertEqual(result_cache.hits, hits)
+                delattr(index, name)
+            index.enable_materialization(now=datetime(2011, 1, 11))
+            self.assertEqual(list(index._apply_index(query)[0]), [1])
+            self.assertEqual(result_cache.hits, hits)
+            index.disable_materialization()
+            self.assertEqual(list(index._apply_index(query)[0]), [1])
+            self.assertEqual(result_cache.hits, hits + 1)
+        finally:
+            transaction.abort()
+            result_cache.clear()
+            connection.close()
+            db.close()
+
+    def test_catalog_resultset(self):
+        from Acquisition import Implicit
+        from Products.PluginIndexes.FieldIndex.FieldIndex import FieldIndex
+        from Products.ZCatalog.Catalog import Catalog
+
+        catalog = Catalog().__of__(Implicit())
+        catalog.addIndex('event', EventIndex('event'))
+        catalog.addIndex('category', FieldIndex('category'))
+        catalog.addColumn('id')
+        start = datetime(2011, 3, 7, 9)
+        for uid in range(6):
+            ob = TestOb(str(uid), start + timedelta(days=uid),
+                        start + timedelta(days=uid, hours=1), None)
+            ob.id = ob.name
+            ob.category = uid % 2 and 'Event' or 'Meeting'
+            catalog.catalogObject(ob, str(uid))
+        index = catalog.getIndex('event')
+
+        # The index is given the result of the indexes applied before it,
+        # which without a catalog plan are the indexes named before it:
+        query = {'category': 'Event',
+                 'event': {'start': datetime(2011, 3, 7),
+                           'end': datetime(2011, 3, 11)}}
+        with mock.patch.object(index, '_search',
+                               wraps=index._search) as search:
+            result = catalog.searchResults(query)
+        self.assertEqual(sorted(brain.id for brain in result), ['1', '3'])
+        resultset = search.call_args[0][2]
+        self.assertEqual(
+            sorted(catalog.paths[rid] for rid in resultset), ['1', '3', '5'])
+
+        # Cached results are intersected with the resultset:
+        with mock.patch('plone.app.eventindex.result_cache') as cache:
+            cache.get.return_value = (IITreeSet(resultset), ('start', 'end'))
+            with mock.patch.object(index, '_cache_key'):
+                result, used_fields = index._apply_index(
+                    {'event': query['event']}, IITreeSet([resultset.minKey()]))
+        self.assertEqual(list(result), [resultset.minKey()])
+        self.assertFalse(cache.set.called)
+
+    def test_sort_on_next_occurrence(self):
+        from Acquisition import Implicit
+        from Products.ZCatalog.Catalog import Catalog
+
+        catalog = Catalog().__of__(Implicit())
+        catalog.addIndex('event', EventIndex('event'))
+        catalog.addColumn('id')
+        events = [
+            # A weekly event on Tuesdays since 2009:
+            TestOb('weekly', datetime(2009, 1, 6, 10), datetime(2009, 1, 6, 11),
+                   'RRULE:FREQ=WEEKLY'),
+            TestOb('monday', datetime(2011, 3, 7, 9), datetime(2011, 3, 7, 10),
+                   None),
+            TestOb('thursday', datetime(2011, 3, 10, 9),
+                   datetime(2011, 3, 10, 10), None),
+            # The last Wednesday of the month, which is expanded:
+            TestOb('monthly', datetime(2010, 1, 27, 8),
+                   datetime(2010, 1, 27, 9),
+                   'RRULE:FREQ=MONTHLY;BYDAY=WE;BYSETPOS=-1'),
+            TestOb('ended', datetime(2010, 1, 5, 8), datetime(2010, 1, 5, 9),
+                   'RRULE:FREQ=DAILY;COUNT=3'),
+        ]
+        for uid, ob in enumerate(events):
+            ob.id = ob.name
+            catalog.catalogObject(ob, str(uid))
+        index = catalog.getIndex('event')
+
+        query = {'event': {'start': datetime(2011, 3, 7),
+                           'end': datetime(2011, 3, 31)}}
+        result = catalog.searchResults(query, sort_on='event')
+        self.assertEqual([brain.id for brain in result],
+                         ['monday', 'weekly', 'thursday', 'monthly'])
+        result = catalog.searchResults(query, sort_on='event', sort_limit=2)
+        self.assertEqual([brain.id for brain in result][:2],
+                         ['monday', 'weekly'])
+
+        rids = [catalog.uids[str(uid)] for uid in range(len(events))]
+        index._apply_index(dict(query, sort_on='event'))
+        keys = index.documentToKeyMap()
+        self.assertEqual(keys[rids[0]], to_seconds(datetime(2011, 3, 8, 10)))
+        self.assertEqual(keys[rids[3]], to_seconds(datetime(2011, 3, 30, 8)))
+        # Events which have ended are sorted on their last occurrence:
+        self.assertEqual(keys[rids[4]], to_seconds(datetime(2010, 1, 7, 8)))
+        self.assertRaises(KeyError, keys.__getitem__, max(rids) + 1)
+        self.assertEqual([list(row) for key, row in index.items()],
+                         [[rids[i]] for i in (4, 1, 0, 2, 3)])
+
+        # In the next transaction, without a query on the index, the events
+        # sort on their start:
+        import transaction
+        index._apply_index(dict(query, sort_on='event'))
+        transaction.abort()
+        keys = index.documentToKeyMap()
+        self.assertEqual(keys[rids[0]], to_seconds(datetime(2009, 1, 6, 10)))
+
+        # And so they do in later searches of the same transaction which
+        # don't query the index, or which query it without sorting on it:
+        result = catalog.searchResults(query, sort_on='event')
+        self.assertEqual([brain.id for brain in result],
+                         ['monday', 'weekly', 'thursday', 'monthly'])
+        result = catalog.searchResults(sort_on='event')
+        self.assertEqual([brain.id for brain in result],
+                         ['weekly', 'ended', 'monthly', 'monday', 'thursday'])
+        catalog.searchResults(query)
+        result = catalog.searchResults(sort_on='event')
+        self.assertEqual([brain.id for brain in result],
+                         ['weekly', 'ended', 'monthly', 'monday', 'thursday'])
+
+    def test_upcoming(self):
+        random = Random(17)
+        rules = [None, None, 'RRULE:FREQ=WEEKLY', 'RRULE:FREQ=DAILY;COUNT=5',
+                 'RRULE:FREQ=MONTHLY;BYDAY=-1FR', 'RRULE:FREQ=HOURLY;COUNT=30']
+        index = EventIndex('event')
+        for uid in range(1, 301):
+            start = datetime(2011, 1, 1) + timedelta(
+                minutes=random.randint(0, 60 * 24 * 365))
+            index.index_object(uid, TestOb(
+                'a', start, start + timedelta(minutes=random.choice(
+                    [0, 30, 60 * 24 * 2])), random.choice(rules)))
+
+        for i in range(10):
+            start = datetime(2011, 1, 1) + timedelta(
+                minutes=random.randint(0, 60 * 24 * 400))
+            end = start + timedelta(days=30)
+            expected = sorted(index.occurrences(start, end),
+                              key=lambda x: (x[1], x[0]))
+            self.assertEqual(index.upcoming(start, 20, end), expected[:20])
+            self.assertEqual(index.upcoming(start, 20), expected[:20])
+            self.assertEqual(index.upcoming(start, 10 ** 6, end), expected)
+
+        # Events starting after the tenth occurrence are never expanded:
+        start = datetime(2011, 6, 1)
+        upcoming = index.upcoming(start, 10)
+        with mock.patch.object(index, '_iter_occurrences',
+                               wraps=index._iter_occurrences) as expand:
+            self.assertEqual(index.upcoming(start, 10), upcoming)
+        opened = set(call[0][0] for call in expand.call_args_list)
+        self.assertTrue(max(index._uid2start[uid] for uid in opened) <=
+                        to_seconds(upcoming[-1][1]))
+
+        resultset = IITreeSet(range(1, 301, 2))
+        self.assertEqual(
+            index.upcoming(start, 10, resultset=resultset),
+            [x for x in index.upcoming(start, 1000) if x[0] % 2][:10])
+
+        # As a query, with the events sorted on their next occurrence:
+        result, used_fields = index._apply_index(
+            {'event': {'start': start, 'limit': 10}, 'sort_on': 'event'})
+        self.assertEqual(sorted(result), sorted(set(x[0] for x in upcoming)))
+        first = []
+        for documentId, occurrence_start, occurrence_end in upcoming:
+            if documentId not in first:
+                first.append(documentId)
+        keys = index.documentToKeyMap()
+        self.assertEqual(sorted(result, key=lambda x: (keys[x], x)), first)
+
+    def test_upcoming_budget(self):
+        from plone.app.eventindex.budget import ExpansionBudgetExceeded
+        index = EventIndex('event')
+        # The last Monday of the month, which is expanded from its start:
+        for uid in range(1, 51):
+            start = datetime(2000, 1, 3, 10) + timedelta(days=uid)
+            index.index_object(uid, TestOb(
+                'a', start, start + timedelta(hours=1),
+                'RRULE:FREQ=MONTHLY;BYDAY=MO;BYSETPOS=-1'))
+        index.index_object(51, TestOb('b', datetime(2011, 6, 1, 10),
+                                      datetime(2011, 6, 1, 11), None))
+        start = datetime(2011, 6, 1)
+        self.assertEqual(len(index.upcoming(start, 10)), 10)
+
+        # The occurrences skipped by all events count against the budget
+        # of the query:
+        index.query_budget = 1000
+        upcoming = index.upcoming(start, 10)
+        self.assertEqual(upcoming[0][0], 51)
+        self.assertTrue(len(index.getOverBudget()) > 40)
+
+        index.budget_policy = 'raise'
+        self.assertRaises(ExpansionBudgetExceeded, index.upcoming, start, 10)
+        self.assertRaises(ExpansionBudgetExceeded, index._apply_index,
+                          {'event': {'start': start, 'limit': 10}})
+
+    def test_last_occurrence(self):
+        index = EventIndex('event')
+        start = datetime(2011, 3, 5, 12)
+        end = start + timedelta(hours=1)
+        # Computed, not expanded:
+        index.index_object(1, TestOb('a', start, end,
+                                     'RRULE:FREQ=HOURLY;COUNT=1000000'))
+        self.assertEqual(index._uid2end[1], to_seconds(
+            start + timedelta(hours=1000000)))
+        index.index_object(2, TestOb('b', start, end,
+                                     'RRULE:FREQ=DAILY;BYHOUR=12,18;'
+                                     'UNTIL=20110310T000000Z'))
+        self.assertEqual(index._uid2end[2],
+                         to_seconds(datetime(2011, 3, 9, 19)))
+
+        # Too many occurrences to expand, so it's indexed as open ended:
+        index.max_indexed_occurrences = 10
+        index.index_object(3, TestOb('c', start, end,
+                                     'RRULE:FREQ=MONTHLY;BYDAY=MO;'
+                                     'BYSETPOS=-1;COUNT=20'))
+        self.assertEqual(index._uid2end[3], OPEN_END)
+        result, used_fields = index._apply_index({'event': {
+            'start': datetime(2012, 10, 29), 'end': datetime(2012, 10, 30)}})
+        self.assertTrue(3 in result)
+        # But it still ends after its 20 occurrences:
+        result, used_fields = index._apply_index({'event': {
+            'start': datetime(2012, 11, 1), 'end': datetime(2013, 1, 1)}})
+        self.assertFalse(3 in result)
+
+    def test_unchanged_reindex(self):
+        from ZODB.DB import DB
+        import transaction
+
+        db = DB(None)
+        connection = db.open()
+        index = connection.root()['index'] = EventIndex('event')
+        start = datetime(2011, 1, 4, 10)
+        event = TestOb('a', start, start + timedelta(hours=1),
+                       'RRULE:FREQ=WEEKLY')
+        self.assertTrue(index.index_object(1, event))
+        transaction.commit()
+        last = db.lastTransaction()
+        counter = index.getCounter()
+
+        # A title change doesn't change anything in the index:
+        event.name = 'b'
+        self.assertFalse(index.index_object(1, event))
+        self.assertEqual(index.index_objects([(1, event)]), 1)
+        transaction.commit()
+        self.assertEqual(db.lastTransaction(), last)
+        self.assertEqual(index.getCounter(), counter)
+        self.assertEqual(index.getUnchanged(), 2)
+
+        event.end += timedelta(minutes=30)
+        self.assertTrue(index.index_object(1, event))
+        self.assertEqual(index.getEntryForObject(1)['duration'], 5400)
+        self.assertEqual(index.getUnchanged(), 2)
+        transaction.abort()
+        connection.close()
+        db.close()
+
+    def test_all_documents(self):
+        from ZODB.DB import DB
+        import transaction
+
+        db = DB(None)
+        connection = db.open()
+        index = connection.root()['index'] = EventIndex('event')
+        start = datetime(2011, 1, 4, 10)
+        for uid in (1, 2):
+            index.index_object(uid, TestOb(str(uid), start,
+                                           start + timedelta(hours=1), None))
+        transaction.commit()
+
+        # Unbounded queries share the set of all documents:
+        documents = index._search(None, None)[0]
+        self.assertEqual(list(documents), [1, 2])
+        self.assertTrue(index._search(None, None)[0] is documents)
+        self.assertEqual(list(index._search(None, None, IITreeSet([2, 3]))[0]),
+                         [2])
+
+        # Until the index changes:
+        index.index_object(3, TestOb('3', start, start + timedelta(hours=1),
+                                     None))
+        changed = index._search(None, None)[0]
+        self.assertEqual(list(changed), [1, 2, 3])
+        # Uncommitted changes aren't kept:
+        self.assertFalse(index._search(None, None)[0] is changed)
+        transaction.abort()
+        self.assertTrue(index._search(None, None)[0] is documents)
+        transaction.abort()
+        connection.close()
+        db.close()
+
+    def test_calendar(self):
+        index = EventIndex('event')
+        # Daily at noon:
+        index.index_object(1, TestOb('a', datetime(2011, 4, 1, 12, 0),
+                                     datetime(2011, 4, 1, 13, 0),
+                                     'RRULE:FREQ=DAILY'))
+        # Over three days:
+        index.index_object(2, TestOb('b', datetime(2011, 4, 4, 20, 0),
+                                     datetime(2011, 4, 6, 8, 0), None))
+        # A moment at midnight:
+        index.index_object(3, TestOb('c', datetime(2011, 4, 5, 0, 0),
+                                     datetime(2011, 4, 5, 0, 0), None))
+        # Ending at the start of the period:
+        index.index_object(4, TestOb('d', datetime(2011, 4, 3, 20, 0),
+                                     datetime(2011, 4, 4, 0, 0), None))
+        # Every six hours, twice:
+        index.index_object(5, TestOb('e', datetime(2011, 4, 6, 6, 0),
+                                     datetime(2011, 4, 6, 7, 0),
+                                     'RRULE:FREQ=HOURLY;INTERVAL=6;COUNT=2'))
+
+        res = index.calendar(datetime(2011, 4, 4), datetime(2011, 4, 7))
+        self.assertEqual([(day, list(documentIds), count)
+                          for day, documentIds, count in res], [
+            (datetime(2011, 4, 4), [1, 2], 2),
+            (datetime(2011, 4, 5), [1, 2, 3], 3),
+            (datetime(2011, 4, 6), [1, 2, 5], 4),
+        ])
+
+        # The last bucket is cut short, and occurrences starting at the end
+        # aren't in it:
+        res = index.calendar(DateTime('2011/4/4 00:00 UTC'),
+                             datetime(2011, 4, 6, 12, 0), 'week',
+                             IITreeSet([1, 5]))
+        self.assertEqual([(day, list(documentIds), count)
+                          for day, documentIds, count in res], [
+            (datetime(2011, 4, 4), [1, 5], 3),
+        ])
+
+        # The same as the occurrences of every bucket:
+        start = datetime(2011, 4, 4, 0, 30)
+        res = index.calendar(start, datetime(2011, 4, 7), timedelta(hours=5))
+        self.assertEqual(len(res), 15)
+        for bucket_start, documentIds, count in res:
+            bucket_end = bucket_start + timedelta(hours=5)
+            occurrences = [
+                documentId for documentId, occurrence_start, occurrence_end
+                in index.occurrences(bucket_start, bucket_end)
+                if occurrence_start < bucket_end]
+            self.assertEqual(list(documentIds), sorted(set(occurrences)))
+            self.assertEqual(count, len(occurrences))
+
+        self.assertEqual(index.calendar(start, start), [])
+        self.assertRaises(ValueError, index.calendar, start, None)
+        self.assertRaises(ValueError, index.calendar, start, start, 'month')
+
+    def test_calendar_timezone(self):
+        helsinki = timezone('Europe/Helsinki')
+        index = EventIndex('event')
+        start = helsinki.localize(datetime(2012, 3, 27, 0, 30))
+        index.index_object(1, TestOb('a', start, start + timedelta(hours=1),
+                                     None))
+        start = helsinki.localize(datetime(2012, 3, 1))
+        end = helsinki.localize(datetime(2012, 4, 1))
+
+        # The days start at midnight in Helsinki, also after the change to
+        # summer time on the 25th:
+        res = index.calendar(start, end, tzinfo=helsinki)
+        self.assertEqual(len(res), 31)
+        self.assertEqual(res[23][0], datetime(2012, 3, 23, 22))
+        self.assertEqual(res[25][0], datetime(2012, 3, 25, 21))
+        self.assertEqual([day for day, documentIds, count in res
+                          if documentIds],
+                         [datetime(2012, 3, 26, 21)])
+
+        # In UTC the days start an hour after midnight since, and the event
+        # overlaps two of them:
+        res = index.calendar(start, end)
+        self.assertEqual(len(res), 31)
+        self.assertEqual([day for day, documentIds, count in res
+                          if documentIds],
+                         [datetime(2012, 3, 25, 22),
+                          datetime(2012, 3, 26, 22)])
+
+        # Weeks too:
+        res = index.calendar(start, end, 'week', tzinfo=helsinki)
+        self.assertEqual([day for day, documentIds, count in res],
+                         [datetime(2012, 2, 29, 22), datetime(2012, 3, 7, 22),
+                          datetime(2012, 3, 14, 22), datetime(2012, 3, 21, 22),
+                          datetime(2012, 3, 28, 21)])
+
+    def test_calendar_budget(self):
+        from plone.app.eventindex.budget import ExpansionBudgetExceeded
+        index = EventIndex('event')
+        # Every minute:
+        index.index_object(1, TestOb('a', datetime(2011, 4, 1, 0, 0),
+                                     datetime(2011, 4, 1, 0, 0, 30),
+                                     'RRULE:FREQ=MINUTELY'))
+        index.index_object(2, TestOb('b', datetime(2011, 4, 1, 12, 0),
+                                     datetime(2011, 4, 1, 13, 0),
+                                     'RRULE:FREQ=DAILY'))
+        index.index_object(3, TestOb('c', datetime(2011, 4, 2, 12, 0),
+                                     datetime(2011, 4, 2, 13, 0), None))
+        start, end = datetime(2011, 4, 1), datetime(2011, 4, 3)
+
+        # The occurrences within the period count against the budget of the
+        # document, it's cut short:
+        index.max_occurrences = 1000
+        res = index.calendar(start, end)
+        self.assertEqual([(list(documentIds), count)
+                          for day, documentIds, count in res],
+                         [([1, 2], 1001), ([2, 3], 2)])
+        self.assertEqual(index.getOverBudget(), {1: 1})
+
+        # And against the budget of the query:
+        index.max_occurrences = 10000
+        index.query_budget = 500
+        res = index.calendar(start, end)
+        self.assertEqual([(list(documentIds), count)
+                          for day, documentIds, count in res],
+                         [([1], 500), ([3], 1)])
+
+        index.budget_policy = 'raise'
+        self.assertRaises(ExpansionBudgetExceeded, index.calendar, start, end)
+
+    def test_freebusy(self):
+        index = EventIndex('event')
+        # Daily from 9 to 11:
+        index.index_object(1, TestOb('a', datetime(2011, 4, 1, 9, 0),
+                                     datetime(2011, 4, 1, 11, 0),
+                                     'RRULE:FREQ=DAILY'))
+        # Overlapping the first on the 5th:
+        index.index_object(2, TestOb('b', datetime(2011, 4, 5, 10, 0),
+                                     datetime(2011, 4, 5, 12, 0), None))
+        # Adjoining the first on the 6th:
+        index.index_object(3, TestOb('c', datetime(2011, 4, 6, 11, 0),
+                                     datetime(2011, 4, 6, 11, 30), None))
+        # Within the first on the 6th:
+        index.index_object(4, TestOb('d', datetime(2011, 4, 6, 9, 30),
+                                     datetime(2011, 4, 6, 10, 0), None))
+        # Without a duration:
+        index.index_object(5, TestOb('e', datetime(2011, 4, 6, 15, 0),
+                                     datetime(2011, 4, 6, 15, 0), None))
+        # Over the end of the period:
+        index.index_object(6, TestOb('f', datetime(2011, 4, 6, 22, 0),
+                                     datetime(2011, 4, 7, 2, 0), None))
+
+        res = index.freebusy(DateTime('2011/4/5 10:30 UTC'),
+                             datetime(2011, 4, 7))
+        self.assertEqual(res, [
+            (datetime(2011, 4, 5, 10, 30), datetime(2011, 4, 5, 12, 0)),
+            (datetime(2011, 4, 6, 9, 0), datetime(2011, 4, 6, 11, 30)),
+            (datetime(2011, 4, 6, 22, 0), datetime(2011, 4, 7, 0, 0)),
+        ])
+
+        # Limited to a resultset:
+        res = index.freebusy(datetime(2011, 4, 5), datetime(2011, 4, 7),
+                             IITreeSet([2, 3]))
+        self.assertEqual(res, [
+            (datetime(2011, 4, 5, 10, 0), datetime(2011, 4, 5, 12, 0)),
+            (datetime(2011, 4, 6, 11, 0), datetime(2011, 4, 6, 11, 30)),
+        ])
+
+        # The same as merging the occurrences:
+        start = datetime(2011, 3, 30)
+        end = datetime(2011, 5, 1)
+        spans = sorted((max(s, start), min(e, end)) for d, s, e
+                       in index.occurrences(start, end) if s < e < end)
+        merged = spans[:1]
+        for span_start, span_end in spans[1:]:
+            if span_start <= merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], span_end))
+            else:
+                merged.append((span_start, span_end))
+        self.assertEqual(index.freebusy(start, end), merged)
+
+        self.assertEqual(index.freebusy(datetime(2011, 3, 1),
+                                        datetime(2011, 3, 2)), [])
+        self.assertRaises(ValueError, index.freebusy, start, None)
+
+    def test_freebusy_budget(self):
+        from plone.app.eventindex.budget import ExpansionBudgetExceeded
+        index = EventIndex('event')
+        # Every ten minutes for five minutes:
+        index.index_object(1, TestOb('a', datetime(2011, 4, 1, 0, 0),
+                                     datetime(2011, 4, 1, 0, 5),
+                                     'RRULE:FREQ=MINUTELY;INTERVAL=10'))
+        index.index_object(2, TestOb('b', datetime(2011, 4, 1, 12, 0),
+                                     datetime(2011, 4, 1, 13, 0),
+                                     'RRULE:FREQ=DAILY'))
+        index.index_object(3, TestOb('c', datetime(2011, 4, 2, 12, 0),
+                                     datetime(2011, 4, 2, 13, 0), None))
+        start, end = datetime(2011, 4, 1), datetime(2011, 4, 3)
+
+        # The occurrences within the period count against the budget of the
+        # document, it's cut short:
+        index.max_occurrences = 3
+        self.assertEqual(index.freebusy(start, end), [
+            (datetime(2011, 4, 1, 0, 0), datetime(2011, 4, 1, 0, 5)),
+            (datetime(2011, 4, 1, 0, 10), datetime(2011, 4, 1, 0, 15)),
+            (datetime(2011, 4, 1, 0, 20), datetime(2011, 4, 1, 0, 25)),
+            (datetime(2011, 4, 1, 12, 0), datetime(2011, 4, 1, 13, 0)),
+            (datetime(2011, 4, 2, 12, 0), datetime(2011, 4, 2, 13, 0)),
+        ])
+        self.assertEqual(index.getOverBudget(), {1: 1})
+
+        # And against the budget of the query:
+        index.max_occurrences = 10000
+        index.query_budget = 2
+        self.assertEqual(index.freebusy(start, end), [
+            (datetime(2011, 4, 1, 0, 0), datetime(2011, 4, 1, 0, 5)),
+            (datetime(2011, 4, 1, 12, 0), datetime(2011, 4, 1, 13, 0)),
+            (datetime(2011, 4, 2, 12, 0), datetime(2011, 4, 2, 13, 0)),
+        ])
+
+        index.budget_policy = 'raise'
+        self.assertRaises(ExpansionBudgetExceeded, index.freebusy, start, end)
+
+    def test_varying_offsets(self):
+        # Daily at 23:30 in Helsinki, from the summer, when that's 20:30 UTC,
+        # into the winter, when it's 21:30 UTC:
+        from dateutil.zoneinfo import gettz
+        index = EventIndex('event')
+        start = datetime(2011, 6, 1, 23, 30, tzinfo=gettz('Europe/Helsinki'))
+        index.index_object(1, TestOb('a', start, start + timedelta(minutes=30),
+                                     'RRULE:FREQ=DAILY'))
+        res = index._apply_index({'event': {
+            'start': datetime(2011, 12, 1, 21, 45),
+            'end': datetime(2011, 12, 1, 21, 50)}})
+        self.assertEqual(list(res[0]), [1])
+        self.assertEqual(
+            list(index.occurrences(datetime(2011, 12, 1, 21, 45),
+                                   datetime(2011, 12, 1, 21, 50))),
+            [(1, datetime(2011, 12, 1, 21, 30), datetime(2011, 12, 1, 22, 0))])
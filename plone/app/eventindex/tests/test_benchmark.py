@@ -0,0 +1,48 @@
+from StringIO import StringIO
+from plone.app.eventindex.benchmark.generate import generate
+from plone.app.eventindex.benchmark.runner import QUERIES
+from plone.app.eventindex.benchmark.runner import report
+from plone.app.eventindex.benchmark.runner import run
+
+import unittest2 as unittest
+
+
+class BenchmarkTests(unittest.TestCase):
+
+    def test_generate(self):
+        events = list(generate(500, seed=3))
+        self.assertEqual([documentId for documentId, event in events],
+                         range(1, 501))
+        kinds = set(event.kind for documentId, event in events)
+        self.assertEqual(kinds, set(['single', 'bounded', 'open', 'exdates']))
+        # The same seed gives the same calendar:
+        self.assertEqual(
+            [(e.start, e.end, e.recurrence) for i, e in events],
+            [(e.start, e.end, e.recurrence) for i, e in generate(500, seed=3)])
+
+        events = list(generate(100, mix=(('single', 1),)))
+        self.assertEqual(set(event.kind for documentId, event in events),
+                         set(['single']))
+
+    def test_run(self):
+        results = run(size=200, queries=2, batch=50)
+        self.assertEqual([result['name'] for result in results],
+                         ['index_object', 'index_objects'] +
+                         ['query %s' % name for name, s, e in QUERIES] +
+                         ['calendar month', 'reindex', 'unindex'])
+        self.assertEqual(results[0]['operations'], 200)
+        self.assertEqual(results[1]['operations'], 200)
+        self.assertTrue(results[0]['bytes'] > 0)
+        self.assertEqual(results[2]['bytes'], 0)
+
+        out = StringIO()
+        report(results, out)
+        self.assertEqual(len(out.getvalue().splitlines()), len(results) + 1)
+
+    def test_conflicts(self):
+        from plone.app.eventindex.benchmark.conflicts import run
+        result = run(threads=2, transactions=5, events=3)
+        self.assertEqual(result['commits'], 10)
+        self.assertTrue(0 <= result['rate'] < 1)
+        result = run(threads=2, transactions=5, events=3, legacy=True)
+        self.assertEqual(result['commits'], 10)
@@ -0,0 +1,71 @@
+from plone.app.eventindex.budget import ExpansionBudget
+from plone.app.eventindex.budget import ExpansionBudgetExceeded
+
+import mock
+import unittest2 as unittest
+
+
+class ExpansionBudgetTests(unittest.TestCase):
+
+    def test_event_limit(self):
+        budget = ExpansionBudget(3)
+        for documentId in (1, 2):
+            budget.start(documentId)
+            for i in range(3):
+                budget.spend()
+        with self.assertRaises(ExpansionBudgetExceeded) as cm:
+            budget.spend()
+        self.assertEqual(cm.exception.documentId, 2)
+        self.assertEqual(budget.examined, 7)
+        self.assertFalse(budget.exhausted())
+
+    def test_query_limit(self):
+        budget = ExpansionBudget(3, 5)
+        budget.start(1)
+        for i in range(3):
+            budget.spend()
+        budget.start(2)
+        budget.spend()
+        budget.spend()
+        self.assertTrue(budget.exhausted())
+        with self.assertRaises(ExpansionBudgetExceeded) as cm:
+            budget.spend()
+        self.assertEqual(cm.exception.documentId, 2)
+        with self.assertRaises(ExpansionBudgetExceeded) as cm:
+            budget.start(3)
+        self.assertEqual(cm.exception.documentId, None)
+
+    def test_timeout(self):
+        with mock.patch('plone.app.eventindex.budget.time') as time:
+            time.return_value = 1000.0
+            budget = ExpansionBudget(1000, None, 2)
+            budget.start(1)
+            for i in range(150):
+                budget.spend()
+            time.return_value = 1003.0
+            self.assertTrue(budget.exhausted())
+            with self.assertRaises(ExpansionBudgetExceeded):
+                for i in range(100):
+                    budget.spend()
+            self.assertEqual(budget.examined, 200)
+
+    def test_event_budgets(self):
+        # Documents expanded at the same time have budgets of their own,
+        # sharing the limit of the query:
+        budget = ExpansionBudget(3, 7)
+        first = budget.event(1)
+        second = budget.event(2)
+        for i in range(3):
+            first.spend()
+            second.spend()
+        with self.assertRaises(ExpansionBudgetExceeded) as cm:
+            first.spend()
+        self.assertEqual(cm.exception.documentId, 1)
+        third = budget.event(3)
+        third.spend()
+        with self.assertRaises(ExpansionBudgetExceeded) as cm:
+            third.spend()
+        self.assertEqual(cm.exception.documentId, 3)
+        self.assertEqual(budget.examined, 9)
+        self.assertTrue(budget.exhausted())
+        self.assertRaises(ExpansionBudgetExceeded, budget.event, 4)
@@ -0,0 +1,128 @@
+from datetime import datetime
+from datetime import timedelta
+from plone.app.eventindex import EventIndex
+from plone.app.eventindex.ical import load
+from plone.app.eventindex.ical import parse_duration
+from plone.app.eventindex.ical import parse_events
+from pytz import timezone
+
+import pytz
+import unittest2 as unittest
+
+
+CALENDAR = """BEGIN:VCALENDAR\r
+VERSION:2.0\r
+BEGIN:VEVENT\r
+SUMMARY:Weekly meeting\r
+DTSTART;TZID=Europe/Helsinki:20110104T100000\r
+DTEND;TZID=Europe/Helsinki:20110104T110000\r
+RRULE:FREQ=WEEKLY;BYDAY=TU;\r
+ COUNT=10\r
+EXDATE;TZID=Europe/Helsinki:20110111T100000,20110118T100000\r
+END:VEVENT\r
+BEGIN:VEVENT\r
+DTSTART;VALUE=DATE:20110201\r
+END:VEVENT\r
+BEGIN:VEVENT\r
+DTSTART:20110301T120000Z\r
+DURATION:PT1H30M\r
+RDATE:20110401T120000Z\r
+END:VEVENT\r
+BEGIN:VEVENT\r
+SUMMARY:No start\r
+END:VEVENT\r
+BEGIN:VTODO\r
+DTSTART:20110301T120000Z\r
+END:VTODO\r
+BEGIN:VEVENT\r
+DTSTART;TZID=EUROPE/HELSINKI:20110501T100000\r
+RRULE:FREQ=DAILY\r
+END:VEVENT\r
+END:VCALENDAR\r
+"""
+
+INVALID = """BEGIN:VCALENDAR\r
+BEGIN:VEVENT\r
+UID:good\r
+DTSTART:20110301T120000Z\r
+END:VEVENT\r
+BEGIN:VEVENT\r
+UID:bad-start\r
+DTSTART:2011-03-01\r
+END:VEVENT\r
+BEGIN:VEVENT\r
+UID:bad-rule\r
+DTSTART:20110301T120000Z\r
+RRULE:FREQ=DAILY;\r
+ BYDAY=XX\r
+END:VEVENT\r
+BEGIN:VEVENT\r
+DTSTART:20110302T120000Z\r
+END:VEVENT\r
+END:VCALENDAR\r
+"""
+
+
+class ICalTests(unittest.TestCase):
+
+    def test_parse_duration(self):
+        self.assertEqual(parse_duration('P1W2DT3H4M5S'),
+                         timedelta(days=9, hours=3, minutes=4, seconds=5))
+        self.assertEqual(parse_duration('-PT15M'), timedelta(minutes=-15))
+        self.assertRaises(ValueError, parse_duration, '1H')
+
+    def test_parse_events(self):
+        helsinki = timezone('Europe/Helsinki')
+        events = list(parse_events(CALENDAR.splitlines(True)))
+        self.assertEqual(len(events), 4)
+
+        self.assertEqual(events[0].start,
+                         helsinki.localize(datetime(2011, 1, 4, 10)))
+        self.assertEqual(events[0].end,
+                         helsinki.localize(datetime(2011, 1, 4, 11)))
+        self.assertEqual(events[0].recurrence,
+                         'RRULE:FREQ=WEEKLY;BYDAY=TU;COUNT=10\n'
+                         'EXDATE:20110111T080000Z,20110118T080000Z')
+
+        # All day events:
+        self.assertEqual(events[1].start, datetime(2011, 2, 1))
+        self.assertEqual(events[1].end, datetime(2011, 2, 2))
+        self.assertEqual(events[1].recurrence, None)
+
+        self.assertEqual(events[2].start,
+                         pytz.utc.localize(datetime(2011, 3, 1, 12)))
+        self.assertEqual(events[2].end,
+                         pytz.utc.localize(datetime(2011, 3, 1, 13, 30)))
+        self.assertEqual(events[2].recurrence, None)
+
+        # Upper cased by anonical.py:
+        self.assertEqual(events[3].start.tzinfo.zone, 'Europe/Helsinki')
+        self.assertEqual(events[3].end, events[3].start)
+
+    def test_load(self):
+        index = EventIndex('event')
+        self.assertEqual(load(index, CALENDAR.splitlines(True), first_id=5,
+                              batch=3, commit=False), 4)
+        self.assertEqual(list(index._uid2start.keys()), [5, 6, 7, 8])
+
+        result, used_fields = index._apply_index({'event': {
+            'start': datetime(2011, 1, 4), 'end': datetime(2011, 1, 5)}})
+        self.assertEqual(list(result), [5])
+        # The EXDATEs are left out:
+        result, used_fields = index._apply_index({'event': {
+            'start': datetime(2011, 1, 11), 'end': datetime(2011, 1, 19)}})
+        self.assertEqual(list(result), [])
+        result, used_fields = index._apply_index({'event': {
+            'start': datetime(2011, 1, 25), 'end': datetime(2011, 1, 26)}})
+        self.assertEqual(list(result), [5])
+
+    def test_load_invalid(self):
+        # Invalid events are skipped, the others are indexed:
+        index = EventIndex('event')
+        skipped = []
+        self.assertEqual(load(index, INVALID.splitlines(True), commit=False,
+                              skipped=skipped), 2)
+        self.assertEqual([(line, uid) for line, uid, error in skipped],
+                         [(6, 'bad-start'), (10, 'bad-rule')])
+        self.assertEqual(index.getEntryForObject(2)['start'],
+                         index.getEntryForObject(1)['start'] + 86400)
@@ -0,0 +1,122 @@
+from datetime import datetime
+from datetime import timedelta
+from dateutil.tz import tzoffset
+from plone.app.eventindex import EventIndex
+from plone.app.eventindex import to_seconds
+from plone.app.eventindex.parallel import filter_chunk
+from plone.app.eventindex.parallel import filter_parallel
+from plone.app.eventindex.parallel import get_pool
+from plone.app.eventindex.parallel import shutdown
+from plone.app.eventindex.parallel import start
+from plone.app.eventindex.tests.test_EventIndex import TestOb
+from random import Random
+
+import mock
+import unittest2 as unittest
+
+
+class ParallelTests(unittest.TestCase):
+
+    def tearDown(self):
+        shutdown()
+
+    def test_filter_chunk(self):
+        index = EventIndex('event')
+        start = datetime(2000, 1, 3, 10)
+        index.index_object(1, TestOb('a', start, start + timedelta(hours=1),
+                                     'RRULE:FREQ=MONTHLY;BYDAY=MO;BYSETPOS=-1'))
+        index.index_object(2, TestOb('b', start, start + timedelta(hours=1),
+                                     'RRULE:FREQ=DAILY'))
+        events = [(documentId, index._uid2duration[documentId],
+                   index._uid2recurrence[documentId]) for documentId in (1, 2)]
+        period = (to_seconds(datetime(2011, 3, 28)),
+                  to_seconds(datetime(2011, 3, 28, 23)))
+        self.assertEqual(filter_chunk(period + (10000, events)), ([1, 2], []))
+        self.assertEqual(filter_chunk(period + (100, events)), ([2], [1]))
+        period = (to_seconds(datetime(2011, 3, 29)),
+                  to_seconds(datetime(2011, 3, 29, 23)))
+        self.assertEqual(filter_chunk(period + (10000, events)), ([2], []))
+        self.assertEqual(filter_chunk((None, period[1], 10000, events)),
+                         ([1, 2], []))
+
+    def test_parallel_query(self):
+        random = Random(14)
+        rules = ['RRULE:FREQ=WEEKLY;BYDAY=TU',
+                 'RRULE:FREQ=MONTHLY;BYDAY=2MO;COUNT=20',
+                 'RRULE:FREQ=DAILY;INTERVAL=10',
+                 'RRULE:FREQ=YEARLY;BYMONTH=3,9',
+                 None]
+        index = EventIndex('event')
+        for documentId in range(1, 201):
+            start = datetime(2011, 1, 1) + timedelta(
+                minutes=random.randint(0, 60 * 24 * 365))
+            index.index_object(documentId, TestOb(
+                'a', start, start + timedelta(hours=random.randint(1, 30)),
+                random.choice(rules)))
+
+        queries = []
+        for i in range(10):
+            start = datetime(2011, 1, 1) + timedelta(
+                days=random.randint(0, 700))
+            queries.append({'event': {
+                'start': start,
+                'end': start + timedelta(days=random.choice([0, 1, 7]))}})
+        expected = [list(index._apply_index(query)[0]) for query in queries]
+
+        index.parallel_processes = 2
+        index.parallel_threshold = 10
+        index.parallel_chunk = 7
+        self.assertEqual([list(index._apply_index(query)[0])
+                          for query in queries], expected)
+
+        # The events over the budget are handled as in the serial path:
+        index.max_occurrences = 5
+        index.budget_policy = 'nomatch'
+        result, used_fields = index._apply_index(queries[0])
+        self.assertTrue(len(index.getOverBudget()) > 0)
+        self.assertTrue(set(result) <= set(expected[0]))
+
+    def test_only_compact_rules(self):
+        # Rules in timezones without a compact form aren't sent to the
+        # processes, but are expanded by the index:
+        index = EventIndex('event')
+        start = datetime(2011, 1, 3, 10)
+        for documentId in range(1, 11):
+            if documentId % 2:
+                tzinfo = tzoffset('X', 7200)
+            else:
+                tzinfo = None
+            event_start = (start + timedelta(days=documentId)).replace(
+                tzinfo=tzinfo)
+            index.index_object(documentId, TestOb(
+                'a', event_start, event_start + timedelta(hours=1),
+                'RRULE:FREQ=WEEKLY;BYDAY=MO,TU,WE,TH,FR,SA,SU;INTERVAL=2'))
+        query = {'event': {'start': datetime(2011, 2, 1),
+                           'end': datetime(2011, 2, 2)}}
+        expected = list(index._apply_index(query)[0])
+
+        index.parallel_processes = 2
+        index.parallel_threshold = 2
+        with mock.patch('plone.app.eventindex.filter_parallel',
+                        wraps=filter_parallel) as parallel:
+            self.assertEqual(list(index._apply_index(query)[0]), expected)
+        events = parallel.call_args[0][-1]
+        self.assertEqual([event[0] for event in events], [2, 4, 6, 8, 10])
+        for documentId, duration, recurrence in events:
+            self.assertTrue(isinstance(recurrence, tuple))
+
+    def test_pools(self):
+        from multiprocessing.pool import RUN
+        # Configured in zope.conf:
+        start(None)
+        start({'parallel_processes': '2'})
+        pool = get_pool(2)
+        self.assertTrue(get_pool(2) is pool)
+        # Other sizes don't stop the pool, which may be in use:
+        other = get_pool(1)
+        self.assertEqual(pool._state, RUN)
+        self.assertEqual(pool.map(abs, [-1, -2]), [1, 2])
+        self.assertEqual(other.map(abs, [-3]), [3])
+        shutdown()
+        self.assertNotEqual(pool._state, RUN)
+        self.assertFalse(get_pool(2) is pool)
@@ -0,0 +1,407 @@
+from datetime import datetime
+from datetime import timedelta
+from dateutil import rrule
+from dateutil.tz import tzoffset
+from dateutil.zoneinfo import gettz
+from itertools import islice
+from plone.app.eventindex import sync_timezone
+from plone.app.eventindex.budget import ExpansionBudgetExceeded
+from plone.app.eventindex.recurrence import COST_EXPANDED
+from plone.app.eventindex.recurrence import COST_FINE
+from plone.app.eventindex.recurrence import COST_SEEKABLE
+from plone.app.eventindex.recurrence import UTC
+from plone.app.eventindex.recurrence import canonical_rule
+from plone.app.eventindex.recurrence import compile_rule
+from plone.app.eventindex.recurrence import expand_seconds
+from plone.app.eventindex.recurrence import fixed_offset
+from plone.app.eventindex.recurrence import is_open_ended
+from plone.app.eventindex.recurrence import is_seekable
+from plone.app.eventindex.recurrence import last_occurrence
+from plone.app.eventindex.recurrence import period_signature
+from plone.app.eventindex.recurrence import rule_cache
+from plone.app.eventindex.recurrence import rule_cost
+from plone.app.eventindex.recurrence import rule_signature
+from plone.app.eventindex.recurrence import rule_step
+from plone.app.eventindex.recurrence import seek
+from plone.app.eventindex.recurrence import seek_rule
+from plone.app.eventindex.recurrence import to_seconds
+from plone.app.eventindex.recurrence import utc_seconds
+from pytz import timezone
+from pytz import utc
+
+import unittest2 as unittest
+
+
+RULES = [
+    'RRULE:FREQ=DAILY',
+    'RRULE:FREQ=DAILY;INTERVAL=3;COUNT=1000',
+    'RRULE:FREQ=DAILY;BYHOUR=8,20;BYMINUTE=15,45;COUNT=777',
+    'RRULE:FREQ=DAILY;BYDAY=MO,WE;BYMONTH=1,6',
+    'RRULE:FREQ=DAILY;UNTIL=20130101T000000Z',
+    'RRULE:FREQ=WEEKLY;COUNT=300',
+    'RRULE:FREQ=WEEKLY;INTERVAL=2;BYDAY=MO,TH,SU;COUNT=500',
+    'RRULE:FREQ=WEEKLY;INTERVAL=3;BYDAY=TU,SA;WKST=SU',
+    'RRULE:FREQ=WEEKLY;BYDAY=FR;BYMONTH=3',
+    'RRULE:FREQ=MONTHLY;COUNT=120',
+    'RRULE:FREQ=MONTHLY;INTERVAL=5;BYMONTHDAY=1,15,28;COUNT=100',
+    'RRULE:FREQ=MONTHLY;BYMONTHDAY=31',
+    'RRULE:FREQ=MONTHLY;BYDAY=MO,FR;UNTIL=20150101T000000Z',
+    'RRULE:FREQ=YEARLY;COUNT=40',
+    'RRULE:FREQ=YEARLY;BYMONTH=2;BYMONTHDAY=29',
+    'RRULE:FREQ=YEARLY;INTERVAL=2;BYMONTH=3,9;BYMONTHDAY=10,20;COUNT=60',
+    'RRULE:FREQ=HOURLY;INTERVAL=7;COUNT=5000',
+    'RRULE:FREQ=HOURLY;BYMINUTE=0,30;UNTIL=20120101T000000Z',
+    'RRULE:FREQ=MINUTELY;INTERVAL=13;COUNT=20000',
+    'RRULE:FREQ=SECONDLY;INTERVAL=3600;COUNT=10000',
+    # Not seekable, these are expanded from the start:
+    'RRULE:FREQ=MONTHLY;BYDAY=MO;BYSETPOS=-1',
+    'RRULE:FREQ=MONTHLY;BYDAY=2TU;COUNT=50',
+    'RRULE:FREQ=HOURLY;BYHOUR=9,10,11;COUNT=1000',
+    'RRULE:FREQ=DAILY;BYDAY=MO;COUNT=50',
+    # Rulesets:
+    'RRULE:FREQ=WEEKLY;COUNT=200\nEXDATE:20110412T120000Z,20120103T120000Z',
+    'RRULE:FREQ=DAILY;INTERVAL=2\nEXRULE:FREQ=WEEKLY;BYDAY=SA,SU\n'
+    'RDATE:20110401T090000Z',
+]
+
+TARGETS = [
+    datetime(2010, 1, 1),
+    datetime(2011, 3, 5, 11, 59),
+    datetime(2011, 3, 5, 12, 0),
+    datetime(2011, 3, 6, 12, 0),
+    datetime(2012, 2, 29, 23, 30),
+    datetime(2013, 7, 14, 3, 17, 12),
+    datetime(2016, 12, 31, 23, 59, 59),
+    datetime(2030, 1, 1),
+]
+
+
+def expand(rule, targets, n):
+    """Brute force the first n occurrences at or after each of the targets.
+
+    The rule is expanded once from its start for all the targets.
+    """
+    if rule._tzinfo if hasattr(rule, '_tzinfo') else rule._rrule[0]._tzinfo:
+        targets = [dt.replace(tzinfo=UTC) for dt in targets]
+    results = [[] for dt in targets]
+    for occurrence in rule:
+        done = True
+        for dt, result in zip(targets, results):
+            if occurrence >= dt and len(result) < n:
+                result.append(occurrence)
+            done = done and len(result) == n
+        if done:
+            break
+    return results
+
+
+class SeekTests(unittest.TestCase):
+
+    def assertEquivalent(self, dtstart):
+        for text in RULES:
+            rule = rrule.rrulestr(text, dtstart=dtstart)
+            sync_timezone(rule, dtstart.tzinfo)
+            expected = expand(rule, TARGETS, 25)
+            for target, expected in zip(TARGETS, expected):
+                found = list(islice(seek(rule, target), 25))
+                self.assertEqual(found, expected,
+                                 '%s from %s' % (text.split('\n')[0], target))
+
+    def test_naive(self):
+        self.assertEquivalent(datetime(2011, 3, 5, 12, 0))
+
+    def test_timezone(self):
+        helsinki = timezone('Europe/Helsinki')
+        self.assertEquivalent(helsinki.localize(datetime(2011, 3, 5, 23, 30)))
+
+    def test_negative_offset(self):
+        eastern = timezone('US/Eastern')
+        self.assertEquivalent(eastern.localize(datetime(2011, 3, 5, 20, 45)))
+
+    def test_varying_offsets(self):
+        # The offsets of zoneinfo files change with daylight saving time,
+        # so the offset of the start doesn't hold for all occurrences:
+        self.assertEquivalent(
+            datetime(2011, 6, 1, 23, 30, tzinfo=gettz('Europe/Helsinki')))
+
+    def test_is_seekable(self):
+        dtstart = datetime(2011, 3, 5, 12, 0)
+        self.assertTrue(is_seekable(rrule.rrulestr(
+            'RRULE:FREQ=WEEKLY;BYDAY=MO,TH;COUNT=10', dtstart=dtstart)))
+        self.assertFalse(is_seekable(rrule.rrulestr(
+            'RRULE:FREQ=MONTHLY;BYDAY=MO;BYSETPOS=-1', dtstart=dtstart)))
+        self.assertFalse(is_seekable(rrule.rrulestr(
+            'RRULE:FREQ=MONTHLY;BYMONTHDAY=31;COUNT=10', dtstart=dtstart)))
+        self.assertTrue(is_seekable(rrule.rrulestr(
+            'RRULE:FREQ=MONTHLY;BYMONTHDAY=31', dtstart=dtstart)))
+
+    def test_seek_skips_ahead(self):
+        rule = rrule.rrulestr('RRULE:FREQ=MINUTELY',
+                              dtstart=datetime(2005, 1, 1, 12, 0))
+        shifted = seek_rule(rule, datetime(2011, 3, 5, 12, 0, 30))
+        self.assertEqual(shifted._dtstart, datetime(2011, 3, 5, 12, 0))
+        self.assertEqual(seek(rule, datetime(2011, 3, 5, 12, 0, 30)).next(),
+                         datetime(2011, 3, 5, 12, 1))
+
+    def test_seek_exhausted(self):
+        rule = rrule.rrulestr('RRULE:FREQ=DAILY;COUNT=10',
+                              dtstart=datetime(2011, 3, 5, 12, 0))
+        self.assertEqual(seek_rule(rule, datetime(2011, 4, 1)), None)
+        self.assertEqual(list(seek(rule, datetime(2011, 4, 1))), [])
+        self.assertEqual(list(seek(rule, datetime(2011, 3, 14, 12, 0))),
+                         [datetime(2011, 3, 14, 12, 0)])
+
+
+class RuleStorageTests(unittest.TestCase):
+
+    def setUp(self):
+        rule_cache.clear()
+
+    def test_roundtrip(self):
+        helsinki = timezone('Europe/Helsinki')
+        texts = RULES + [
+            'RRULE:FREQ=MONTHLY;BYDAY=+1MO,-1FR;BYMONTHDAY=-3,5;WKST=SU',
+            'RRULE:FREQ=YEARLY;BYWEEKNO=20;BYYEARDAY=100,200',
+            'RRULE:FREQ=YEARLY;BYEASTER=0,-2;COUNT=10',
+        ]
+        for dtstart in [datetime(2011, 3, 5, 12, 0),
+                        helsinki.localize(datetime(2011, 3, 5, 23, 30))]:
+            for text in texts:
+                rule = rrule.rrulestr(text, dtstart=dtstart)
+                sync_timezone(rule, dtstart.tzinfo)
+                canonical = canonical_rule(rule, dtstart)
+                rule_cache.clear()
+                compiled = compile_rule(canonical)
+                self.assertFalse(compiled is rule)
+                self.assertEqual(list(islice(compiled, 50)),
+                                 list(islice(rule, 50)), text)
+
+    def test_compile_cached(self):
+        helsinki = timezone('Europe/Helsinki')
+        dtstart = helsinki.localize(datetime(2011, 10, 3, 15, 40))
+        stored = ('RRULE:FREQ=DAILY;COUNT=3', to_seconds(dtstart),
+                  'Europe/Helsinki')
+        rule = compile_rule(stored)
+        self.assertEqual(list(rule), [dtstart + timedelta(days=i)
+                                      for i in range(3)])
+        self.assertTrue(compile_rule(stored) is rule)
+        self.assertEqual((rule_cache.hits, rule_cache.misses), (1, 1))
+
+        # Rules that aren't in the compact form are used as they are:
+        self.assertTrue(compile_rule(rule) is rule)
+        self.assertEqual(compile_rule(None), None)
+
+
+class SignatureTests(unittest.TestCase):
+
+    def test_signature_covers_occurrences(self):
+        helsinki = timezone('Asia/Kolkata')
+        for dtstart in [datetime(2011, 3, 5, 23, 30),
+                        helsinki.localize(datetime(2011, 3, 5, 23, 30)),
+                        datetime(2011, 6, 1, 23, 30,
+                                 tzinfo=gettz('Europe/Helsinki'))]:
+            for text in RULES:
+                rule = rrule.rrulestr(text, dtstart=dtstart)
+                sync_timezone(rule, dtstart.tzinfo)
+                signature = rule_signature(rule)
+                if signature is None:
+                    continue
+                weekmask, monthmask = signature
+                for occurrence in islice(rule, 400):
+                    seconds = to_seconds(occurrence)
+                    week, month = period_signature(seconds, seconds)
+                    self.assertTrue(week & weekmask, text)
+                    self.assertTrue(month & monthmask, text)
+
+    def test_signature(self):
+        # Tuesdays at 10:00 in UTC+2 start in hour 32 of the UTC week.
+        helsinki = timezone('Europe/Helsinki')
+        dtstart = helsinki.localize(datetime(2011, 1, 4, 10, 0))
+        rule = rrule.rrulestr('RRULE:FREQ=WEEKLY;BYDAY=TU;BYMONTH=1,2',
+                              dtstart=dtstart)
+        self.assertEqual(rule_signature(rule), (1 << 32, 3))
+
+        # Monday 2011-01-03 08:00 to 09:00 UTC:
+        start = to_seconds(datetime(2011, 1, 3, 8))
+        self.assertEqual(period_signature(start, start + 3600),
+                         ((1 << 8) | (1 << 9), 1))
+        week, month = period_signature(start, start + 86400 * 7)
+        self.assertEqual(week, (1 << 168) - 1)
+
+    def test_rule_cost(self):
+        dtstart = datetime(2011, 3, 5, 12, 0)
+        for text, cost in [
+                ('RRULE:FREQ=DAILY', COST_SEEKABLE),
+                ('RRULE:FREQ=MONTHLY;BYDAY=2TU', COST_EXPANDED),
+                ('RRULE:FREQ=HOURLY;BYHOUR=9,10', COST_FINE),
+                ('RRULE:FREQ=DAILY\nEXRULE:FREQ=MONTHLY;BYDAY=2TU',
+                 COST_EXPANDED),
+                ]:
+            self.assertEqual(rule_cost(rrule.rrulestr(text, dtstart=dtstart)),
+                             cost, text)
+
+    def test_rule_step(self):
+        helsinki = timezone('Europe/Helsinki')
+        dtstart = helsinki.localize(datetime(2011, 3, 5, 12, 30))
+        for text, step in [
+                ('RRULE:FREQ=DAILY', 86400),
+                ('RRULE:FREQ=WEEKLY;INTERVAL=2;COUNT=5', 14 * 86400),
+                ('RRULE:FREQ=WEEKLY;BYDAY=SA', 7 * 86400),
+                ('RRULE:FREQ=HOURLY;INTERVAL=3', 3 * 3600),
+                ('RRULE:FREQ=MINUTELY;INTERVAL=90', 90 * 60),
+                ('RRULE:FREQ=SECONDLY', 1),
+                ('RRULE:FREQ=WEEKLY;BYDAY=SU', None),
+                ('RRULE:FREQ=WEEKLY;BYDAY=SA,SU', None),
+                ('RRULE:FREQ=DAILY;BYHOUR=12,18', None),
+                ('RRULE:FREQ=DAILY;BYDAY=SA', None),
+                ('RRULE:FREQ=HOURLY;BYHOUR=12', None),
+                ('RRULE:FREQ=MONTHLY', None),
+                ('RRULE:FREQ=DAILY;BYMONTH=3', None),
+                ('RRULE:FREQ=DAILY\nEXDATE:20110306T123000', None),
+                ]:
+            rule = rrule.rrulestr(text, dtstart=dtstart)
+            sync_timezone(rule, dtstart.tzinfo)
+            self.assertEqual(rule_step(rule), step, text)
+
+
+class ConversionTests(unittest.TestCase):
+
+    def test_utc_seconds(self):
+        helsinki = timezone('Europe/Helsinki')
+        eastern = timezone('US/Eastern')
+        for dt in [datetime(2011, 3, 27, 3, 30),
+                   helsinki.localize(datetime(2011, 3, 27, 4, 30)),
+                   helsinki.localize(datetime(2011, 10, 30, 3, 30)),
+                   eastern.localize(datetime(1969, 12, 31, 23, 59, 59)),
+                   utc.localize(datetime(2038, 1, 19, 3, 14, 8)),
+                   datetime(2011, 3, 27, 3, 30, tzinfo=UTC),
+                   datetime(2011, 3, 27, 3, 30,
+                            tzinfo=tzoffset('X', -5400)),
+                   # Offsets depending on the time:
+                   datetime(2011, 3, 27, 4, 30,
+                            tzinfo=gettz('Europe/Helsinki')),
+                   datetime(2011, 10, 30, 2, 30,
+                            tzinfo=gettz('Europe/Helsinki')),
+                   ]:
+            self.assertEqual(utc_seconds(dt), to_seconds(dt), dt)
+
+    def test_fixed_offset(self):
+        helsinki = timezone('Europe/Helsinki')
+        summer = helsinki.localize(datetime(2011, 7, 1)).tzinfo
+        winter = helsinki.localize(datetime(2011, 1, 1)).tzinfo
+        self.assertEqual(fixed_offset(summer), 3 * 3600)
+        self.assertEqual(fixed_offset(winter), 2 * 3600)
+        self.assertEqual(fixed_offset(utc), 0)
+        self.assertEqual(fixed_offset(tzoffset('X', -5400)), -5400)
+        self.assertEqual(fixed_offset(gettz('Europe/Helsinki')), None)
+
+    def test_fixed_offset_cache(self):
+        # Unpickled tzinfos, as loaded from the database, don't fill the
+        # cache, except for pytz, which unpickles to the same tzinfos:
+        from cPickle import dumps
+        from cPickle import loads
+        from plone.app.eventindex.recurrence import _fixed_offsets
+        winter = timezone('Europe/Helsinki').localize(
+            datetime(2011, 1, 1)).tzinfo
+        fixed_offset(winter)
+        size = len(_fixed_offsets)
+        for tzinfo in (gettz('Europe/Helsinki'), tzoffset('X', -5400),
+                       UTC, winter):
+            for i in range(10):
+                fixed_offset(loads(dumps(tzinfo)))
+        self.assertEqual(len(_fixed_offsets), size)
+
+    def assertExpandsLikeTimeTuples(self, dtstart):
+        periods = [(to_seconds(target), to_seconds(target) + 30 * 86400)
+                   for target in TARGETS[1:6]]
+        last = max(end for start, end in periods)
+        duration = 5400
+        for text in RULES:
+            rule = rrule.rrulestr(text, dtstart=dtstart)
+            sync_timezone(rule, dtstart.tzinfo)
+            occurrences = []
+            for occurrence in rule:
+                occurrence = to_seconds(occurrence)
+                if occurrence > last:
+                    break
+                occurrences.append(occurrence)
+            for start, end in periods:
+                expected = [(o, o + duration) for o in occurrences
+                            if o + duration > start and o <= end][:10]
+                found = list(islice(
+                    expand_seconds(rule, duration, start, end), 10))
+                self.assertEqual(found, expected, '%s from %s' % (
+                    text.split('\n')[0], start))
+
+    def test_expand_naive(self):
+        self.assertExpandsLikeTimeTuples(datetime(2011, 3, 5, 12, 0))
+
+    def test_expand_fixed_offsets(self):
+        helsinki = timezone('Europe/Helsinki')
+        self.assertExpandsLikeTimeTuples(
+            helsinki.localize(datetime(2011, 3, 5, 23, 30)))
+
+    def test_expand_varying_offsets(self):
+        self.assertExpandsLikeTimeTuples(
+            datetime(2011, 3, 5, 23, 30, tzinfo=gettz('Europe/Helsinki')))
+
+
+class LastOccurrenceTests(unittest.TestCase):
+
+    def assertLastLikeExpanded(self, dtstart):
+        for text in RULES + [
+                'RRULE:FREQ=HOURLY;COUNT=1',
+                'RRULE:FREQ=DAILY;UNTIL=20110301T000000Z',
+                'RRULE:FREQ=WEEKLY;BYDAY=MO,FR;COUNT=7',
+                'RRULE:FREQ=MONTHLY;BYMONTHDAY=5,20;COUNT=13',
+                'RRULE:FREQ=YEARLY;BYMONTH=3;BYMONTHDAY=1;'
+                'UNTIL=20300101T000000Z',
+                'RRULE:FREQ=DAILY;BYMONTH=2;UNTIL=20200601T000000Z',
+                'RRULE:FREQ=DAILY;COUNT=10;UNTIL=20110310T000000Z',
+                'RRULE:FREQ=HOURLY;BYMINUTE=0,30;COUNT=99',
+                'RRULE:FREQ=WEEKLY;COUNT=20\nEXDATE:20110723T203000Z',
+                ]:
+            rule = rrule.rrulestr(text, dtstart=dtstart)
+            sync_timezone(rule, dtstart.tzinfo)
+            if is_open_ended(rule):
+                continue
+            expected = None
+            for occurrence in rule:
+                expected = occurrence
+            self.assertEqual(last_occurrence(rule), expected, text)
+
+    def test_naive(self):
+        self.assertLastLikeExpanded(datetime(2011, 3, 5, 12, 0))
+
+    def test_timezone(self):
+        helsinki = timezone('Europe/Helsinki')
+        self.assertLastLikeExpanded(
+            helsinki.localize(datetime(2011, 3, 5, 23, 30)))
+
+    def test_varying_offsets(self):
+        self.assertLastLikeExpanded(
+            datetime(2011, 3, 5, 23, 30, tzinfo=gettz('Europe/Helsinki')))
+
+    def test_no_occurrences(self):
+        rule = rrule.rrulestr('RRULE:FREQ=DAILY;UNTIL=20110101T000000',
+                              dtstart=datetime(2011, 3, 5, 12, 0))
+        self.assertEqual(last_occurrence(rule), None)
+
+    def test_huge_counts(self):
+        dtstart = datetime(2011, 3, 5, 12, 0)
+        rule = rrule.rrulestr('RRULE:FREQ=HOURLY;COUNT=10000000',
+                              dtstart=dtstart)
+        self.assertEqual(last_occurrence(rule, 10),
+                         dtstart + timedelta(hours=10000000 - 1))
+        # Beyond the year 9999:
+        rule = rrule.rrulestr('RRULE:FREQ=HOURLY;COUNT=100000000',
+                              dtstart=dtstart)
+        self.assertRaises(ExpansionBudgetExceeded, last_occurrence, rule, 10)
+        rule = rrule.rrulestr('RRULE:FREQ=DAILY;BYHOUR=8,20;COUNT=1000001',
+                              dtstart=dtstart)
+        self.assertEqual(last_occurrence(rule, 10),
+                         datetime(2011, 3, 5, 20) + timedelta(days=500000))
+        # Not seekable, so it's expanded:
+        rule = rrule.rrulestr('RRULE:FREQ=MONTHLY;BYDAY=MO;BYSETPOS=-1;'
+                              'COUNT=1000', dtstart=dtstart)
+        self.assertRaises(ExpansionBudgetExceeded, last_occurrence, rule, 10)
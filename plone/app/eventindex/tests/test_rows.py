@@ -0,0 +1,34 @@
+from plone.app.eventindex.rows import Row
+
+import unittest2 as unittest
+
+
+class RowTests(unittest.TestCase):
+
+    def _resolve(self, old, committed, new):
+        row = Row()
+        state = row._p_resolveConflict(Row(old).__getstate__(),
+                                       Row(committed).__getstate__(),
+                                       Row(new).__getstate__())
+        row.__setstate__(state)
+        return list(row)
+
+    def test_merge(self):
+        # Both transactions remove the first documentId of the row, which
+        # plain sets can't resolve:
+        self.assertEqual(self._resolve([1, 2, 3], [2, 3, 4], [2, 3, 5]),
+                         [2, 3, 4, 5])
+        self.assertEqual(self._resolve([1, 2, 3], [2, 3], [1, 3]), [3])
+        self.assertEqual(self._resolve([1], [], [1, 2]), [2])
+        self.assertEqual(self._resolve([], [1], [2]), [1, 2])
+        # Rows can become empty:
+        self.assertEqual(self._resolve([1, 2], [2], [1]), [])
+
+    def test_large_rows(self):
+        # Rows with buckets of their own are resolved by their buckets, the
+        # changes to the row itself still conflict:
+        from ZODB.POSException import ConflictError
+        row = Row(range(1000))
+        state = row.__getstate__()
+        self.assertRaises(ConflictError, row._p_resolveConflict,
+                          state, state, state)
@@ -0,0 +1,167 @@
+from datetime import datetime
+from plone.app.eventindex import EventIndex
+from plone.app.eventindex import stats
+from plone.app.eventindex.stats import QueryStats
+from plone.app.eventindex.stats import Statistics
+
+import unittest2 as unittest
+
+
+class TestOb(object):
+
+    def __init__(self, start, end, recurrence=None):
+        self.start = start
+        self.end = end
+        self.recurrence = recurrence
+
+
+class StatisticsTests(unittest.TestCase):
+
+    def test_query_stats(self):
+        query = QueryStats(datetime(2011, 4, 5), datetime(2011, 4, 6))
+        query.cost(1, 5)
+        query.cost(2, 50)
+        query.cost(1, 10)
+        query.phase('search')
+        query.finish(3)
+        self.assertEqual(query.occurrences, 65)
+        self.assertEqual(query.top_costs(), [(2, 50), (1, 15)])
+        self.assertEqual(query.top_costs(1), [(2, 50)])
+        self.assertEqual(query.results, 3)
+        self.assertEqual(query.phases.keys(), ['search'])
+        self.assertTrue(query.elapsed >= query.phases['search'])
+
+    def test_aggregate(self):
+        statistics = Statistics()
+        for candidates in (10, 30):
+            query = QueryStats()
+            query.candidates = candidates
+            query.scans['end'] = candidates * 2
+            query.finish(1)
+            statistics.record(query)
+        query = QueryStats(datetime(2011, 4, 5), datetime(2011, 4, 6))
+        query.exit = 'cached'
+        query.finish(1)
+        statistics.record(query, slow=True)
+        self.assertEqual(statistics.over_budget(5), 1)
+        self.assertEqual(statistics.over_budget(7), 1)
+        self.assertEqual(statistics.over_budget(5), 2)
+
+        summary = statistics.summary()
+        self.assertEqual(summary['queries'], 3)
+        self.assertTrue(('candidates', 40, 40 / 3.0) in summary['counters'])
+        self.assertEqual(summary['scans'], [('end', 80)])
+        self.assertEqual(summary['exits'], [('cached', 1)])
+        self.assertEqual(len(summary['slow']), 1)
+        self.assertEqual(summary['slow'][0]['start'], datetime(2011, 4, 5))
+        self.assertEqual(summary['over_budget'], [(5, 2), (7, 1)])
+
+        statistics.reset()
+        self.assertEqual(statistics.summary()['queries'], 0)
+        self.assertEqual(statistics.summary()['slow'], [])
+        self.assertEqual(statistics.summary()['over_budget'], [])
+
+    def test_index_statistics(self):
+        index = EventIndex('event')
+        index.index_object(1, TestOb(datetime(2011, 4, 5, 12, 0),
+                                     datetime(2011, 4, 5, 13, 0)))
+        # Not regular, so it's expanded:
+        index.index_object(2, TestOb(datetime(2011, 1, 3, 12, 0),
+                                     datetime(2011, 1, 3, 13, 0),
+                                     'RRULE:FREQ=MONTHLY;BYMONTHDAY=3'))
+        index.slow_query_threshold = None
+        reported = []
+        stats.hooks.append(lambda index, query: reported.append(query))
+        try:
+            result, used_fields = index._apply_index({'event': {
+                'start': datetime(2011, 4, 1), 'end': datetime(2011, 4, 6)}})
+        finally:
+            stats.hooks.pop()
+
+        self.assertEqual(list(result), [1, 2])
+        self.assertEqual(len(reported), 1)
+        query = reported[0]
+        self.assertEqual(query.start, datetime(2011, 4, 1))
+        self.assertEqual(query.candidates, 2)
+        self.assertEqual(query.recurring, 1)
+        self.assertEqual(query.expanded, 1)
+        self.assertEqual(query.results, 2)
+        self.assertEqual(query.scans.keys(), ['grid'])
+        # Seeking skipped to March, before the period, and found April:
+        self.assertEqual(query.costs, {2: 2})
+        self.assertEqual(sorted(query.phases), ['expand', 'filter', 'search'])
+
+        summary = index.getStatistics()
+        self.assertEqual(summary['queries'], 1)
+        self.assertEqual(summary['slow'], [])
+
+        # Every query is slow with a threshold of 0:
+        index.slow_query_threshold = 0
+        index._apply_index({'event': {'start': datetime(2011, 4, 1),
+                                      'end': datetime(2011, 4, 6)}})
+        summary = index.getStatistics()
+        self.assertEqual(summary['queries'], 2)
+        self.assertEqual(summary['slow'][0]['top_costs'], [(2, 2)])
+
+        index.manage_resetStatistics()
+        self.assertEqual(index.getStatistics()['queries'], 0)
+
+    def test_over_budget(self):
+        from ZODB.DB import DB
+        import transaction
+
+        db = DB(None)
+        connection = db.open()
+        index = connection.root()['index'] = EventIndex('event')
+        # The last Monday of the month, which is expanded:
+        index.index_object(1, TestOb(
+            datetime(2011, 1, 3, 12, 0), datetime(2011, 1, 3, 13, 0),
+            'RRULE:FREQ=MONTHLY;BYDAY=MO;BYSETPOS=-1'))
+        index.max_occurrences = 1
+        index.slow_query_threshold = None
+        transaction.commit()
+        # Other tests may have used the statistics of the same oid:
+        index.manage_resetStatistics()
+        try:
+            index._apply_index({'event': {'start': datetime(2011, 4, 1),
+                                          'end': datetime(2011, 4, 6)}})
+            self.assertEqual(index.getOverBudget(), {1: 1})
+            self.assertEqual(index.getStatistics()['over_budget'], [(1, 1)])
+
+            # The counts are kept by the process, not by the index object:
+            connection.cacheMinimize()
+            self.assertEqual(index._p_changed, None)
+            self.assertEqual(index.getOverBudget(), {1: 1})
+            other = db.open()
+            self.assertEqual(other.root()['index'].getOverBudget(), {1: 1})
+            other.close()
+
+            index.manage_resetStatistics()
+            self.assertEqual(index.getOverBudget(), {})
+        finally:
+            transaction.abort()
+            connection.close()
+            db.close()
+
+    def test_early_exits(self):
+        index = EventIndex('event')
+        index.slow_query_threshold = None
+        reported = []
+        stats.hooks.append(lambda index, query: reported.append(query))
+        try:
+            index._apply_index({'event': {'start': datetime(2011, 4, 1)}})
+            index.index_object(1, TestOb(datetime(2011, 4, 5, 12, 0),
+                                         datetime(2011, 4, 5, 13, 0)))
+            index._apply_index({'event': {}})
+        finally:
+            stats.hooks.pop()
+        self.assertEqual([query.exit for query in reported],
+                         ['empty', 'unbounded'])
+        self.assertEqual(reported[1].candidates, 1)
+
+    def test_manage_statistics(self):
+        from App.special_dtml import DTMLFile
+        self.assertTrue(isinstance(EventIndex.manage_statistics, DTMLFile))
+        self.assertTrue({'label': 'Statistics',
+                         'action': 'manage_statistics'}
+                        in EventIndex.manage_options)
@@ -0,0 +1,74 @@
+from datetime import datetime
+from datetime import timedelta
+from plone.app.eventindex import EventIndex
+from plone.app.eventindex import vectorized
+from plone.app.eventindex.tests.test_EventIndex import TestOb
+from pytz import timezone
+from random import Random
+
+import mock
+import unittest2 as unittest
+
+
+class VectorizedTests(unittest.TestCase):
+
+    def test_overlapping(self):
+        # Every 10 seconds from 100 to 150, lasting 3 seconds:
+        args = ([1], [100], [10], [150], [3])
+        for start, end, expected in [
+                (None, None, [1]),
+                (None, 99, []),
+                (None, 100, [1]),
+                (103, 109, []),
+                (102, 103, [1]),
+                (153, None, []),
+                (152, None, [1]),
+                (90, 95, []),
+                ]:
+            self.assertEqual(vectorized.overlapping(*args + (start, end)),
+                             expected, (start, end))
+            with mock.patch.object(vectorized, 'numpy', None):
+                self.assertEqual(vectorized.overlapping(*args + (start, end)),
+                                 expected, (start, end))
+
+    def test_regular_recurrences(self):
+        helsinki = timezone('Europe/Helsinki')
+        random = Random(15)
+        rules = ['RRULE:FREQ=DAILY',
+                 'RRULE:FREQ=DAILY;INTERVAL=3;COUNT=20',
+                 'RRULE:FREQ=WEEKLY;UNTIL=20120101T000000Z',
+                 'RRULE:FREQ=WEEKLY;INTERVAL=2',
+                 'RRULE:FREQ=HOURLY;INTERVAL=7;COUNT=100',
+                 'RRULE:FREQ=MINUTELY;INTERVAL=600']
+        events = []
+        for documentId in range(1, 201):
+            start = datetime(2011, 1, 1) + timedelta(
+                minutes=random.randint(0, 60 * 24 * 365))
+            if random.random() < 0.5:
+                start = helsinki.localize(start)
+            events.append((documentId, TestOb(
+                'a', start, start + timedelta(minutes=random.choice(
+                    [0, 30, 60 * 5, 60 * 24 * 3])),
+                random.choice(rules))))
+
+        index = EventIndex('event')
+        index.index_objects(events)
+        self.assertEqual(len(index._uid2step), 200)
+        expanded = EventIndex('event')
+        expanded.index_objects(events)
+        expanded._uid2step.clear()
+
+        for i in range(50):
+            start = datetime(2011, 1, 1) + timedelta(
+                minutes=random.randint(0, 60 * 24 * 500))
+            end = start + timedelta(minutes=random.choice(
+                [0, 1, 59, 60 * 24, 60 * 24 * 9]))
+            for query in ({'start': start, 'end': end}, {'start': start},
+                          {'end': end}):
+                expected = list(expanded._apply_index({'event': query})[0])
+                self.assertEqual(
+                    list(index._apply_index({'event': query})[0]), expected)
+                with mock.patch.object(vectorized, 'numpy', None):
+                    self.assertEqual(
+                        list(index._apply_index({'event': query})[0]),
+                        expected)
@@ -0,0 +1,39 @@
+"""Upgrade the event indexes of catalogs after deploying a new version.
+
+The data structures of an index from an older version are upgraded in
+place, one index per transaction, before the site is used again. Until an
+index is upgraded, queries and indexing raise ``UpgradeRequired``.
+
+Call ``upgrade_catalog()`` from a GenericSetup upgrade step of the site,
+or from ``bin/instance debug``::
+
+  >>> from plone.app.eventindex.upgrade import upgrade_catalog
+  >>> upgrade_catalog(app.Plone.portal_catalog)
+  ['event']
+"""
+from plone.app.eventindex import EventIndex
+
+import logging
+import transaction
+
+logger = logging.getLogger('plone.app.eventindex')
+
+
+def upgrade_catalog(catalog, commit=True):
+    """Upgrade the outdated event indexes of a ZCatalog.
+
+    Unless ``commit`` is False, the transaction is committed after every
+    index, so a large catalog isn't upgraded in a single transaction.
+
+    Returns the ids of the indexes upgraded.
+    """
+    upgraded = []
+    for index in catalog.getIndexObjects():
+        if isinstance(index, EventIndex) and index.needsUpgrade():
+            logger.info('Upgrading index %s', index.getId())
+            index.upgrade()
+            upgraded.append(index.getId())
+            if commit:
+                transaction.commit()
+    return upgraded
+
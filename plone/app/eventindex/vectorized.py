@@ -0,0 +1,51 @@
+"""Check regular recurrences against a period with arithmetic.
+
+The occurrences of regular recurrences, see ``rule_step``, are arithmetic
+progressions of seconds since the epoch, so whether any occurrence overlaps
+a period can be computed without expanding them. If NumPy is installed,
+this is done for all the recurrences of a query at once.
+"""
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def overlapping(documentIds, firsts, steps, lasts, durations, start, end):
+    """Find the regular recurrences with an occurrence within a period.
+
+    The recurrence of ``documentIds[i]`` has occurrences every ``steps[i]``
+    seconds from ``firsts[i]`` up to and including ``lasts[i]``, each lasting
+    ``durations[i]`` seconds. ``start`` and ``end`` are seconds since the
+    epoch or None. Returns the list of the documentIds with an occurrence
+    that ends after ``start`` and starts before or at ``end``.
+    """
+    if numpy is not None:
+        return _overlapping_numpy(documentIds, firsts, steps, lasts,
+                                  durations, start, end)
+
+    result = []
+    for documentId, first, step, last, duration in zip(
+            documentIds, firsts, steps, lasts, durations):
+        occurrence = first
+        if start is not None and first + duration <= start:
+            # The first occurrence ending after the start:
+            occurrence += ((start - duration - first) // step + 1) * step
+        if occurrence <= last and (end is None or occurrence <= end):
+            result.append(documentId)
+    return result
+
+
+def _overlapping_numpy(documentIds, firsts, steps, lasts, durations, start,
+                       end):
+    firsts = numpy.array(firsts, dtype=numpy.int64)
+    steps = numpy.array(steps, dtype=numpy.int64)
+    occurrences = firsts
+    if start is not None:
+        periods = (start - numpy.array(durations, dtype=numpy.int64) -
+                   firsts) // steps + 1
+        occurrences = firsts + numpy.maximum(periods, 0) * steps
+    matches = occurrences <= numpy.array(lasts, dtype=numpy.int64)
+    if end is not None:
+        matches &= occurrences <= end
+    return numpy.array(documentIds, dtype=numpy.int64)[matches].tolist()
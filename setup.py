@@ -31,13 +31,22 @@ setup(
         'Zope2',
         'mock',
         'python-dateutil<2.0',
+        'pytz',
         'setuptools',
         'unittest2',
     ],
+    extras_require={
+        'numpy': ['numpy'],
+    },
     entry_points="""
     # -*- Entry points: -*-
 
     [z3c.autoinclude.plugin]
     target = plone
+
+    [console_scripts]
+    eventindex-benchmark = plone.app.eventindex.benchmark.runner:main
+    eventindex-conflicts = plone.app.eventindex.benchmark.conflicts:main
+    eventindex-load-ical = plone.app.eventindex.ical:main
     """,
       )